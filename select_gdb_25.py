@@ -2,78 +2,167 @@
 import os
 import sys
 import logging
+import logging.handlers
+import threading
+import atexit
 import traceback
 import datetime
+import argparse
 import re
+import math
+import collections
+import json
+import io
+import contextlib
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import time
+import shutil
+import tempfile
+import hashlib
+import bisect
+import array
 
 # Настройка логирования
 log_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "select_gdb_log.txt")
 
-# Для Python 2.7 нельзя использовать encoding в basicConfig, делаем по-другому
-if sys.version_info < (3, 0):
-    # Создаем обработчик с явной кодировкой для Windows
-    import codecs
-    # На Windows для Python 2.7 лучше использовать cp1251 вместо utf-8
-    log_handler = logging.FileHandler(log_file)
-    log_handler.setLevel(logging.DEBUG)
-    log_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-    
-    # Создаем логгер и добавляем обработчик
-    logger = logging.getLogger('')
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(log_handler)
-    
-    # Убираем стандартные обработчики, чтобы избежать дублирования
-    for hdlr in logger.handlers[:]:
-        if isinstance(hdlr, logging.StreamHandler) or isinstance(hdlr, logging.FileHandler):
-            if hdlr != log_handler:
-                logger.removeHandler(hdlr)
-    
-    # Функция для перекодирования строк
-    def encode_if_needed(s):
-        if isinstance(s, unicode):
-            return s  # Сохраняем unicode для записи в файл
+# Уровень подробности лога (можно переопределить переменной окружения SELECT_GDB_LOG_LEVEL=DEBUG)
+LOG_LEVEL = getattr(logging, os.environ.get("SELECT_GDB_LOG_LEVEL", "INFO").upper(), logging.INFO)
+# Ротация файла лога по размеру, чтобы лог не рос бесконечно на длинных пакетных запусках
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+def to_text(value):
+    """Приводит значение к тексту в unicode; байтовые строки Python 2 декодируются из utf-8 или cp1251"""
+    if sys.version_info[0] >= 3:
+        return value if isinstance(value, str) else str(value)
+    if isinstance(value, unicode):
+        return value
+    if not isinstance(value, str):
         try:
-            return unicode(s, 'utf-8')  # Пытаемся декодировать из utf-8
-        except:
-            try:
-                return unicode(s, 'cp1251')  # Пытаемся декодировать из cp1251
-            except:
-                return unicode(str(s), errors='replace')  # Если не получается, заменяем на символы
-    
-    # Переопределяем все функции логирования
-    def encoded_log(original_log, msg, *args, **kwargs):
-        msg = encode_if_needed(msg)
-        original_log(msg, *args, **kwargs)
-    
-    # Сохраняем оригинальные функции логирования
-    original_debug = logger.debug
-    original_info = logger.info
-    original_warning = logger.warning
-    original_error = logger.error
-    original_critical = logger.critical
-    
-    # Переопределяем функции логирования
-    logger.debug = lambda msg, *args, **kwargs: encoded_log(original_debug, msg, *args, **kwargs)
-    logger.info = lambda msg, *args, **kwargs: encoded_log(original_info, msg, *args, **kwargs)
-    logger.warning = lambda msg, *args, **kwargs: encoded_log(original_warning, msg, *args, **kwargs)
-    logger.error = lambda msg, *args, **kwargs: encoded_log(original_error, msg, *args, **kwargs)
-    logger.critical = lambda msg, *args, **kwargs: encoded_log(original_critical, msg, *args, **kwargs)
-    
-    # Добавляем консольный вывод для отладки
-    console = logging.StreamHandler()
-    console.setLevel(logging.DEBUG)
-    console.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-    logger.addHandler(console)
+            return unicode(value)
+        except UnicodeError:
+            value = str(value)
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        return value.decode('cp1251', 'replace')
+
+class QueueLogHandler(logging.Handler):
+    """Обработчик, который только ставит запись в очередь.
+    Форматирование и запись в файл выполняются в фоновом потоке QueueLogListener,
+    поэтому вызов logging.* не ждет диска и не блокирует геообработку."""
+    def __init__(self, log_queue):
+        logging.Handler.__init__(self)
+        self.queue = log_queue
     
-else:
-    # Для Python 3 можно использовать encoding
-    logging.basicConfig(
-        filename=log_file,
-        level=logging.DEBUG,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        encoding='utf-8'
-    )
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+class QueueLogListener:
+    """Фоновый поток, передающий записи из очереди конечным обработчикам"""
+    def __init__(self, log_queue, handlers):
+        self.queue = log_queue
+        self.handlers = handlers
+        self.thread = None
+    
+    def start(self):
+        self.thread = threading.Thread(target=self.monitor, name="select_gdb_log_listener")
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def monitor(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            if sys.version_info[0] < 3:
+                # Приводим сообщение к unicode один раз и уже вне потока геообработки
+                record.msg = to_text(record.msg)
+                if record.args and isinstance(record.args, tuple):
+                    record.args = tuple(to_text(arg) if isinstance(arg, str) else arg for arg in record.args)
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+    
+    def stop(self):
+        """Дописывает оставшиеся в очереди записи и останавливает поток"""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        for handler in self.handlers:
+            handler.close()
+
+class WorkerLogBuffer(logging.Handler):
+    """Накопление записей лога в дочернем процессе пула: записи возвращаются родительскому
+    процессу вместе с результатом задания и пишутся в лог им, а не дочерним процессом"""
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.setFormatter(logging.Formatter("%(message)s"))
+        self.records = []
+    
+    def emit(self, record):
+        try:
+            self.records.append((record.levelno, to_text(self.format(record))))
+        except Exception:
+            self.handleError(record)
+    
+    def take(self):
+        """Возвращает накопленные записи [(уровень, текст)] и очищает буфер"""
+        records, self.records = self.records, []
+        return records
+
+# Буфер лога дочернего процесса пула (None в основном процессе)
+worker_log_buffer = None
+
+def configure_logging():
+    """Настраивает корневой логгер: запись через очередь в файл с ротацией по размеру
+    
+    Дочерние процессы пула (параллельный Identity) в файл не пишут: записи накапливаются
+    в WorkerLogBuffer и возвращаются родительскому процессу с результатом задания.
+    """
+    global worker_log_buffer
+    import multiprocessing
+    root_logger = logging.getLogger('')
+    root_logger.setLevel(LOG_LEVEL)
+    for hdlr in root_logger.handlers[:]:
+        root_logger.removeHandler(hdlr)
+    
+    formatter = logging.Formatter(LOG_FORMAT)
+    if multiprocessing.current_process().name != "MainProcess":
+        worker_log_buffer = WorkerLogBuffer()
+        root_logger.addHandler(worker_log_buffer)
+        return None
+    
+    handlers = []
+    file_handler = logging.handlers.RotatingFileHandler(
+        log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    file_handler.setLevel(LOG_LEVEL)
+    file_handler.setFormatter(formatter)
+    handlers.append(file_handler)
+    
+    if sys.version_info[0] < 3:
+        # Консольный вывод для окна Python в ArcMap
+        console = logging.StreamHandler()
+        console.setLevel(LOG_LEVEL)
+        console.setFormatter(formatter)
+        handlers.append(console)
+    
+    log_queue = queue.Queue()
+    listener = QueueLogListener(log_queue, handlers)
+    listener.start()
+    root_logger.addHandler(QueueLogHandler(log_queue))
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = configure_logging()
 
 # Функция для логирования ошибок с трассировкой стека
 def log_exception(e, message="Произошла ошибка"):
@@ -125,6 +214,735 @@ except ImportError as e:
     print("ВНИМАНИЕ: Модуль arcpy не найден. Некоторые функции проверки будут недоступны.")
     print("Для полной функциональности запустите скрипт через Python, поставляемый с ArcGIS/ArcMap.")
 
+# Параметры обработки по тайлам для очень крупных лесхозов
+# TILING_MODE: "auto" - по тайлам обрабатываются только слои, число объектов в которых
+# превышает TILING_FEATURE_THRESHOLD; "on" - всегда; "off" - никогда (исходное поведение)
+TILING_MODE = "auto"
+TILING_FEATURE_THRESHOLD = 50000
+TILE_SIZE_METERS = 10000.0
+# Запас вокруг охвата объектов тайла при отборе вырезающих объектов
+TILE_OVERLAP_METERS = 1.0
+# Число процессов для параллельного Identity по тайлам (0 или 1 - последовательно)
+IDENTITY_WORKERS = 0
+# Строить пространственный индекс классов надписей, у которых его нет (изменяет базу прошлого тура)
+LABEL_SPATIAL_INDEX = False
+# Способ присоединения NPP из классов надписей к Land_"Сокр":
+# "identity" - наложение Identity (исходное поведение); "point_in_polygon" - пространственный индекс
+# и попадание точки в полигон / наибольшее перекрытие без наложения; "auto" - "point_in_polygon",
+# если все надписи точечные или их полигоны малы относительно полигонов Land_"Сокр"
+NPP_JOIN_ENGINE = "identity"
+# Полигон надписи считается малым, если его средняя площадь не превышает эту долю средней площади полигона Land
+LABEL_SMALL_POLYGON_RATIO = 0.25
+# Способ сборки Land_"Сокр"_сетка: "legacy" - последовательность инструментов, перезаписывающих класс
+# (исходное поведение); "streaming" - конвейер генераторов над строками и одна запись курсором вставки
+PIPELINE_MODE = "legacy"
+# В режиме "streaming" дополнительно собрать сетку прежним способом и сравнить результаты
+PIPELINE_VALIDATE = False
+# Рабочее пространство временных классов: "in_memory" (ArcMap), "memory" (ArcGIS Pro),
+# "scratch_gdb" - временная файловая GDB в arcpy.env.scratchFolder или "auto" - по оценке объема
+# класса: в SCRATCH_MEMORY_WORKSPACE, пока он помещается в SCRATCH_MEMORY_BUDGET_MB, иначе во временную GDB
+SCRATCH_WORKSPACE = "auto"
+SCRATCH_MEMORY_WORKSPACE = "in_memory"
+# Бюджет памяти для одновременно существующих временных классов в режиме "auto", МБ
+SCRATCH_MEMORY_BUDGET_MB = 512
+# Перепроецировать классы надписей в другой системе координат в систему координат Land_"Сокр"
+# один раз и хранить их в кэше LABEL_CACHE_DIR (False - проецирование на лету в каждом Identity)
+LABEL_PROJECTION_CACHE = True
+LABEL_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "select_gdb_label_cache")
+# Географическое преобразование при перепроецировании надписей со сменой датума (например,
+# "Pulkovo_1942_To_WGS_1984_20"); пустая строка - первое из arcpy.ListTransformations
+LABEL_GEOGRAPHIC_TRANSFORMATION = ""
+# Шаблоны слоев с готовой символикой: LAYER_TEMPLATE_DIR/<роль>.lyr (.lyrx для ArcGIS Pro), где роль -
+# "сетка", "контур", "Lots", "Land" или "Admi". Без шаблона слой создается с символикой по умолчанию
+LAYER_TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "select_gdb_layers")
+# Знаменатель масштаба, мельче которого слой роли не отрисовывается, например {"сетка": 100000}
+# (по умолчанию слои видны при любом масштабе, как и раньше)
+LAYER_MIN_SCALES = {}
+# Определяющие запросы слоев по ролям, например {"сетка": "NPP IS NOT NULL"}
+LAYER_DEFINITION_QUERIES = {}
+# Сохранять рядом с базой файл слоя каждого добавленного в карту результата
+LAYER_FILES_EMIT = True
+# Строить атрибутивные индексы по полям отбора (UsName_1, LandType, LandCode, NPP) и перестраивать
+# пространственный индекс сетки после циклов удаления и добавления объектов
+INDEX_OUTPUTS = True
+# Строить индексы и в исходных классах пользователя (Lots, Land); по умолчанию индексируются только
+# результаты и временные копии скрипта, так как открытый в ArcMap исходный класс заблокирован
+INDEX_SOURCES = False
+# Обслуживание базы геоданных после каждого задания: сжатие (Compact), перестроение пространственных
+# индексов результатов и замер размера базы и скорости чтения до и после
+GDB_MAINTENANCE = False
+# Число объектов каждого класса, читаемых при замере скорости чтения до и после обслуживания
+GDB_MAINTENANCE_SAMPLE_ROWS = 5000
+# Список последних заданий (базы, лесничество, сокращение, классы надписей, снимок каталога) для
+# повторного запуска в один щелчок; метаданные используются повторно, пока базы не изменились
+RECENT_JOBS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "select_gdb_recent.json")
+RECENT_JOBS_LIMIT = 10
+# Таблица сокращений {UsName_1: Сокр} (редактируемый JSON). Сокращение нового лесничества
+# выводится из UsName_1 (derive_short_name) и сохраняется, чтобы пакетные и повторные запуски
+# давали выходным классам те же имена без запроса
+SHORT_NAMES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "select_gdb_short_names.json")
+# Слова, не участвующие в сокращении, и наибольшая длина сокращения первого значимого слова
+SHORT_NAME_STOP_WORDS = ["лесничество", "лесхоз", "лесопарк", "глху", "гплху", "гу", "оао", "зао", "ооо", "уп", "филиал"]
+SHORT_NAME_LENGTH = 10
+
+# Правила отбора объектов по LandType/LandCode (можно переопределить файлом RULES_FILE).
+# Правило - список условий, объединенных через ИЛИ; условие - словарь {поле: значения},
+# поля условия объединяются через И. Значения - список (поле входит в список)
+# или {"not_in": [...]} (поле не входит в список); NULL не удовлетворяет ни одному условию.
+RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "select_gdb_rules.json")
+DEFAULT_RULES = {
+    # Объекты Land, которые попадают в Land_"Сокр"
+    "land_keep": [{"LandType": [101, 102, 103]}],
+    # Объекты Land, которые не попадают в Land_"Сокр"_контур
+    "contour_drop": [{"LandType": [101, 102, 103]}, {"LandCode": [326]}],
+    # Объекты сетки, у которых очищается NPP
+    "npp_clear": [{"LandType": {"not_in": [101, 102, 103]}}],
+    # Объекты сетки, которые удаляются, если не пересекают Lots_"Сокр"
+    "outside_lots_drop": [{"LandCode": [123, 3, 6, 7]}]
+}
+
+
+class FilterRule:
+    """Правило отбора объектов, скомпилированное в SQL-выражение и предикат Python
+    
+    Выражения строятся один раз, а предикат matches дает тот же результат, что и
+    where_clause, поэтому правило можно применять и в запросе, и в потоке строк.
+    """
+    def __init__(self, name, conditions):
+        if isinstance(conditions, dict):
+            conditions = [conditions]
+        self.name = name
+        self.conditions = []
+        for condition in conditions:
+            compiled = []
+            for field, values in sorted(condition.items()):
+                if isinstance(values, dict):
+                    if set(values.keys()) != set(["not_in"]):
+                        raise ValueError("Правило {}: неизвестный оператор для поля {}: {}".format(
+                            name, field, ", ".join(values.keys())))
+                    compiled.append((field, False, list(values["not_in"])))
+                else:
+                    if not isinstance(values, (list, tuple)):
+                        values = [values]
+                    compiled.append((field, True, list(values)))
+            self.conditions.append(compiled)
+        self.fields = sorted(set(field for condition in self.conditions for field, _, _ in condition))
+        self.value_sets = [[(field, is_in, set(values)) for field, is_in, values in condition]
+                           for condition in self.conditions]
+    
+    @staticmethod
+    def sql_values(values):
+        """Список значений для IN: числа как есть, строки в кавычках"""
+        formatted = []
+        for value in values:
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                formatted.append(str(value))
+            else:
+                formatted.append("'{}'".format(to_text(value).replace("'", "''")))
+        return ", ".join(formatted)
+    
+    def where_clause(self):
+        """SQL-выражение объектов, удовлетворяющих правилу"""
+        if not self.conditions:
+            return "1 = 0"
+        parts = []
+        for condition in self.conditions:
+            if not condition:
+                return "1 = 1"
+            terms = ["{} {}IN ({})".format(field, "" if is_in else "NOT ", self.sql_values(values))
+                     for field, is_in, values in condition]
+            parts.append(" AND ".join(terms))
+        if len(parts) == 1:
+            return parts[0]
+        return " OR ".join("({})".format(part) for part in parts)
+    
+    def exclusion_clause(self):
+        """SQL-выражение объектов, НЕ удовлетворяющих правилу; объекты с NULL в полях условия
+        правилу не удовлетворяют и поэтому сюда входят"""
+        if not self.conditions:
+            return "1 = 1"
+        parts = []
+        for condition in self.conditions:
+            if not condition:
+                return "1 = 0"
+            terms = ["{0} IS NULL OR {0} {1}IN ({2})".format(field, "NOT " if is_in else "", self.sql_values(values))
+                     for field, is_in, values in condition]
+            parts.append("({})".format(" OR ".join(terms)))
+        return " AND ".join(parts)
+    
+    def matches(self, values):
+        """Удовлетворяет ли правилу строка values (словарь поле -> значение)"""
+        for condition in self.value_sets:
+            for field, is_in, value_set in condition:
+                value = values.get(field)
+                if value is None or (value in value_set) != is_in:
+                    break
+            else:
+                return True
+        return False
+
+compiled_rules = {}
+
+def load_rules(path=None):
+    """Читает правила: DEFAULT_RULES, переопределенные файлом правил, если он есть"""
+    path = path or RULES_FILE
+    rules = dict(DEFAULT_RULES)
+    if os.path.exists(path):
+        with io.open(path, "r", encoding="utf-8") as rules_file:
+            file_rules = json.load(rules_file)
+        unknown = [name for name in file_rules if name not in DEFAULT_RULES]
+        if unknown:
+            logging.warning("В файле правил {} есть неизвестные правила: {}".format(path, ", ".join(unknown)))
+        rules.update(file_rules)
+        logging.info("Загружены правила отбора из {}".format(path))
+    return rules
+
+def get_rule(name):
+    """Возвращает скомпилированное правило отбора по имени"""
+    if not compiled_rules:
+        for rule_name, conditions in load_rules().items():
+            compiled_rules[rule_name] = FilterRule(rule_name, conditions)
+            logging.info("Правило %s: %s", rule_name, compiled_rules[rule_name].where_clause())
+    return compiled_rules[name]
+
+class HeadlessMessageBox:
+    """Замена messagebox для работы без интерфейса (пакетный режим, дочерние процессы):
+    сообщения пишутся в лог, на вопросы дается ответ по умолчанию"""
+    def __init__(self, default_answer=True):
+        self.default_answer = default_answer
+    
+    def showinfo(self, title, message, **kwargs):
+        logging.info("[{}] {}".format(title, message))
+        return "ok"
+    
+    def showwarning(self, title, message, **kwargs):
+        logging.warning("[{}] {}".format(title, message))
+        return "ok"
+    
+    def showerror(self, title, message, **kwargs):
+        logging.error("[{}] {}".format(title, message))
+        return "ok"
+    
+    def askyesno(self, title, message, **kwargs):
+        logging.info("[{}] {} -> {}".format(title, message, "Да" if self.default_answer else "Нет"))
+        return self.default_answer
+
+class TileMessageCollector(HeadlessMessageBox):
+    """Замена messagebox на время обработки по тайлам: предупреждения и ошибки тайлов
+    пишутся в лог и накапливаются, а report показывает их одним сообщением.
+    Вопросы передаются исходному messagebox"""
+    def __init__(self, wrapped):
+        HeadlessMessageBox.__init__(self)
+        self.wrapped = wrapped
+        self.tile = None
+        self.warnings = []
+        self.errors = []
+    
+    def showwarning(self, title, message, **kwargs):
+        HeadlessMessageBox.showwarning(self, title, message)
+        self.warnings.append((self.tile, message))
+        return "ok"
+    
+    def showerror(self, title, message, **kwargs):
+        HeadlessMessageBox.showerror(self, title, message)
+        self.errors.append((self.tile, message))
+        return "ok"
+    
+    def askyesno(self, title, message, **kwargs):
+        return self.wrapped.askyesno(title, message, **kwargs)
+    
+    def report(self, limit=5):
+        """Показывает накопленные ошибки (или предупреждения) тайлов одним сообщением"""
+        messages = self.errors or self.warnings
+        if not messages:
+            return
+        tiles = set(tile for tile, _ in messages)
+        text = "{} при обработке {} тайлов:\n\n".format("Ошибки" if self.errors else "Предупреждения", len(tiles))
+        text += "\n".join("Тайл {}: {}".format(tile, message) for tile, message in messages[:limit])
+        if len(messages) > limit:
+            text += "\n... и еще {}".format(len(messages) - limit)
+        if self.errors:
+            self.wrapped.showerror("Ошибка", text)
+        else:
+            self.wrapped.showwarning("Предупреждение", text)
+
+def enable_headless_mode(default_answer=True):
+    """Переключает все диалоги сообщений скрипта в неинтерактивный режим"""
+    global messagebox
+    messagebox = HeadlessMessageBox(default_answer)
+    logging.info("Включен режим без интерфейса (ответ на вопросы по умолчанию: {})".format(
+        "Да" if default_answer else "Нет"))
+
+# Журнал событий: одна строка JSON на этап обработки, рядом с select_gdb_log.txt
+EVENT_LOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "select_gdb_events.jsonl")
+EVENT_LOG_ENABLED = True
+# Идентификатор запуска, по которому события группируются при анализе
+RUN_ID = "{}-{}".format(datetime.datetime.now().strftime("%Y%m%d-%H%M%S"), os.getpid())
+# Во сколько раз этап должен замедлиться относительно медианы прошлых запусков, чтобы считаться регрессией
+EVENT_REGRESSION_RATIO = 1.5
+event_log_lock = threading.Lock()
+# События дочернего процесса пула: накапливаются и возвращаются родительскому процессу (None - запись в файл)
+worker_events = None
+
+def write_event(event):
+    """Дописывает событие одной строкой JSON в журнал событий EVENT_LOG_FILE"""
+    if not EVENT_LOG_ENABLED:
+        return
+    event.setdefault("time", datetime.datetime.now().isoformat())
+    event.setdefault("pid", os.getpid())
+    if worker_events is not None:
+        worker_events.append(event)
+        return
+    event.setdefault("run_id", RUN_ID)
+    try:
+        line = to_text(json.dumps(event, ensure_ascii=False, default=to_text))
+        with event_log_lock:
+            with io.open(EVENT_LOG_FILE, "a", encoding="utf-8") as event_file:
+                event_file.write(line + u"\n")
+    except Exception as e:
+        logging.warning("Не удалось записать событие в журнал событий: {}".format(str(e)))
+
+@contextlib.contextmanager
+def track_stage(stage, inputs=None, output=None, **details):
+    """Замеряет этап обработки и записывает его в журнал событий
+    
+    Внутри блока with можно дополнить словарь событий, например
+    stage_event["counts"]["output"] = количество объектов результата.
+    
+    Args:
+        stage (str): имя этапа ("clip_land", "identity", ...)
+        inputs (list): пути входных классов объектов
+        output (str): путь выходного класса объектов
+        details: дополнительные поля события (способ обработки, тайлинг и т.д.)
+    """
+    event = {
+        "event": "stage",
+        "stage": stage,
+        "inputs": [to_text(path) for path in (inputs or [])],
+        "output": to_text(output) if output else None,
+        "counts": {},
+        "status": "ok"
+    }
+    event.update(details)
+    start_time = time.time()
+    scratch_bytes = ScratchManager.released_bytes
+    try:
+        yield event
+    except Exception as e:
+        event["status"] = "error"
+        event["error"] = to_text(e)
+        raise
+    finally:
+        event["duration"] = round(time.time() - start_time, 3)
+        if ScratchManager.released_bytes > scratch_bytes:
+            # Оценка объема временных классов, созданных и освобожденных внутри этапа
+            event["scratch_bytes"] = ScratchManager.released_bytes - scratch_bytes
+        if ARCPY_AVAILABLE:
+            try:
+                # Сообщения последнего выполненного в этапе инструмента
+                event["arcpy_messages"] = to_text(arcpy.GetMessages())[-2000:]
+            except Exception:
+                pass
+        write_event(event)
+
+def read_events(path=None):
+    """Читает журнал событий; поврежденные строки пропускаются"""
+    path = path or EVENT_LOG_FILE
+    events = []
+    if not os.path.exists(path):
+        return events
+    with io.open(path, "r", encoding="utf-8") as event_file:
+        for line in event_file:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                continue
+    return events
+
+def median_value(values):
+    """Медиана непустого списка чисел"""
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+def stage_cost(event):
+    """Стоимость этапа для сравнения между запусками: секунды на 1000 входных объектов,
+    если число входных объектов известно, иначе секунды"""
+    input_count = event.get("counts", {}).get("input")
+    if input_count:
+        return event["duration"] * 1000.0 / input_count
+    return event["duration"]
+
+def analyze_events(path=None, top=10, regression_ratio=None):
+    """Сводка журнала событий по всем запускам: самые медленные этапы и регрессии
+    
+    Регрессией считается запуск, в котором стоимость этапа (stage_cost) превысила медиану
+    предыдущих запусков в regression_ratio раз.
+    
+    Returns:
+        tuple: (сводка по этапам, список регрессий)
+    """
+    regression_ratio = regression_ratio or EVENT_REGRESSION_RATIO
+    events = [event for event in read_events(path)
+              if event.get("event") == "stage" and event.get("status") == "ok" and event.get("duration") is not None]
+    if not events:
+        print("Журнал событий пуст: {}".format(path or EVENT_LOG_FILE))
+        return [], []
+    
+    stages = {}
+    for event in events:
+        stages.setdefault(event["stage"], []).append(event)
+    
+    summary = []
+    regressions = []
+    for stage, stage_events in stages.items():
+        durations = [event["duration"] for event in stage_events]
+        summary.append({
+            "stage": stage,
+            "runs": len(set(event.get("run_id") for event in stage_events)),
+            "calls": len(stage_events),
+            "total": sum(durations),
+            "median": median_value(durations),
+            "max": max(durations)
+        })
+        
+        # Стоимость этапа в каждом запуске в порядке запусков
+        run_ids = []
+        run_costs = {}
+        for event in stage_events:
+            run_id = event.get("run_id")
+            if run_id not in run_costs:
+                run_ids.append(run_id)
+                run_costs[run_id] = 0.0
+            run_costs[run_id] += stage_cost(event)
+        for index in range(3, len(run_ids)):
+            baseline = median_value([run_costs[run_id] for run_id in run_ids[max(0, index - 20):index]])
+            current = run_costs[run_ids[index]]
+            if baseline > 0 and current > baseline * regression_ratio:
+                regressions.append({"stage": stage, "run_id": run_ids[index],
+                                    "cost": current, "baseline": baseline})
+    
+    summary.sort(key=lambda item: item["total"], reverse=True)
+    print("Событий: {}, запусков: {}".format(len(events), len(set(event.get("run_id") for event in events))))
+    print(u"{:<24} {:>6} {:>7} {:>10} {:>10} {:>10}".format(u"Этап", u"Запуск", u"Вызовы", u"Всего, с", u"Медиана", u"Макс."))
+    for item in summary[:top]:
+        print(u"{:<24} {:>6} {:>7} {:>10.1f} {:>10.2f} {:>10.2f}".format(
+            item["stage"], item["runs"], item["calls"], item["total"], item["median"], item["max"]))
+    if regressions:
+        print("Регрессии (стоимость выше медианы прошлых запусков в {} раза):".format(regression_ratio))
+        for item in regressions:
+            print("  {} в запуске {}: {:.2f} при медиане {:.2f}".format(
+                item["stage"], item["run_id"], item["cost"], item["baseline"]))
+    else:
+        print("Регрессий не обнаружено")
+    
+    placements = [event for event in read_events(path) if event.get("event") == "scratch_placement"]
+    if placements:
+        spilled = [event for event in placements if event.get("workspace") == "scratch_gdb"]
+        print("Временные классы: {}, вынесено во временную GDB: {}".format(len(placements), len(spilled)))
+    
+    index_events = [event for event in events if event["stage"] == "index" and "net_seconds" in event]
+    if index_events:
+        print("Индексы: построение {:.1f} с, типовые запросы {:.2f} -> {:.2f} с, чистый выигрыш {:.1f} с".format(
+            sum(event["build_seconds"] for event in index_events),
+            sum(event["query_seconds_before"] for event in index_events),
+            sum(event["query_seconds_after"] for event in index_events),
+            sum(event["net_seconds"] for event in index_events)))
+    return summary, regressions
+
+# Проверенные базы данных: {путь: (время изменения, является ли рабочим пространством)}
+validated_workspaces = {}
+validated_workspaces_lock = threading.Lock()
+
+def describe_workspace(path):
+    """Проверяет через arcpy.Describe, что путь - база данных (рабочее пространство).
+    Результат кэшируется, пока не изменится время изменения пути.
+    
+    Returns:
+        tuple: (является ли рабочим пространством, текст ошибки или None)
+    """
+    key = os.path.normcase(os.path.abspath(path))
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        mtime = None
+    with validated_workspaces_lock:
+        cached = validated_workspaces.get(key)
+    if cached and cached[0] == mtime:
+        logging.debug("Проверка базы данных взята из кэша: %s", path)
+        return cached[1], None
+    
+    try:
+        is_workspace = arcpy.Describe(path).dataType == "Workspace"
+    except arcpy.ExecuteError:
+        return False, arcpy.GetMessages(2)
+    except Exception as e:
+        return False, str(e)
+    with validated_workspaces_lock:
+        validated_workspaces[key] = (mtime, is_workspace)
+    return is_workspace, None
+
+class WorkspaceValidator:
+    """Проверка базы данных для окон выбора в фоновом потоке.
+    
+    describe_workspace выполняется в отдельном потоке, а окно опрашивает результат через after()
+    и показывает индикатор выполнения, поэтому проверка пути на сетевом диске не блокирует окно.
+    Пока идет проверка, кнопки buttons (в том числе "Отмена"), клавиша Enter и закрытие окна
+    отключены, а при уничтожении окна ожидающий опрос отменяется.
+    """
+    poll_interval = 100
+    
+    def __init__(self, master, parent_frame, buttons):
+        self.master = master
+        self.buttons = buttons
+        self.progress = ttk.Progressbar(parent_frame, mode="indeterminate")
+        self.progress.bind("<Destroy>", self.on_destroy)
+        self.results = queue.Queue()
+        self.callback = None
+        self.after_id = None
+        self.return_binding = None
+    
+    def start(self, path, callback):
+        """Запускает проверку path; callback(является ли рабочим пространством, текст ошибки)
+        вызывается в потоке Tk"""
+        self.callback = callback
+        for button in self.buttons:
+            button.config(state=tk.DISABLED)
+        self.return_binding = self.master.bind("<Return>")
+        self.master.bind("<Return>", lambda event: "break")
+        self.master.protocol("WM_DELETE_WINDOW", lambda: None)
+        self.progress.pack(fill=tk.X, pady=5)
+        self.progress.start(10)
+        
+        worker = threading.Thread(target=self.run, args=(path,))
+        worker.daemon = True
+        worker.start()
+        self.after_id = self.master.after(self.poll_interval, self.poll)
+    
+    def on_destroy(self, event=None):
+        if self.after_id is not None:
+            self.master.after_cancel(self.after_id)
+            self.after_id = None
+    
+    def run(self, path):
+        try:
+            result = describe_workspace(path)
+        except Exception as e:
+            result = (False, str(e))
+        self.results.put(result)
+    
+    def poll(self):
+        self.after_id = None
+        try:
+            is_workspace, error = self.results.get_nowait()
+        except queue.Empty:
+            self.after_id = self.master.after(self.poll_interval, self.poll)
+            return
+        
+        self.progress.stop()
+        self.progress.pack_forget()
+        for button in self.buttons:
+            button.config(state=tk.NORMAL)
+        if self.return_binding:
+            self.master.bind("<Return>", self.return_binding)
+        else:
+            self.master.unbind("<Return>")
+        self.master.protocol("WM_DELETE_WINDOW", self.master.destroy)
+        self.callback(is_workspace, error)
+
+class SearchIndex:
+    """Индекс строк списка для поиска по мере ввода.
+    
+    Запрос короче трех символов ищется по началу слов (бинарный поиск в отсортированном
+    списке слов), более длинный - как подстрока: кандидаты берутся пересечением множеств
+    строк по триграммам запроса и проверяются вхождением подстроки. Регистр не учитывается.
+    """
+    word_separators = re.compile(r"[\s_\-.,;:\"'()]+")
+    
+    def __init__(self, texts):
+        self.texts = [to_text(text).lower() for text in texts]
+        self.words = []
+        self.trigrams = collections.defaultdict(set)
+        for index, text in enumerate(self.texts):
+            for word in set(self.word_separators.split(text)):
+                if word:
+                    self.words.append((word, index))
+            for position in range(len(text) - 2):
+                self.trigrams[text[position:position + 3]].add(index)
+        self.words.sort()
+        self.word_keys = [word for word, _ in self.words]
+    
+    def search(self, query):
+        """Номера строк, подходящих под запрос, в исходном порядке"""
+        query = to_text(query).strip().lower()
+        if not query:
+            return list(range(len(self.texts)))
+        if len(query) < 3:
+            found = set()
+            for position in range(bisect.bisect_left(self.word_keys, query), len(self.words)):
+                word, index = self.words[position]
+                if not word.startswith(query):
+                    break
+                found.add(index)
+            return sorted(found)
+        
+        candidates = sorted((self.trigrams.get(query[position:position + 3], set())
+                             for position in range(len(query) - 2)), key=len)
+        return sorted(index for index in set.intersection(*candidates) if query in self.texts[index])
+
+class VirtualList(tk.Frame):
+    """Список с поиском по мере ввода для больших наборов строк.
+    
+    В tk.Listbox находятся только видимые строки: полоса прокрутки, колесо мыши и клавиши
+    сдвигают окно по отфильтрованному списку, поэтому окно открывается сразу при любом
+    числе строк. Выбор хранится по номерам исходных строк и не сбрасывается при смене фильтра.
+    """
+    def __init__(self, master, items=(), labels=None, selectmode=tk.SINGLE, height=15, font=("Arial", 10),
+                 width=None, **kwargs):
+        tk.Frame.__init__(self, master, **kwargs)
+        self.selectmode = selectmode
+        self.rows = height
+        
+        # Строка поиска
+        self.search_frame = tk.Frame(self)
+        self.search_frame.pack(fill=tk.X)
+        tk.Label(self.search_frame, text="Поиск:", font=("Arial", 9)).pack(side=tk.LEFT)
+        self.query = tk.StringVar()
+        self.entry = tk.Entry(self.search_frame, textvariable=self.query)
+        self.entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        self.count_label = tk.Label(self.search_frame, font=("Arial", 9), fg="gray")
+        self.count_label.pack(side=tk.RIGHT)
+        self.entry.bind('<KeyRelease>', self.on_query)
+        
+        # Список видимых строк
+        self.list_frame = tk.Frame(self)
+        self.list_frame.pack(fill=tk.BOTH, expand=True, pady=5)
+        self.scrollbar = tk.Scrollbar(self.list_frame, command=self.scroll)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.listbox = tk.Listbox(self.list_frame,
+                                  font=font,
+                                  height=height,
+                                  selectmode=selectmode,
+                                  exportselection=False)
+        if width:
+            # Ширина в символах, чтобы длинные названия не обрезались
+            self.listbox.config(width=width)
+        self.listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        
+        self.listbox.bind('<<ListboxSelect>>', self.on_select)
+        self.listbox.bind('<MouseWheel>', self.on_wheel)
+        self.listbox.bind('<Button-4>', self.on_wheel)
+        self.listbox.bind('<Button-5>', self.on_wheel)
+        self.listbox.bind('<Up>', lambda event: self.move_cursor(-1))
+        self.listbox.bind('<Down>', lambda event: self.move_cursor(1))
+        self.listbox.bind('<Prior>', lambda event: self.move_cursor(-self.rows))
+        self.listbox.bind('<Next>', lambda event: self.move_cursor(self.rows))
+        self.entry.bind('<Down>', lambda event: self.listbox.focus_set())
+        
+        self.set_items(items, labels)
+    
+    def set_items(self, items, labels=None):
+        """Заменяет строки списка; labels - отображаемый текст строк (по умолчанию сами строки)"""
+        self.items = list(items)
+        self.labels = [to_text(label) for label in (labels if labels is not None else self.items)]
+        self.index = SearchIndex(self.labels)
+        self.selected = set()
+        self.query.set("")
+        self.visible = list(range(len(self.items)))
+        self.offset = 0
+        self.cursor = 0
+        self.render()
+    
+    def selection(self):
+        """Выбранные строки в исходном порядке"""
+        return [self.items[index] for index in sorted(self.selected)]
+    
+    def select(self, items):
+        """Отмечает строки items как выбранные"""
+        wanted = set(items)
+        self.selected.update(index for index, item in enumerate(self.items) if item in wanted)
+        self.render()
+    
+    def focus_search(self):
+        self.entry.focus_set()
+    
+    def on_query(self, event=None):
+        if event is not None and event.keysym in ("Return", "Down", "Up"):
+            return
+        self.visible = self.index.search(self.query.get())
+        self.offset = 0
+        self.cursor = 0
+        # При одиночном выборе первая найденная строка выбирается сразу (Enter подтверждает ее);
+        # если ничего не найдено, выбор снимается, чтобы Enter не подтвердил скрытую строку
+        if self.selectmode == tk.SINGLE and not self.visible:
+            self.selected = set()
+        elif self.selectmode == tk.SINGLE and not self.selected.intersection(self.visible):
+            self.selected = set([self.visible[0]])
+        self.render()
+    
+    def render(self):
+        total = len(self.visible)
+        self.offset = max(0, min(self.offset, total - self.rows))
+        window = self.visible[self.offset:self.offset + self.rows]
+        self.listbox.delete(0, tk.END)
+        for row, index in enumerate(window):
+            self.listbox.insert(tk.END, self.labels[index])
+            if index in self.selected:
+                self.listbox.selection_set(row)
+        if window and self.offset <= self.cursor < self.offset + len(window):
+            self.listbox.activate(self.cursor - self.offset)
+        if total:
+            self.scrollbar.set(self.offset / float(total), (self.offset + len(window)) / float(total))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+        self.count_label.config(text="{} из {}".format(total, len(self.items)))
+    
+    def scroll(self, *args):
+        """Команда полосы прокрутки: ("moveto", доля) или ("scroll", шаг, "units"/"pages")"""
+        if args[0] == "moveto":
+            self.offset = int(float(args[1]) * len(self.visible))
+        elif args[0] == "scroll":
+            self.offset += int(args[1]) * (self.rows if args[2] == "pages" else 1)
+        self.render()
+    
+    def on_wheel(self, event):
+        if getattr(event, "num", None) == 4 or getattr(event, "delta", 0) > 0:
+            self.scroll("scroll", -3, "units")
+        else:
+            self.scroll("scroll", 3, "units")
+        return "break"
+    
+    def on_select(self, event=None):
+        window = self.visible[self.offset:self.offset + self.rows]
+        chosen = set(window[int(row)] for row in self.listbox.curselection())
+        if self.selectmode == tk.SINGLE:
+            if chosen:
+                self.selected = chosen
+        else:
+            self.selected = (self.selected - set(window)) | chosen
+        active = self.listbox.index(tk.ACTIVE)
+        if 0 <= active < len(window):
+            self.cursor = self.offset + active
+    
+    def move_cursor(self, step):
+        """Перемещение по списку клавишами с прокруткой окна за пределы видимых строк"""
+        if not self.visible:
+            return "break"
+        self.cursor = max(0, min(self.cursor + step, len(self.visible) - 1))
+        if self.cursor < self.offset:
+            self.offset = self.cursor
+        elif self.cursor >= self.offset + self.rows:
+            self.offset = self.cursor - self.rows + 1
+        if self.selectmode == tk.SINGLE:
+            self.selected = set([self.visible[self.cursor]])
+        self.render()
+        return "break"
+
 class GDBSelector:
     def __init__(self, master):
         self.master = master
@@ -132,7 +950,7 @@ class GDBSelector:
         
         # Настройка окна
         master.title("Выбор базы геоданных")
-        master.geometry("500x200")
+        master.geometry("500x230")
         
         # Фрейм для содержимого
         self.main_frame = tk.Frame(master, padx=20, pady=20)
@@ -177,6 +995,10 @@ class GDBSelector:
                                      text="Отмена", 
                                      command=master.destroy)
         self.cancel_button.pack(side=tk.LEFT, padx=5)
+        
+        # Проверка выбранной базы в фоновом потоке
+        self.validator = WorkspaceValidator(master, self.main_frame,
+                                            [self.browse_button, self.select_button, self.cancel_button])
     
     def browse_gdb(self):
         # Открыть диалог выбора файла с явным указанием родительского окна
@@ -216,24 +1038,9 @@ class GDBSelector:
             messagebox.showerror("Ошибка", "Путь не указывает на файл с расширением .gdb")
             return
             
-        # Расширенная проверка с arcpy, если доступен
+        # Расширенная проверка с arcpy, если доступен (в фоновом потоке, окно остается отзывчивым)
         if ARCPY_AVAILABLE:
-            try:
-                # Проверка валидности базы геоданных
-                desc = arcpy.Describe(path)
-                if desc.dataType == "Workspace":
-                    self.gdb_path = path
-                    messagebox.showinfo("Успех", "База геоданных выбрана: {}".format(path))
-                    self.master.destroy()
-                else:
-                    messagebox.showerror("Ошибка", "Выбранный путь не является базой геоданных")
-                    return
-            except arcpy.ExecuteError:
-                messagebox.showerror("Ошибка ArcPy", arcpy.GetMessages(2))
-                return
-            except Exception as e:
-                messagebox.showerror("Ошибка", str(e))
-                return
+            self.validator.start(path, lambda is_workspace, error: self.on_validated(path, is_workspace, error))
         else:
             # Упрощенная проверка, если arcpy недоступен
             # Проверяем наличие структуры GDB (базовая проверка)
@@ -258,6 +1065,17 @@ class GDBSelector:
                 if messagebox.askyesno("Подтверждение", "Хотите всё равно использовать этот путь?"):
                     self.gdb_path = path
                     self.master.destroy()
+    
+    def on_validated(self, path, is_workspace, error):
+        """Завершение фоновой проверки базы геоданных"""
+        if error:
+            messagebox.showerror("Ошибка", error)
+        elif is_workspace:
+            self.gdb_path = path
+            messagebox.showinfo("Успех", "База геоданных выбрана: {}".format(path))
+            self.master.destroy()
+        else:
+            messagebox.showerror("Ошибка", "Выбранный путь не является базой геоданных")
 
 class OldForestGDBSelector:
     def __init__(self, master):
@@ -267,7 +1085,7 @@ class OldForestGDBSelector:
         
         # Настройка окна
         master.title("Выбор базы данных прошлого тура")
-        master.geometry("500x200")
+        master.geometry("500x230")
         
         # Фрейм для содержимого
         self.main_frame = tk.Frame(master, padx=20, pady=20)
@@ -312,6 +1130,10 @@ class OldForestGDBSelector:
                                      text="Отмена", 
                                      command=master.destroy)
         self.cancel_button.pack(side=tk.LEFT, padx=5)
+        
+        # Проверка выбранной базы в фоновом потоке
+        self.validator = WorkspaceValidator(master, self.main_frame,
+                                            [self.browse_button, self.select_button, self.cancel_button])
     
     def browse_db(self):
         # Открыть диалог выбора файла или каталога
@@ -373,64 +1195,1339 @@ class OldForestGDBSelector:
             messagebox.showerror("Ошибка", "Путь не указывает на файл с расширением .gdb или .mdb")
             return
             
-        # Расширенная проверка с arcpy, если доступен
+        # Расширенная проверка с arcpy, если доступен (в фоновом потоке, окно остается отзывчивым)
         if ARCPY_AVAILABLE:
-            try:
-                # Проверка валидности базы данных
-                desc = arcpy.Describe(path)
-                if desc.dataType == "Workspace":
-                    self.db_path = path
-                    messagebox.showinfo("Успех", "База данных выбрана: {}".format(path))
-                    self.master.destroy()
-                else:
-                    messagebox.showerror("Ошибка", "Выбранный путь не является базой данных")
-                    return
-            except arcpy.ExecuteError:
-                messagebox.showerror("Ошибка ArcPy", arcpy.GetMessages(2))
-                return
-            except Exception as e:
-                messagebox.showerror("Ошибка", str(e))
-                return
+            self.validator.start(path, lambda is_workspace, error: self.on_validated(path, is_workspace, error))
         else:
             # Упрощенная проверка, если arcpy недоступен
             messagebox.showinfo("Внимание", "Без модуля arcpy невозможно полностью проверить корректность базы данных.")
             self.db_path = path
             self.master.destroy()
+    
+    def on_validated(self, path, is_workspace, error):
+        """Завершение фоновой проверки базы данных прошлого тура"""
+        if error:
+            messagebox.showerror("Ошибка", error)
+        elif is_workspace:
+            self.db_path = path
+            messagebox.showinfo("Успех", "База данных выбрана: {}".format(path))
+            self.master.destroy()
+        else:
+            messagebox.showerror("Ошибка", "Выбранный путь не является базой данных")
 
-class LabelClassProcessor:
-    def __init__(self, db_path, shortened_name):
-        self.db_path = db_path
-        self.shortened_name = shortened_name
-        self.labels_classes = []
-        self.is_mdb = os.path.isfile(db_path) and os.path.basename(db_path).lower().endswith('.mdb')
-        # Добавляем свойство для хранения пути к GDB
-        self.gdb_path = None  # Будет установлено при вызове process_identity
+def estimate_feature_bytes(fc, sample_size=200):
+    """Оценка объема класса объектов в байтах: число объектов, умноженное на средний
+    размер первых sample_size строк (8 байт на координату вершины и на атрибутивное поле)"""
+    count = int(arcpy.GetCount_management(fc).getOutput(0))
+    if count == 0:
+        return 0
+    desc = arcpy.Describe(fc)
+    coordinate_count = 2 + (1 if desc.hasZ else 0) + (1 if desc.hasM else 0)
+    field_count = len([f for f in desc.fields if f.type != "Geometry"])
+    point_count = 0
+    sampled = 0
+    with arcpy.da.SearchCursor(fc, ["SHAPE@"]) as cursor:
+        for (shape,) in cursor:
+            point_count += shape.pointCount if shape is not None else 0
+            sampled += 1
+            if sampled >= sample_size:
+                break
+    mean_points = point_count / float(max(sampled, 1))
+    return int(count * (mean_points * coordinate_count + field_count) * 8)
+
+class ScratchManager:
+    """Временные классы и слои этапа обработки с уникальными именами.
     
-    def find_label_classes(self):
-        """Поиск классов с 'надпис' и цифрой в имени"""
-        if not ARCPY_AVAILABLE:
-            logging.error("Модуль arcpy недоступен")
-            messagebox.showerror("Ошибка", "Модуль arcpy не доступен для поиска классов")
-            return False, "Модуль arcpy недоступен"
+    Имена строятся как <основа>_<процесс>_<номер>, поэтому этапы и параллельные задания
+    не затирают временные данные друг друга. release удаляет только объекты, выданные
+    этим менеджером (вместо очистки всего in_memory), и учитывает их объем, оцененный
+    при выдаче по входным классам.
+    Используется как контекстный менеджер: все объекты освобождаются при выходе из блока.
+    """
+    lock = threading.Lock()
+    sequence = 0
+    scratch_gdb = None
+    # Оценка объема всех освобожденных за процесс временных классов, байт
+    released_bytes = 0
+    # Оценка объема временных классов, размещенных в памяти в режиме "auto" и еще не освобожденных, байт
+    memory_bytes = 0
+    # Оценки объема входных классов за задание: {путь к данным: байт}; Land и классы надписей
+    # оцениваются один раз, а не для каждого листа и тайла (сбрасывается reset_estimates).
+    # Временные слои оцениваются по классу, на котором они построены
+    source_estimates = {}
+    
+    def __init__(self, stage=None, workspace=None):
+        self.stage = stage
+        self.workspace_kind = workspace or SCRATCH_WORKSPACE
+        self.datasets = []
+        self.layers = []
+        self.allocated_bytes = 0
+        # {путь временного класса: оценка объема при выдаче}
+        self.dataset_estimates = {}
+        # {путь временного класса в памяти: оценка объема}, учитывается в memory_bytes
+        self.memory_estimates = {}
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        try:
+            self.release()
+        except Exception as e:
+            logging.warning("Не удалось освободить временные данные этапа {}: {}".format(self.stage, str(e)))
+        return False
+    
+    @classmethod
+    def unique_name(cls, base):
+        """Имя, уникальное в пределах всех процессов, работающих с общими временными данными"""
+        with cls.lock:
+            cls.sequence += 1
+            return "{}_{}_{}".format(base, os.getpid(), cls.sequence)
+    
+    def workspace(self, kind=None):
+        """Рабочее пространство временных классов (временная GDB создается один раз на процесс)"""
+        kind = kind or self.workspace_kind
+        if kind != "scratch_gdb":
+            return kind
+        with ScratchManager.lock:
+            if ScratchManager.scratch_gdb is None or not arcpy.Exists(ScratchManager.scratch_gdb):
+                scratch_root = tempfile.mkdtemp(prefix="select_gdb_scratch_", dir=arcpy.env.scratchFolder or None)
+                arcpy.CreateFileGDB_management(scratch_root, "scratch.gdb")
+                ScratchManager.scratch_gdb = os.path.join(scratch_root, "scratch.gdb")
+                atexit.register(shutil.rmtree, scratch_root, True)
+            return ScratchManager.scratch_gdb
+    
+    @classmethod
+    def reset_estimates(cls):
+        """Сбрасывает оценки объема входных классов в начале нового задания"""
+        with cls.lock:
+            cls.source_estimates = {}
+    
+    @classmethod
+    def forget_estimate(cls, fc):
+        """Сбрасывает оценку объема класса fc, данные которого изменились (результат Identity)"""
+        with cls.lock:
+            cls.source_estimates.pop(to_text(fc), None)
+    
+    @staticmethod
+    def source_path(fc):
+        """Путь к данным входного класса: для слоя - класс, на котором он построен"""
+        try:
+            desc = arcpy.Describe(fc)
+            if getattr(desc, "dataType", None) == "FeatureLayer":
+                return desc.catalogPath
+        except Exception as e:
+            logging.debug("Не удалось определить источник %s: %s", fc, e)
+        return fc
+    
+    @classmethod
+    def estimate_sources(cls, sources, factor=1.0):
+        """Оценка объема временного класса: объем входных классов sources
+        (число объектов и вершин), умноженный на factor, байт.
+        Объем каждого входного класса оценивается один раз за задание; слой с отбором
+        (лист надписей в охвате, тайл) оценивается сверху объемом всего исходного класса"""
+        estimate = 0
+        for fc in sources or []:
+            with cls.lock:
+                fc_bytes = cls.source_estimates.get(to_text(fc))
+            if fc_bytes is None:
+                path = cls.source_path(fc)
+                with cls.lock:
+                    fc_bytes = cls.source_estimates.get(to_text(path))
+                if fc_bytes is None:
+                    try:
+                        fc_bytes = estimate_feature_bytes(path)
+                    except Exception as e:
+                        logging.debug("Не удалось оценить объем %s: %s", path, e)
+                        fc_bytes = 0
+                    with cls.lock:
+                        cls.source_estimates[to_text(path)] = fc_bytes
+            estimate += fc_bytes
+        return int(estimate * factor)
+    
+    def choose_workspace(self, base, estimate):
+        """Выбирает размещение временного класса с оценкой объема estimate в режиме "auto"
+        
+        Класс остается в памяти, если вместе с уже размещенными в памяти классами он укладывается
+        в SCRATCH_MEMORY_BUDGET_MB; решение записывается в журнал событий.
+        
+        Returns:
+            str: рабочее пространство
+        """
+        budget = int(SCRATCH_MEMORY_BUDGET_MB * 1048576)
+        with ScratchManager.lock:
+            in_memory = ScratchManager.memory_bytes + estimate <= budget
+            if in_memory:
+                ScratchManager.memory_bytes += estimate
+            memory_bytes = ScratchManager.memory_bytes
+        kind = SCRATCH_MEMORY_WORKSPACE if in_memory else "scratch_gdb"
+        
+        if not in_memory:
+            logging.info("Временный класс {} (около {:.1f} МБ) не помещается в бюджет памяти {} МБ, "
+                         "создается во временной GDB".format(base, estimate / 1048576.0, SCRATCH_MEMORY_BUDGET_MB))
+        write_event({"event": "scratch_placement", "stage": self.stage, "name": base, "workspace": kind,
+                     "estimate_bytes": estimate, "memory_bytes": memory_bytes, "budget_bytes": budget})
+        return kind
+    
+    def dataset(self, base, sources=None, factor=1.0):
+        """Путь нового временного класса объектов
+        
+        Объем класса оценивается один раз по sources и factor (estimate_sources): в режиме "auto"
+        по нему выбирается размещение (choose_workspace), а release учитывает его при удалении
+        """
+        kind = self.workspace_kind
+        estimate = self.estimate_sources(sources, factor) if sources else 0
+        if kind == "auto":
+            kind = self.choose_workspace(base, estimate)
+        path = os.path.join(self.workspace(kind), self.unique_name(base))
+        self.datasets.append(path)
+        self.dataset_estimates[path] = estimate
+        if self.workspace_kind == "auto" and kind != "scratch_gdb":
+            self.memory_estimates[path] = estimate
+        return path
+    
+    def layer(self, base):
+        """Имя нового временного слоя"""
+        name = self.unique_name(base)
+        self.layers.append(name)
+        return name
+    
+    def release(self):
+        """Удаляет все выданные слои и классы; возвращает оценку освобожденного объема в байтах"""
+        released_bytes = 0
+        released_count = 0
+        for layer in self.layers:
+            if arcpy.Exists(layer):
+                arcpy.Delete_management(layer)
+        for path in self.datasets:
+            if arcpy.Exists(path):
+                released_bytes += self.dataset_estimates.get(path, 0)
+                arcpy.Delete_management(path)
+                released_count += 1
+        self.layers = []
+        self.datasets = []
+        self.dataset_estimates = {}
+        
+        self.allocated_bytes += released_bytes
+        with ScratchManager.lock:
+            ScratchManager.released_bytes += released_bytes
+            ScratchManager.memory_bytes -= sum(self.memory_estimates.values())
+        self.memory_estimates = {}
+        if released_count:
+            logging.debug("Этап %s: освобождено временных классов %s, около %.1f МБ",
+                          self.stage, released_count, released_bytes / 1048576.0)
+        return released_bytes
+
+def expand_extent(extent, margin):
+    """Расширяет охват (xmin, ymin, xmax, ymax) на margin во все стороны"""
+    xmin, ymin, xmax, ymax = extent
+    return (xmin - margin, ymin - margin, xmax + margin, ymax + margin)
+
+def merge_extents(first, second):
+    """Объединяет два охвата; None означает пустой охват"""
+    if first is None:
+        return second
+    if second is None:
+        return first
+    return (min(first[0], second[0]), min(first[1], second[1]),
+            max(first[2], second[2]), max(first[3], second[3]))
+
+def extents_intersect(first, second):
+    """Проверяет пересечение двух охватов (xmin, ymin, xmax, ymax)"""
+    return (first[0] <= second[2] and second[0] <= first[2] and
+            first[1] <= second[3] and second[1] <= first[3])
+
+def build_oid_where_clause(oid_field, oids):
+    """Строит SQL-выражение для списка OBJECTID, сжимая подряд идущие номера в диапазоны"""
+    ranges = []
+    for oid in sorted(oids):
+        if ranges and oid == ranges[-1][1] + 1:
+            ranges[-1][1] = oid
+        else:
+            ranges.append([oid, oid])
+    
+    single = [str(start) for start, end in ranges if start == end]
+    clauses = ["{} BETWEEN {} AND {}".format(oid_field, start, end) for start, end in ranges if start != end]
+    if single:
+        clauses.append("{} IN ({})".format(oid_field, ",".join(single)))
+    return " OR ".join(clauses) if clauses else "1 = 0"
+
+class GridIndex:
+    """Пространственный индекс на регулярной сетке ячеек для быстрого отбора кандидатов по охвату"""
+    def __init__(self, cell_size):
+        self.cell_size = float(cell_size) if cell_size and cell_size > 0 else 1.0
+        self.items = []
+        self.cells = {}
+    
+    def __len__(self):
+        return len(self.items)
+    
+    def cell_range(self, extent):
+        xmin, ymin, xmax, ymax = extent
+        return (int(math.floor(xmin / self.cell_size)), int(math.floor(ymin / self.cell_size)),
+                int(math.floor(xmax / self.cell_size)), int(math.floor(ymax / self.cell_size)))
+    
+    def insert(self, item, extent):
+        """Добавляет объект с охватом (xmin, ymin, xmax, ymax)"""
+        item_id = len(self.items)
+        self.items.append((item, extent))
+        col_min, row_min, col_max, row_max = self.cell_range(extent)
+        for col in range(col_min, col_max + 1):
+            for row in range(row_min, row_max + 1):
+                self.cells.setdefault((col, row), []).append(item_id)
+    
+    def query(self, extent):
+        """Возвращает объекты, охват которых пересекает extent, в порядке добавления"""
+        col_min, row_min, col_max, row_max = self.cell_range(extent)
+        item_ids = set()
+        if (col_max - col_min + 1) * (row_max - row_min + 1) > len(self.cells):
+            # Охват запроса больше заполненной части индекса - перебираем только непустые ячейки
+            for (col, row), cell_items in self.cells.items():
+                if col_min <= col <= col_max and row_min <= row <= row_max:
+                    item_ids.update(cell_items)
+        else:
+            for col in range(col_min, col_max + 1):
+                for row in range(row_min, row_max + 1):
+                    item_ids.update(self.cells.get((col, row), ()))
+        return [self.items[i][0] for i in sorted(item_ids) if extents_intersect(self.items[i][1], extent)]
+
+def grid_cell_size(extent, item_count):
+    """Размер ячейки индекса, при котором на ячейку приходится в среднем несколько объектов"""
+    width = extent[2] - extent[0]
+    height = extent[3] - extent[1]
+    if item_count <= 0 or width <= 0 or height <= 0:
+        return max(width, height, 1.0)
+    return max(math.sqrt(width * height / item_count) * 2.0, 1e-6)
+
+def extent_polygon(extent, spatial_reference=None):
+    """Создает полигон arcpy по охвату (xmin, ymin, xmax, ymax)"""
+    xmin, ymin, xmax, ymax = extent
+    points = arcpy.Array([arcpy.Point(xmin, ymin), arcpy.Point(xmin, ymax),
+                          arcpy.Point(xmax, ymax), arcpy.Point(xmax, ymin),
+                          arcpy.Point(xmin, ymin)])
+    return arcpy.Polygon(points, spatial_reference)
+
+class TileGrid:
+    """Регулярная сетка тайлов поверх охвата (xmin, ymin, xmax, ymax)"""
+    def __init__(self, extent, tile_size, overlap=0.0):
+        self.xmin, self.ymin, self.xmax, self.ymax = [float(value) for value in extent]
+        self.tile_size = float(tile_size) if tile_size and tile_size > 0 else 1.0
+        self.overlap = float(overlap)
+        self.cols = max(1, int(math.ceil((self.xmax - self.xmin) / self.tile_size)))
+        self.rows = max(1, int(math.ceil((self.ymax - self.ymin) / self.tile_size)))
+    
+    def tiles(self):
+        """Индексы тайлов (строка, столбец) в детерминированном порядке обхода"""
+        return [(row, col) for row in range(self.rows) for col in range(self.cols)]
+    
+    def core_extent(self, tile):
+        """Ядро тайла - непересекающаяся с соседями часть сетки"""
+        row, col = tile
+        xmin = self.xmin + col * self.tile_size
+        ymin = self.ymin + row * self.tile_size
+        return (xmin, ymin, min(xmin + self.tile_size, self.xmax), min(ymin + self.tile_size, self.ymax))
+    
+    def locate(self, x, y):
+        """Возвращает тайл-владелец точки; точки за пределами сетки прижимаются к крайним тайлам"""
+        if x is None or y is None:
+            return (0, 0)
+        col = int(math.floor((x - self.xmin) / self.tile_size))
+        row = int(math.floor((y - self.ymin) / self.tile_size))
+        return (min(max(row, 0), self.rows - 1), min(max(col, 0), self.cols - 1))
+
+class TiledProcessor:
+    """Обработка крупных слоев по тайлам с ограниченным потреблением памяти.
+    
+    Каждый объект входного слоя принадлежит ровно одному тайлу - тому, в ядро которого
+    попадает его центроид. Геометрия на границах тайлов не режется: тайл обрабатывает
+    свои объекты целиком, а вырезающие объекты отбираются по охвату объектов тайла
+    с запасом TILE_OVERLAP_METERS. Поэтому результат Clip/Identity для тайла совпадает
+    с результатом обработки всего слоя, а склейка в порядке строк/столбцов сетки
+    (и OBJECTID внутри тайла) дает детерминированный итог.
+    """
+    def __init__(self, grid_source_fc, tile_size=None, overlap=None):
+        self.grid_source_fc = grid_source_fc
+        self.tile_size = tile_size or TILE_SIZE_METERS
+        self.overlap = TILE_OVERLAP_METERS if overlap is None else overlap
+        self.grid = None
+    
+    @staticmethod
+    def is_required(feature_count):
+        """Нужна ли обработка по тайлам для слоя с указанным числом объектов"""
+        if TILING_MODE == "on":
+            return True
+        if TILING_MODE == "off":
+            return False
+        return feature_count > TILING_FEATURE_THRESHOLD
+    
+    def build_grid(self):
+        """Строит сетку тайлов по охвату слоя grid_source_fc (Lots_"Сокр")"""
+        extent = arcpy.Describe(self.grid_source_fc).extent
+        self.grid = TileGrid((extent.XMin, extent.YMin, extent.XMax, extent.YMax),
+                             self.tile_size, self.overlap)
+        logging.info("Построена сетка тайлов {}x{} (размер тайла {} м) по охвату {}".format(
+            self.grid.rows, self.grid.cols, self.grid.tile_size, self.grid_source_fc))
+        return self.grid
+    
+    def partition(self, in_layer):
+        """Распределяет объекты слоя по тайлам по их центроидам
+        
+        Returns:
+            dict: {(строка, столбец): {"oids": [...], "extent": (xmin, ymin, xmax, ymax)}}
+        """
+        if self.grid is None:
+            self.build_grid()
+        
+        partitions = {}
+        with arcpy.da.SearchCursor(in_layer, ["OID@", "SHAPE@"]) as cursor:
+            for oid, shape in cursor:
+                if shape is None:
+                    tile, shape_extent = (0, 0), None
+                else:
+                    centroid = shape.trueCentroid
+                    tile = self.grid.locate(centroid.X, centroid.Y)
+                    shape_extent = (shape.extent.XMin, shape.extent.YMin, shape.extent.XMax, shape.extent.YMax)
+                
+                part = partitions.setdefault(tile, {"oids": [], "extent": None})
+                part["oids"].append(oid)
+                part["extent"] = merge_extents(part["extent"], shape_extent)
         
+        logging.info("Объекты распределены по {} непустым тайлам из {}".format(
+            len(partitions), self.grid.rows * self.grid.cols))
+        return partitions
+    
+    def tile_layer(self, in_fc, oids, layer_name):
+        """Создает слой только с объектами тайла"""
+        oid_field = arcpy.AddFieldDelimiters(in_fc, arcpy.Describe(in_fc).OIDFieldName)
+        arcpy.MakeFeatureLayer_management(in_fc, layer_name, build_oid_where_clause(oid_field, oids))
+        return layer_name
+    
+    def window_layer(self, fc, part, layer_name, spatial_reference):
+        """Создает слой с объектами fc, пересекающими охват объектов тайла с запасом
+        
+        spatial_reference - система координат, в которой задан охват тайла
+        """
+        window = extent_polygon(expand_extent(part["extent"], self.overlap), spatial_reference)
+        arcpy.MakeFeatureLayer_management(fc, layer_name)
+        arcpy.SelectLayerByLocation_management(layer_name, "INTERSECT", window)
+        return layer_name
+    
+    def run_tiles(self, in_fc, partitions, out_fc, tile_func):
+        """Обрабатывает тайлы по очереди и склеивает результаты в out_fc
+        
+        tile_func(tile_layer, tile_output, part) должна записать результат тайла в tile_output.
+        Промежуточные данные тайла удаляются сразу после склейки.
+        """
+        global messagebox
+        tiles = sorted(partitions.keys())
+        stitched_count = 0
+        # Предупреждения и ошибки этапов внутри тайлов собираются и показываются одним сообщением
+        collector = TileMessageCollector(messagebox)
+        messagebox = collector
         try:
-            logging.info("Начало поиска классов надписей")
-            logging.info("Параметры: База данных={}".format(self.db_path))
+            for n, tile in enumerate(tiles):
+                part = partitions[tile]
+                collector.tile = tile
+                with ScratchManager("tile") as scratch:
+                    tile_layer = self.tile_layer(in_fc, part["oids"], scratch.layer("tile_input_layer"))
+                    tile_output = scratch.dataset("tile_result", [tile_layer])
+                    logging.info("Тайл %s/%s %s: %s объектов", n + 1, len(tiles), tile, len(part["oids"]))
+                    tile_func(tile_layer, tile_output, part)
+                    
+                    stitched_count += self.stitch_tile(tile_output, out_fc)
+        finally:
+            messagebox = collector.wrapped
+            collector.report()
+        
+        self.finish_stitching(in_fc, out_fc)
+        logging.info("Результаты {} тайлов склеены в {}: {} объектов".format(len(tiles), out_fc, stitched_count))
+        return stitched_count
+    
+    @staticmethod
+    def stitch_tile(tile_output, out_fc):
+        """Добавляет результат тайла в итоговый класс; возвращает число добавленных объектов"""
+        if not arcpy.Exists(tile_output):
+            return 0
+        tile_count = int(arcpy.GetCount_management(tile_output).getOutput(0))
+        if not arcpy.Exists(out_fc):
+            arcpy.CopyFeatures_management(tile_output, out_fc)
+        elif tile_count > 0:
+            arcpy.Append_management(tile_output, out_fc, "NO_TEST")
+        return tile_count
+    
+    @staticmethod
+    def finish_stitching(in_fc, out_fc):
+        """Если ни один тайл не дал результата, создает пустой класс со схемой входного слоя"""
+        if not arcpy.Exists(out_fc):
+            arcpy.CreateFeatureclass_management(os.path.dirname(out_fc), os.path.basename(out_fc),
+                                                template=in_fc,
+                                                spatial_reference=arcpy.Describe(in_fc).spatialReference)
+    
+    def clip(self, in_fc, clip_fc, out_fc, where_clause=None):
+        """Clip_analysis, который для крупных входных слоев выполняется по тайлам
+        
+        where_clause - отбор входных объектов по атрибутам (правило отбора) до вырезания
+        """
+        if TILING_MODE == "off":
+            self.clip_filtered(in_fc, clip_fc, out_fc, where_clause)
+            return
+        
+        # Небольшие лесничества вырезаются сразу, без слоев отбора кандидатов
+        if TILING_MODE == "auto":
+            estimated_count = self.estimate_candidates(in_fc, clip_fc)
+            if not self.is_required(estimated_count):
+                logging.info("Вырезание {} без тайлов: около {} объектов в охвате {}".format(
+                    in_fc, estimated_count, clip_fc))
+                self.clip_filtered(in_fc, clip_fc, out_fc, where_clause)
+                return
+        
+        with ScratchManager("tile_clip") as scratch:
+            # Отбираем только объекты, которые вообще пересекаются с вырезающим слоем
+            candidates_layer = scratch.layer("tile_clip_candidates")
+            arcpy.MakeFeatureLayer_management(in_fc, candidates_layer, where_clause)
+            arcpy.SelectLayerByLocation_management(candidates_layer, "INTERSECT", clip_fc)
+            candidate_count = int(arcpy.GetCount_management(candidates_layer).getOutput(0))
             
-            # Очищаем рабочее пространство
-            arcpy.ClearWorkspaceCache_management()
+            if not self.is_required(candidate_count):
+                arcpy.Delete_management(candidates_layer)
+                self.clip_filtered(in_fc, clip_fc, out_fc, where_clause)
+                return
             
-            # Найденные классы будем хранить в структуре {номер: путь_к_классу}
-            found_classes = {}
-            numbers_found = set()
+            logging.info("Вырезание {} по тайлам: {} объектов-кандидатов".format(in_fc, candidate_count))
+            partitions = self.partition(candidates_layer)
+            arcpy.Delete_management(candidates_layer)
             
-            # Все найденные классы
-            all_feature_classes = []
+            in_sr = arcpy.Describe(in_fc).spatialReference
             
-            # Классы с надписями, но с проблемами в определении номера
-            problem_classes = []
+            def clip_tile(tile_layer, tile_output, part):
+                clip_layer = self.window_layer(clip_fc, part, scratch.layer("tile_clip_features"), in_sr)
+                try:
+                    arcpy.Clip_analysis(tile_layer, clip_layer, tile_output)
+                finally:
+                    arcpy.Delete_management(clip_layer)
             
-            # Шаблоны для поиска надписей с цифрами
+            self.run_tiles(in_fc, partitions, out_fc, clip_tile)
+    
+    @staticmethod
+    def estimate_candidates(in_fc, clip_fc):
+        """Оценка числа объектов in_fc в охвате clip_fc без создания слоев: число объектов
+        входного класса, умноженное на долю его охвата, покрытую охватом clip_fc
+        (при равномерной плотности объектов)"""
+        total = int(arcpy.GetCount_management(in_fc).getOutput(0))
+        in_desc = arcpy.Describe(in_fc)
+        in_extent = in_desc.extent
+        clip_extent = arcpy.Describe(clip_fc).extent
+        try:
+            clip_extent = clip_extent.projectAs(in_desc.spatialReference)
+        except Exception:
+            pass
+        in_area = in_extent.width * in_extent.height
+        if in_area <= 0:
+            return total
+        overlap_width = min(in_extent.XMax, clip_extent.XMax) - max(in_extent.XMin, clip_extent.XMin)
+        overlap_height = min(in_extent.YMax, clip_extent.YMax) - max(in_extent.YMin, clip_extent.YMin)
+        if overlap_width <= 0 or overlap_height <= 0:
+            return 0
+        return int(math.ceil(total * min(1.0, overlap_width * overlap_height / in_area)))
+    
+    @staticmethod
+    def clip_filtered(in_fc, clip_fc, out_fc, where_clause=None):
+        """Clip_analysis всего слоя; при where_clause вырезаются только отобранные объекты"""
+        if not where_clause:
+            arcpy.Clip_analysis(in_fc, clip_fc, out_fc)
+            return
+        with ScratchManager("clip_filtered") as scratch:
+            filtered_layer = scratch.layer("clip_filtered_input")
+            arcpy.MakeFeatureLayer_management(in_fc, filtered_layer, where_clause)
+            arcpy.Clip_analysis(filtered_layer, clip_fc, out_fc)
+    
+    def process_identity(self, label_processor, target_fc_path, output_path):
+        """Identity, раздробление и обработка полей по тайлам с последующей склейкой"""
+        with ScratchManager("tile_identity") as scratch:
+            candidates_layer = scratch.layer("tile_identity_candidates")
+            arcpy.MakeFeatureLayer_management(target_fc_path, candidates_layer)
+            partitions = self.partition(candidates_layer)
+        
+        target_sr = arcpy.Describe(target_fc_path).spatialReference
+        
+        def identity_tile(tile_layer, tile_output, part):
+            label_processor.run_npp_stage(tile_layer, tile_output,
+                                          expand_extent(part["extent"], self.overlap), target_sr)
+            if int(arcpy.GetCount_management(tile_output).getOutput(0)) > 0:
+                label_processor.process_fields(tile_output)
+        
+        return self.run_tiles(target_fc_path, partitions, output_path, identity_tile)
+    
+    def fit_tile_size(self, min_tiles):
+        """Уменьшает размер тайла так, чтобы сетка содержала не меньше min_tiles тайлов"""
+        extent = arcpy.Describe(self.grid_source_fc).extent
+        longest_side = max(extent.width, extent.height)
+        tiles_per_side = int(math.ceil(math.sqrt(max(min_tiles, 1))))
+        if longest_side > 0:
+            self.tile_size = min(self.tile_size, longest_side / tiles_per_side)
+        self.grid = None
+    
+    def process_identity_parallel(self, label_processor, target_fc_path, output_path, workers, min_tiles=None):
+        """Identity по тайлам в пуле процессов; результаты склеиваются в порядке сетки
+        
+        Каждый процесс обрабатывает объекты своего тайла с надписями, отобранными по охвату
+        этих объектов, и пишет результат в собственную временную GDB.
+        """
+        # Тайлов должно быть больше, чем процессов, чтобы нагрузка распределялась равномерно
+        self.fit_tile_size(min_tiles or workers * 2)
+        
+        with ScratchManager("tile_identity") as scratch:
+            candidates_layer = scratch.layer("tile_identity_candidates")
+            arcpy.MakeFeatureLayer_management(target_fc_path, candidates_layer)
+            partitions = self.partition(candidates_layer)
+        
+        scratch_root = tempfile.mkdtemp(prefix="identity_tiles_", dir=arcpy.env.scratchFolder or None)
+        tasks = []
+        for tile in sorted(partitions.keys()):
+            part = partitions[tile]
+            window = expand_extent(part["extent"], self.overlap) if part["extent"] else None
+            tasks.append((tile, target_fc_path, part["oids"], window,
+                          list(label_processor.labels_classes), label_processor.join_engine, scratch_root))
+        
+        logging.info("Параллельный Identity: {} тайлов, {} процессов".format(len(tasks), workers))
+        try:
+            pool = create_process_pool(workers)
+            try:
+                results = pool.map(identity_tile_worker, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+            
+            # pool.map сохраняет порядок заданий, поэтому склейка идет в порядке сетки
+            stitched_count = 0
+            for tile, result_path, tile_count, error, records, events in results:
+                # Лог и события дочерних процессов пишет только основной процесс, в порядке тайлов
+                for level, text in records:
+                    logging.log(level, "[тайл %s] %s", tile, text)
+                for event in events:
+                    write_event(event)
+                if error:
+                    raise RuntimeError("Ошибка при обработке тайла {}: {}".format(tile, error))
+                if result_path:
+                    stitched_count += self.stitch_tile(result_path, output_path)
+            
+            self.finish_stitching(target_fc_path, output_path)
+            logging.info("Результаты {} тайлов склеены в {}: {} объектов".format(
+                len(tasks), output_path, stitched_count))
+            return stitched_count
+        finally:
+            shutil.rmtree(scratch_root, ignore_errors=True)
+
+def process_pool_available():
+    """Проверяет, что дочерние процессы пула смогут найти identity_tile_worker.
+    
+    В Windows дочерний процесс не наследует память родителя, а импортирует модуль с функцией
+    заново. Когда скрипт выполняется в окне Python ArcMap или как инструмент-скрипт внутри ArcMap,
+    у главного модуля нет файла .py, и задания пула завершаются ошибкой.
+    
+    Returns:
+        tuple: (доступен ли пул, причина недоступности или None)
+    """
+    if os.name != "nt":
+        # При fork дочерний процесс получает уже загруженный модуль
+        return True, None
+    module = sys.modules.get(identity_tile_worker.__module__)
+    module_file = getattr(module, "__file__", None)
+    if not module_file or not os.path.isfile(module_file) or not module_file.lower().endswith((".py", ".pyc")):
+        return False, "модуль {} не загружен из файла .py (окно Python или инструмент ArcMap)".format(
+            identity_tile_worker.__module__)
+    return True, None
+
+def identity_workers():
+    """Число процессов параллельного Identity: IDENTITY_WORKERS, если пул процессов
+    доступен (process_pool_available), иначе 0 с предупреждением в журнале"""
+    if IDENTITY_WORKERS <= 1:
+        return IDENTITY_WORKERS
+    available, reason = process_pool_available()
+    if not available:
+        logging.warning("Параллельный Identity недоступен (%s), Identity выполняется в одном процессе", reason)
+        return 0
+    return IDENTITY_WORKERS
+
+def create_process_pool(workers):
+    """Создает пул процессов. Внутри ArcMap sys.executable указывает на ArcMap.exe,
+    поэтому дочерние процессы явно запускаются через python.exe из поставки ArcGIS"""
+    import multiprocessing
+    if os.name == "nt" and not os.path.basename(sys.executable).lower().startswith("python"):
+        multiprocessing.set_executable(os.path.join(sys.exec_prefix, "python.exe"))
+    return multiprocessing.Pool(processes=workers)
+
+def identity_tile_worker(task):
+    """Выполняет Identity, раздробление и обработку полей для одного тайла в дочернем процессе
+    
+    Записи лога и события этапа не пишутся в файлы из дочернего процесса, а возвращаются
+    родительскому процессу (см. WorkerLogBuffer, worker_events).
+    
+    Returns:
+        tuple: (тайл, путь к результату или None, число объектов, текст ошибки или None,
+                записи лога [(уровень, текст)], события этапов)
+    """
+    global worker_events
+    tile, target_fc_path, oids, window, label_classes, join_engine, scratch_root = task
+    worker_events = []
+    if worker_log_buffer is None:
+        # При запуске через fork модуль не импортируется заново и буфер нужно создать здесь
+        configure_logging()
+    worker_log_buffer.take()
+    enable_headless_mode()
+    try:
+        gdb_name = "tile_{}_{}.gdb".format(tile[0], tile[1])
+        arcpy.CreateFileGDB_management(scratch_root, gdb_name)
+        result_path = os.path.join(scratch_root, gdb_name, "result")
+        
+        processor = LabelClassProcessor("", "")
+        processor.labels_classes = list(label_classes)
+        processor.join_engine = join_engine
+        
+        # Надписи ограничиваются охватом объектов тайла внутри run_npp_stage
+        tile_layer = TiledProcessor(target_fc_path).tile_layer(target_fc_path, oids, "worker_tile_layer")
+        processor.run_npp_stage(tile_layer, result_path, window,
+                                arcpy.Describe(target_fc_path).spatialReference if window else None)
+        arcpy.Delete_management(tile_layer)
+        
+        if int(arcpy.GetCount_management(result_path).getOutput(0)) > 0:
+            processor.process_fields(result_path)
+        
+        result = (tile, result_path, int(arcpy.GetCount_management(result_path).getOutput(0)), None)
+    except Exception as e:
+        log_exception(e, "Ошибка при обработке тайла {}".format(tile))
+        result = (tile, None, 0, str(e))
+    return result + (worker_log_buffer.take(), worker_events)
+
+def benchmark_parallel_identity(target_fc_path, label_classes, worker_counts=None):
+    """Измеряет время Identity по тайлам при разном числе процессов
+    
+    Все прогоны используют одну и ту же сетку, рассчитанную на максимальное число
+    процессов, поэтому различие во времени определяется только параллелизмом.
+    
+    Returns:
+        list: [{"workers": N, "seconds": t, "speedup": s, "efficiency": e}, ...]
+    """
+    import multiprocessing
+    available, reason = process_pool_available()
+    if not available:
+        logging.error("Бенчмарк Identity невозможен: пул процессов недоступен ({})".format(reason))
+        return []
+    cpu_count = multiprocessing.cpu_count()
+    if not worker_counts:
+        worker_counts = sorted(set(n for n in [1, 2, 4, 8, cpu_count] if n <= cpu_count))
+    min_tiles = max(worker_counts) * 2
+    
+    label_processor = LabelClassProcessor("", "")
+    label_processor.labels_classes = list(label_classes)
+    
+    scratch_root = tempfile.mkdtemp(prefix="identity_benchmark_", dir=arcpy.env.scratchFolder or None)
+    arcpy.CreateFileGDB_management(scratch_root, "benchmark.gdb")
+    results = []
+    try:
+        for workers in worker_counts:
+            output_path = os.path.join(scratch_root, "benchmark.gdb", "identity_{}".format(workers))
+            start = time.time()
+            count = TiledProcessor(target_fc_path).process_identity_parallel(
+                label_processor, target_fc_path, output_path, workers, min_tiles)
+            seconds = time.time() - start
+            
+            base_seconds = results[0]["seconds"] if results else seconds
+            speedup = base_seconds / seconds if seconds > 0 else 0.0
+            results.append({"workers": workers, "seconds": seconds, "count": count,
+                            "speedup": speedup, "efficiency": speedup * worker_counts[0] / workers})
+            logging.info("Бенчмарк Identity: процессов %s, время %.1f с, объектов %s, ускорение %.2f",
+                workers, seconds, count, speedup)
+    finally:
+        shutil.rmtree(scratch_root, ignore_errors=True)
+    
+    print("Процессов | Время, с | Объектов | Ускорение | Эффективность")
+    for row in results:
+        print("{:>9} | {:>8.1f} | {:>8} | {:>9.2f} | {:>12.0%}".format(
+            row["workers"], row["seconds"], row["count"], row["speedup"], row["efficiency"]))
+    return results
+
+def mean_shape_area(fc, spatial_reference=None, sample_size=500):
+    """Средняя площадь первых sample_size объектов класса в единицах spatial_reference"""
+    total_area = 0.0
+    count = 0
+    with arcpy.da.SearchCursor(fc, ["SHAPE@AREA"], spatial_reference=spatial_reference) as cursor:
+        for (area,) in cursor:
+            if area:
+                total_area += area
+                count += 1
+            if count >= sample_size:
+                break
+    return total_area / count if count else 0.0
+
+class NppLabelJoiner:
+    """Присоединение NPP из классов надписей к полигонам без наложения Identity.
+    
+    Точечные надписи присоединяются по попаданию точки в полигон, полигональные - по
+    наибольшей площади перекрытия. Классы надписей просматриваются по порядку, и первый
+    класс, давший значение, определяет NPP - как при объединении полей NPP в process_fields.
+    Значение сразу пишется в одно поле NPP, поэтому широкой схемы NPP, NPP_1..NPP_n не возникает.
+    """
+    def __init__(self, label_processor):
+        self.label_processor = label_processor
+    
+    def load_labels(self, label_class, layer_name, extent, extent_sr):
+        """Загружает надписи класса из охвата extent в пространственный индекс
+        
+        Returns:
+            tuple: (GridIndex, точечные ли надписи) или None, если класс не дает значений
+        """
+        if "NPP" not in [f.name for f in arcpy.ListFields(label_class)]:
+            logging.warning("В классе {} нет поля NPP, класс пропущен".format(os.path.basename(label_class)))
+            return None
+        
+        label_count = self.label_processor.make_label_layer(label_class, layer_name, extent, extent_sr)
+        if label_count == 0:
+            logging.info("Лист {} не пересекается с охватом обрабатываемого слоя, пропущен".format(
+                os.path.basename(label_class)))
+            return None
+        
+        is_point = arcpy.Describe(label_class).shapeType in ("Point", "Multipoint")
+        index = GridIndex(grid_cell_size(extent, label_count))
+        with arcpy.da.SearchCursor(layer_name, ["SHAPE@", "NPP"], spatial_reference=extent_sr) as cursor:
+            for shape, npp in cursor:
+                if shape is None or not npp:
+                    continue
+                shape_extent = shape.extent
+                index.insert((shape, npp), (shape_extent.XMin, shape_extent.YMin,
+                                            shape_extent.XMax, shape_extent.YMax))
+        arcpy.Delete_management(layer_name)
+        
+        logging.info("Загружено {} надписей класса {} в пространственный индекс".format(
+            len(index), os.path.basename(label_class)))
+        return index, is_point
+    
+    @staticmethod
+    def match(shape, index, is_point):
+        """Находит NPP для полигона shape по надписям одного класса"""
+        shape_extent = shape.extent
+        candidates = index.query((shape_extent.XMin, shape_extent.YMin, shape_extent.XMax, shape_extent.YMax))
+        if is_point:
+            for label_shape, npp in candidates:
+                if shape.contains(label_shape):
+                    return npp
+            return None
+        
+        best_npp = None
+        best_area = 0.0
+        for label_shape, npp in candidates:
+            if shape.disjoint(label_shape):
+                continue
+            overlap_area = shape.intersect(label_shape, 4).area
+            if overlap_area > best_area:
+                best_npp = npp
+                best_area = overlap_area
+        return best_npp
+    
+    def run(self, input_fc, output_path, extent=None, extent_sr=None):
+        """Копирует input_fc в output_path, раздробляет составные объекты и записывает NPP"""
+        arcpy.CopyFeatures_management(input_fc, output_path)
+        self.label_processor.explode_multipart(output_path)
+        
+        output_desc = arcpy.Describe(output_path)
+        if extent is None:
+            extent = (output_desc.extent.XMin, output_desc.extent.YMin,
+                      output_desc.extent.XMax, output_desc.extent.YMax)
+            extent_sr = output_desc.spatialReference
+        
+        indexes = []
+        for i, label_class in enumerate(self.label_processor.labels_classes):
+            loaded = self.load_labels(label_class, "join_label_layer_{}".format(i), extent, extent_sr)
+            if loaded:
+                indexes.append(loaded)
+        
+        # Если во входном слое уже есть NPP, он остается первым по приоритету при объединении полей
+        field_names = [f.name for f in output_desc.fields]
+        npp_field = "NPP_LABEL" if "NPP" in field_names else "NPP"
+        arcpy.AddField_management(output_path, npp_field, "SHORT")
+        
+        total_count = 0
+        matched_count = 0
+        with arcpy.da.UpdateCursor(output_path, ["SHAPE@", npp_field]) as cursor:
+            for row in cursor:
+                total_count += 1
+                if row[0] is None:
+                    continue
+                for index, is_point in indexes:
+                    value = self.match(row[0], index, is_point)
+                    if value:
+                        row[1] = value
+                        cursor.updateRow(row)
+                        matched_count += 1
+                        break
+        
+        logging.info("Присоединение NPP без наложения: {} из {} полигонов получили значение NPP".format(
+            matched_count, total_count))
+        return matched_count
+
+# Типы полей arcpy.ListFields и соответствующие им типы AddField_management
+ADD_FIELD_TYPES = {
+    "SmallInteger": "SHORT",
+    "Integer": "LONG",
+    "Single": "FLOAT",
+    "Double": "DOUBLE",
+    "String": "TEXT",
+    "Date": "DATE"
+}
+
+def grid_fields(template_fc):
+    """Поля схемы сетки, которые есть в template_fc (Land или Land_"Сокр"), и NPP"""
+    names = [f.name for f in arcpy.ListFields(template_fc)]
+    return [name for name in ("LandType", "LandCode") if name in names] + ["NPP"]
+
+def create_grid_class(template_fc, output_path, spatial_reference=None):
+    """Создает пустой класс со схемой сетки: LandType и LandCode с типами из template_fc, NPP (SHORT)
+    
+    Returns:
+        list: имена атрибутивных полей созданного класса
+    """
+    desc = arcpy.Describe(template_fc)
+    template_fields = dict((f.name, f) for f in arcpy.ListFields(template_fc))
+    arcpy.CreateFeatureclass_management(
+        os.path.dirname(output_path),
+        os.path.basename(output_path),
+        "POLYGON",
+        has_m="ENABLED" if desc.hasM else "DISABLED",
+        has_z="ENABLED" if desc.hasZ else "DISABLED",
+        spatial_reference=spatial_reference or desc.spatialReference
+    )
+    fields = grid_fields(template_fc)
+    for name in fields[:-1]:
+        field = template_fields[name]
+        arcpy.AddField_management(output_path, name, ADD_FIELD_TYPES.get(field.type, "LONG"),
+                                  field_length=field.length if field.type == "String" else None)
+    arcpy.AddField_management(output_path, "NPP", "SHORT")
+    return fields
+
+def grid_attribute_summary(fc, fields=("LandType", "LandCode", "NPP")):
+    """Мультимножество (значения полей, площадь) объектов класса и их суммарная площадь"""
+    existing = [f.name for f in arcpy.ListFields(fc)]
+    read_fields = [name for name in fields if name in existing]
+    rows = collections.Counter()
+    total_area = 0.0
+    with arcpy.da.SearchCursor(fc, ["SHAPE@AREA"] + read_fields) as cursor:
+        for row in cursor:
+            area = row[0] or 0.0
+            total_area += area
+            values = dict(zip(read_fields, row[1:]))
+            rows[tuple(values.get(name) for name in fields) + (round(area, 2),)] += 1
+    return rows, total_area
+
+def compare_grid_outputs(expected_fc, actual_fc, fields=("LandType", "LandCode", "NPP")):
+    """Сравнивает два варианта Land_"Сокр"_сетка по числу объектов, атрибутам и площади
+    
+    Returns:
+        dict: результаты сравнения; ключ "equal" - совпадают ли классы
+    """
+    expected_rows, expected_area = grid_attribute_summary(expected_fc, fields)
+    actual_rows, actual_area = grid_attribute_summary(actual_fc, fields)
+    missing = expected_rows - actual_rows
+    extra = actual_rows - expected_rows
+    result = {
+        "expected_count": sum(expected_rows.values()),
+        "actual_count": sum(actual_rows.values()),
+        "missing": sum(missing.values()),
+        "extra": sum(extra.values()),
+        "expected_area": expected_area,
+        "actual_area": actual_area
+    }
+    result["equal"] = not missing and not extra
+    for key, count in list(missing.items())[:10]:
+        logging.info("Нет в %s: %s x%s", os.path.basename(actual_fc), key, count)
+    for key, count in list(extra.items())[:10]:
+        logging.info("Лишний в %s: %s x%s", os.path.basename(actual_fc), key, count)
+    return result
+
+class GridPipeline:
+    """Потоковая сборка Land_"Сокр"_сетка (PIPELINE_MODE = "streaming").
+    
+    Вместо перезаписи класса каждым инструментом (копия, Identity по листам, раздробление,
+    поля, UpdateCursor, DeleteFeatures, Append) объекты проходят цепочку генераторов:
+    чтение -> присоединение NPP -> раздробление -> объединение полей NPP -> очистка NPP
+    по LandType -> отбор по границам Lots_"Сокр" -> добавление Land_"Сокр"_контур,
+    и итоговый класс записывается один раз курсором вставки.
+    
+    Наложение Identity не выражается построчно, поэтому при способе присоединения "identity"
+    цепочка листов выполняется в in_memory, и конвейер читает уже ее результат.
+    """
+    def __init__(self, label_processor, target_fc_path, output_path, provisioned=False):
+        self.label_processor = label_processor
+        self.target_fc_path = target_fc_path
+        self.output_path = output_path
+        # Пустой итоговый класс уже создан заранее (DatasetPool) и заполняется без пересоздания
+        self.provisioned = provisioned
+        self.desc = arcpy.Describe(target_fc_path)
+        self.spatial_reference = self.desc.spatialReference
+        # NPP, присоединенное NppLabelJoiner, переносится без объединения (как в process_fields):
+        # такое значение не бывает нулевым. Поля NPP после Identity всегда проходят замену нулей
+        self.npp_passthrough = False
+        self.grid_count = 0
+        self.removed_count = 0
+    
+    def read_rows(self, fc):
+        """Читает геометрию, поля LandType, LandCode и полей правил, а также значения всех полей NPP"""
+        names = [f.name for f in arcpy.ListFields(fc)]
+        npp_fields = [name for name in names if "NPP" in name.upper()]
+        # Кроме LandType и LandCode читаем поля, на которые ссылаются правила сетки
+        rule_fields = get_rule("npp_clear").fields + get_rule("outside_lots_drop").fields
+        attr_fields = [name for name in names if name in ("LandType", "LandCode") or
+                       (name in rule_fields and name not in npp_fields)]
+        
+        with arcpy.da.SearchCursor(fc, ["SHAPE@"] + attr_fields + npp_fields) as cursor:
+            for row in cursor:
+                item = {"shape": row[0], "LandType": None, "LandCode": None}
+                for i, name in enumerate(attr_fields):
+                    item[name] = row[1 + i]
+                item["npp"] = list(row[1 + len(attr_fields):])
+                yield item
+    
+    def explode(self, rows):
+        """Раздробляет составные объекты: каждая часть - отдельная строка с теми же атрибутами"""
+        for row in rows:
+            shape = row["shape"]
+            if shape is None or not shape.isMultipart or shape.partCount < 2:
+                yield row
+                continue
+            for i in range(shape.partCount):
+                part = dict(row)
+                part["shape"] = arcpy.Polygon(shape.getPart(i), self.spatial_reference, self.desc.hasZ, self.desc.hasM)
+                part["npp"] = list(row["npp"])
+                yield part
+    
+    def join_labels(self, rows):
+        """Присоединяет NPP из классов надписей по попаданию точки / наибольшему перекрытию"""
+        joiner = NppLabelJoiner(self.label_processor)
+        extent = (self.desc.extent.XMin, self.desc.extent.YMin, self.desc.extent.XMax, self.desc.extent.YMax)
+        indexes = []
+        for i, label_class in enumerate(self.label_processor.labels_classes):
+            loaded = joiner.load_labels(label_class, "pipeline_label_layer_{}".format(i), extent, self.spatial_reference)
+            if loaded:
+                indexes.append(loaded)
+        
+        for row in rows:
+            value = None
+            if row["shape"] is not None:
+                for index, is_point in indexes:
+                    value = NppLabelJoiner.match(row["shape"], index, is_point)
+                    if value:
+                        break
+            row["npp"].append(value or None)
+            yield row
+    
+    def combine_npp(self, rows):
+        """Берет первое ненулевое значение из полей NPP, как process_fields"""
+        for row in rows:
+            if self.npp_passthrough:
+                row["NPP"] = row["npp"][0]
+            else:
+                row["NPP"] = None
+                for value in row["npp"]:
+                    if value is not None and value != 0:
+                        row["NPP"] = value
+                        break
+            yield row
+    
+    @staticmethod
+    def clear_npp_by_land_type(rows):
+        """Очищает NPP у объектов, удовлетворяющих правилу npp_clear, как finish_fields"""
+        npp_rule = get_rule("npp_clear")
+        for row in rows:
+            if npp_rule.matches(row):
+                row["NPP"] = None
+            yield row
+    
+    def filter_outside_lots(self, rows):
+        """Отбрасывает объекты, удовлетворяющие правилу outside_lots_drop и не пересекающие
+        Lots_"Сокр", как filter_by_lots_boundary"""
+        shortened_name = self.label_processor.shortened_name
+        lots_path = os.path.join(os.path.dirname(self.output_path), "Lots_{}".format(shortened_name))
+        if not arcpy.Exists(lots_path):
+            logging.warning("Класс объектов 'Lots_{}' не найден".format(shortened_name))
+            messagebox.showwarning("Предупреждение", 
+                                 "Не удалось найти класс Lots_\"{}\". Фильтрация за пределами контура не выполнена.".format(shortened_name))
+            for row in rows:
+                yield row
+            return
+        
+        lots_desc = arcpy.Describe(lots_path)
+        lots_extent = (lots_desc.extent.XMin, lots_desc.extent.YMin, lots_desc.extent.XMax, lots_desc.extent.YMax)
+        lots_count = int(arcpy.GetCount_management(lots_path).getOutput(0))
+        lots_index = GridIndex(grid_cell_size(lots_extent, lots_count))
+        with arcpy.da.SearchCursor(lots_path, ["SHAPE@"], spatial_reference=self.spatial_reference) as cursor:
+            for (shape,) in cursor:
+                if shape is not None:
+                    lots_index.insert(shape, (shape.extent.XMin, shape.extent.YMin, shape.extent.XMax, shape.extent.YMax))
+        
+        outside_rule = get_rule("outside_lots_drop")
+        for row in rows:
+            shape = row["shape"]
+            if shape is not None and outside_rule.matches(row):
+                shape_extent = (shape.extent.XMin, shape.extent.YMin, shape.extent.XMax, shape.extent.YMax)
+                if all(shape.disjoint(lot) for lot in lots_index.query(shape_extent)):
+                    self.removed_count += 1
+                    continue
+            yield row
+    
+    def with_contour(self, rows):
+        """Добавляет после объектов сетки объекты Land_"Сокр"_контур с пустым NPP"""
+        for row in rows:
+            self.grid_count += 1
+            yield row
+        if self.grid_count == 0:
+            return
+        
+        contour_path = self.label_processor.contour_path_for(self.target_fc_path)
+        if not arcpy.Exists(contour_path):
+            logging.warning("Не найден класс Land_\"Сокр\"_контур: {}".format(contour_path))
+            messagebox.showwarning("Предупреждение", 
+                                 "Не найден класс Land_\"Сокр\"_контур для копирования данных")
+            return
+        
+        names = [f.name for f in arcpy.ListFields(contour_path)]
+        attr_fields = [name for name in ("LandType", "LandCode", "NPP") if name in names]
+        with arcpy.da.SearchCursor(contour_path, ["SHAPE@"] + attr_fields) as cursor:
+            for row in cursor:
+                item = {"shape": row[0], "LandType": None, "LandCode": None, "NPP": None}
+                item.update(zip(attr_fields, row[1:]))
+                yield item
+    
+    def create_output(self):
+        """Создает пустой итоговый класс со схемой сетки или берет заранее созданный"""
+        if self.provisioned and arcpy.Exists(self.output_path):
+            output_names = [f.name for f in arcpy.ListFields(self.output_path)]
+            logging.info("Сетка записывается в заранее созданный класс: {}".format(self.output_path))
+            return [name for name in grid_fields(self.target_fc_path) if name in output_names]
+        return create_grid_class(self.target_fc_path, self.output_path, self.spatial_reference)
+    
+    def run(self):
+        """Собирает Land_"Сокр"_сетка и возвращает число записанных объектов"""
+        with ScratchManager("grid_pipeline") as scratch:
+            self.npp_passthrough = self.label_processor.join_engine == "point_in_polygon"
+            if self.npp_passthrough:
+                rows = self.join_labels(self.explode(self.read_rows(self.target_fc_path)))
+            else:
+                identity_path = scratch.dataset("pipeline_identity", [self.target_fc_path])
+                self.label_processor.run_identity_chain(self.target_fc_path, identity_path)
+                rows = self.explode(self.read_rows(identity_path))
+            
+            rows = self.with_contour(self.filter_outside_lots(self.clear_npp_by_land_type(self.combine_npp(rows))))
+            fields = self.create_output()
+            
+            written_count = 0
+            with arcpy.da.InsertCursor(self.output_path, ["SHAPE@"] + fields) as cursor:
+                for row in rows:
+                    cursor.insertRow([row["shape"]] + [row.get(name) for name in fields])
+                    written_count += 1
+        
+        logging.info("Потоковая сборка: объектов сетки {}, удалено за пределами Lots {}, из контура {}, записано {}".format(
+            self.grid_count, self.removed_count, written_count - self.grid_count, written_count))
+        return written_count
+
+def gdb_table_files(gdb_path, path=None):
+    """Файлы данных (.gdbtable и .gdbtablx) файловой GDB без файлов блокировок *.lock.
+    Для класса path возвращаются только его собственные файлы a<DSID>, если их удалось найти"""
+    names = [name for name in os.listdir(gdb_path)
+             if name.lower().endswith((".gdbtable", ".gdbtablx"))]
+    if path and path != gdb_path and ARCPY_AVAILABLE:
+        try:
+            prefix = "a%08x." % arcpy.Describe(path).DSID
+            own = [name for name in names if name.lower().startswith(prefix)]
+            if own:
+                return [os.path.join(gdb_path, name) for name in own]
+        except Exception as e:
+            logging.debug("Не удалось определить файлы класса %s: %s", path, e)
+    return [os.path.join(gdb_path, name) for name in names]
+
+def source_mtime(path):
+    """Время последнего изменения данных класса объектов: для файловой GDB - самого позднего
+    из файлов .gdbtable/.gdbtablx класса (или всей базы), без файлов блокировок *.lock,
+    которые ArcMap обновляет при каждом открытии; для MDB и шейп-файла - файла с данными"""
+    probe = path
+    while probe and not os.path.exists(probe):
+        parent = os.path.dirname(probe)
+        if parent == probe:
+            return None
+        probe = parent
+    if not probe:
+        return None
+    if os.path.isdir(probe) and probe.lower().endswith(".gdb"):
+        mtimes = [os.path.getmtime(name) for name in gdb_table_files(probe, path)]
+        return max(mtimes or [os.path.getmtime(probe)])
+    return os.path.getmtime(probe)
+
+# Системные таблицы файловой GDB со списком ее классов: GDB_SystemCatalog и GDB_Items
+GDB_CATALOG_TABLES = ("a00000001", "a00000004")
+
+def catalog_mtime(path):
+    """Время последнего изменения состава базы path (добавление, удаление, переименование классов):
+    для файловой GDB - ее системных таблиц GDB_CATALOG_TABLES, без файлов *.lock и таблиц классов,
+    которые меняются при каждом редактировании данных; для остальных баз - source_mtime"""
+    if os.path.isdir(path) and path.lower().endswith(".gdb"):
+        mtimes = [os.path.getmtime(name) for name in gdb_table_files(path)
+                  if os.path.basename(name).lower().split(".")[0] in GDB_CATALOG_TABLES]
+        if mtimes:
+            return max(mtimes)
+    return source_mtime(path)
+
+def same_spatial_reference(first, second):
+    """Совпадают ли системы координат: по коду EPSG/ESRI (factoryCode), а для
+    пользовательских систем без кода - по полному описанию"""
+    first_code = getattr(first, "factoryCode", 0) or 0
+    second_code = getattr(second, "factoryCode", 0) or 0
+    if first_code and second_code:
+        return first_code == second_code
+    return first.exportToString() == second.exportToString()
+
+def geographic_transformation(from_sr, to_sr, extent=None):
+    """Географическое преобразование для перехода между датумами from_sr и to_sr:
+    LABEL_GEOGRAPHIC_TRANSFORMATION или первое из arcpy.ListTransformations
+    (наиболее подходящее для охвата extent); пустая строка - преобразование не нужно"""
+    if same_spatial_reference(from_sr.GCS, to_sr.GCS):
+        return ""
+    if LABEL_GEOGRAPHIC_TRANSFORMATION:
+        return LABEL_GEOGRAPHIC_TRANSFORMATION
+    if extent is not None:
+        transformations = arcpy.ListTransformations(from_sr, to_sr, extent)
+    else:
+        transformations = arcpy.ListTransformations(from_sr, to_sr)
+    if not transformations:
+        logging.warning("Не найдено географическое преобразование %s -> %s, надписи будут смещены",
+            from_sr.GCS.name, to_sr.GCS.name)
+        return ""
+    return transformations[0]
+
+class LabelProjectionCache:
+    """Кэш классов надписей, перепроецированных в систему координат целевого слоя.
+    
+    Классы хранятся в файловой GDB каталога LABEL_CACHE_DIR, а манифест manifest.json
+    связывает каждый из них с исходным классом, временем изменения исходной базы,
+    системой координат и географическим преобразованием. Запись используется повторно,
+    пока исходная база не изменилась.
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or LABEL_CACHE_DIR
+        self.gdb_path = os.path.join(self.cache_dir, "labels.gdb")
+        self.manifest_path = os.path.join(self.cache_dir, "manifest.json")
+        self.manifest = self.read_manifest()
+    
+    def read_manifest(self):
+        """Читает манифест кэша; поврежденный манифест считается пустым"""
+        if not os.path.exists(self.manifest_path):
+            return {}
+        try:
+            with io.open(self.manifest_path, "r", encoding="utf-8") as manifest_file:
+                return json.load(manifest_file)
+        except ValueError:
+            logging.warning("Манифест кэша проекций {} поврежден и будет перезаписан".format(self.manifest_path))
+            return {}
+    
+    def write_manifest(self):
+        text = to_text(json.dumps(self.manifest, ensure_ascii=False, indent=1, default=to_text))
+        with io.open(self.manifest_path, "w", encoding="utf-8") as manifest_file:
+            manifest_file.write(text)
+    
+    def workspace(self):
+        """GDB кэша (создается при первом обращении)"""
+        if not arcpy.Exists(self.gdb_path):
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            arcpy.CreateFileGDB_management(self.cache_dir, os.path.basename(self.gdb_path))
+        return self.gdb_path
+    
+    @staticmethod
+    def spatial_reference_key(spatial_reference):
+        """Короткий ключ системы координат по ее полному описанию"""
+        return hashlib.sha1(to_text(spatial_reference.exportToString()).encode("utf-8")).hexdigest()[:12]
+    
+    def projected(self, label_class, spatial_reference):
+        """Путь к копии класса надписей в системе координат spatial_reference
+        (из кэша, если исходная база не изменялась, иначе создается заново)"""
+        source = to_text(label_class)
+        mtime = source_mtime(label_class)
+        desc = arcpy.Describe(label_class)
+        transformation = geographic_transformation(desc.spatialReference, spatial_reference, desc.extent)
+        key = u"{}|{}|{}".format(source, self.spatial_reference_key(spatial_reference), to_text(transformation))
+        entry = self.manifest.get(key)
+        if entry and arcpy.Exists(entry["path"]):
+            if entry.get("mtime") == mtime:
+                logging.info("Класс надписей {} взят из кэша проекций: {}".format(
+                    os.path.basename(label_class), entry["path"]))
+                return entry["path"]
+            # Исходная база изменилась - устаревшая копия удаляется
+            arcpy.Delete_management(entry["path"])
+        
+        workspace = self.workspace()
+        name = arcpy.ValidateTableName("{}_{}".format(
+            os.path.basename(label_class), hashlib.sha1(key.encode("utf-8")).hexdigest()[:8]), workspace)
+        output_path = os.path.join(workspace, name)
+        if arcpy.Exists(output_path):
+            arcpy.Delete_management(output_path)
+        if transformation:
+            arcpy.Project_management(label_class, output_path, spatial_reference, transformation)
+        else:
+            arcpy.Project_management(label_class, output_path, spatial_reference)
+        logging.info("Класс надписей {} перепроецирован в {} (преобразование: {}): {}".format(
+            os.path.basename(label_class), spatial_reference.name, transformation or "не требуется", output_path))
+        
+        self.manifest[key] = {
+            "source": source,
+            "mtime": mtime,
+            "spatial_reference": spatial_reference.name,
+            "transformation": transformation,
+            "path": output_path,
+            "created": datetime.datetime.now().isoformat()
+        }
+        self.write_manifest()
+        return output_path
+
+class LabelClassProcessor:
+    def __init__(self, db_path, shortened_name):
+        self.db_path = db_path
+        self.shortened_name = shortened_name
+        self.labels_classes = []
+        self.is_mdb = os.path.isfile(db_path) and os.path.basename(db_path).lower().endswith('.mdb')
+        # Добавляем свойство для хранения пути к GDB
+        self.gdb_path = None  # Будет установлено при вызове process_identity
+        # Способ присоединения NPP, выбирается в process_identity
+        self.join_engine = "identity"
+        # Последний результат run_npp_stage получен NppLabelJoiner: поле NPP уже итоговое
+        self.npp_joined = False
+    
+    def find_label_classes(self, interactive=True):
+        """Поиск классов с 'надпис' и цифрой в имени
+        
+        interactive=False - режим без интерфейса: диалог ручного выбора классов не показывается,
+        если классов не найдено - поиск сразу завершается неудачей, классы с проблемными именами
+        пропускаются и используются найденные автоматически
+        """
+        if not ARCPY_AVAILABLE:
+            logging.error("Модуль arcpy недоступен")
+            messagebox.showerror("Ошибка", "Модуль arcpy не доступен для поиска классов")
+            return False, "Модуль arcpy недоступен"
+        
+        try:
+            logging.info("Начало поиска классов надписей")
+            logging.info("Параметры: База данных={}".format(self.db_path))
+            
+            # Очищаем рабочее пространство
+            arcpy.ClearWorkspaceCache_management()
+            
+            # Найденные классы будем хранить в структуре {номер: путь_к_классу}
+            found_classes = {}
+            numbers_found = set()
+            
+            # Все найденные классы
+            all_feature_classes = []
+            
+            # Классы с надписями, но с проблемами в определении номера
+            problem_classes = []
+            
+            # Шаблоны для поиска надписей с цифрами
             pattern1 = re.compile(r'.*надпис.*\d+.*', re.IGNORECASE)  # надпис, затем цифра
             pattern2 = re.compile(r'.*\d+.*надпис.*', re.IGNORECASE)  # цифра, затем надпис
             pattern3 = re.compile(r'.*лист.*\d+.*надпис.*', re.IGNORECASE)  # слово лист, затем цифра, затем надпис
@@ -439,7 +2536,7 @@ class LabelClassProcessor:
             
             # Функция для проверки имени и добавления в список найденных
             def check_and_add_class(class_path, class_name):
-                logging.info("Проверка класса: {}".format(class_name))
+                logging.debug("Проверка класса: %s", class_name)
                 
                 # Добавляем класс в общий список всех классов
                 all_feature_classes.append((class_name, class_path))
@@ -508,13 +2605,13 @@ class LabelClassProcessor:
                             datatype=["FeatureClass", "Table"]):
                         
                         workspace_path = dirpath
-                        logging.info("Обход каталога: {}".format(workspace_path))
+                        logging.debug("Обход каталога: %s", workspace_path)
                         
                         for fc in filenames:
                             try:
                                 # Полный путь к объекту
                                 fc_path = os.path.join(workspace_path, fc)
-                                logging.info("Найден объект: {}".format(fc))
+                                logging.debug("Найден объект: %s", fc)
                                 
                                 # Проверяем подходит ли имя
                                 if "надпис" in fc.lower() or "лист" in fc.lower():
@@ -523,7 +2620,7 @@ class LabelClassProcessor:
                                     # Добавляем в общий список всех классов
                                     all_feature_classes.append((fc, fc_path))
                             except Exception as fc_err:
-                                logging.warning("Ошибка при обработке объекта {}: {}".format(fc, str(fc_err)))
+                                logging.warning("Ошибка при обработке объекта %s: %s", fc, str(fc_err))
                 
                 except Exception as walk_err:
                     logging.warning("Ошибка при использовании arcpy.da.Walk: {}".format(str(walk_err)))
@@ -577,7 +2674,7 @@ class LabelClassProcessor:
                                 try:
                                     test_path = os.path.join(direct_ws, name)
                                     if arcpy.Exists(test_path):
-                                        logging.info("Найден класс с прямым именем: {}".format(name))
+                                        logging.info("Найден класс с прямым именем: %s", name)
                                         digits = re.findall(r'\d+', name)
                                         if digits:
                                             number = int(digits[0])
@@ -614,7 +2711,7 @@ class LabelClassProcessor:
                                 try:
                                     full_path = os.path.join(path, name)
                                     if arcpy.Exists(full_path):
-                                        logging.info("Найден класс в каталоге: {}".format(full_path))
+                                        logging.info("Найден класс в каталоге: %s", full_path)
                                         digits = re.findall(r'\d+', name)
                                         if digits:
                                             number = int(digits[0])
@@ -661,12 +2758,16 @@ class LabelClassProcessor:
                             fc_path = os.path.join(ds_path, fc)
                             check_and_add_class(fc_path, fc)
                     except:
-                        logging.warning("Ошибка при поиске классов в наборе данных {}".format(ds))
+                        logging.warning("Ошибка при поиске классов в наборе данных %s", ds)
                 
                 # Возвращаем рабочее пространство в исходное состояние
                 arcpy.env.workspace = self.db_path
                 
             # Проверяем результаты поиска
+            if not found_classes and not problem_classes and not interactive:
+                logging.warning("Классы надписей не найдены, ручной выбор недоступен в режиме без интерфейса")
+                return False, "Не найдено классов, содержащих 'надпис' и цифру"
+            
             if not found_classes and not problem_classes:
                 # Если не найдено классов и нет проблемных, предлагаем ручной выбор
                 manual_selection = self.show_manual_selection_dialog(all_feature_classes)
@@ -685,8 +2786,12 @@ class LabelClassProcessor:
                     logging.warning("Пользователь отменил ручной выбор классов")
                     return False, "Не найдено классов, содержащих 'надпис' и цифру"
             
+            if problem_classes and not interactive:
+                logging.warning("Режим без интерфейса: пропущено %s классов с проблемными именами: %s",
+                                len(problem_classes), ", ".join(name for name, _ in problem_classes))
+            
             # Если есть проблемные классы, показываем диалог с предупреждением
-            if problem_classes:
+            if problem_classes and interactive:
                 logging.warning("Найдено {} классов с проблемными именами".format(len(problem_classes)))
                 warning_message = "Обнаружены классы с 'надпис', но с проблемами в определении номера:\n\n"
                 warning_message += "\n".join([name for name, _ in problem_classes[:5]])
@@ -790,47 +2895,31 @@ class LabelClassProcessor:
         # Инструкция
         hint_label = tk.Label(main_frame, 
                            text="Выберите классы содержащие надписи из списка ниже.\n"
-                                "Используйте Ctrl+Click для выбора нескольких элементов.",
+                                "Щелчок отмечает класс или снимает отметку, строка поиска сокращает список.",
                            font=("Arial", 10),
                            fg="blue",
                            wraplength=550)
         hint_label.pack(pady=10)
         
-        # Фрейм для списка с прокруткой
-        list_frame = tk.Frame(main_frame)
-        list_frame.pack(fill=tk.BOTH, expand=True, pady=10)
-        
-        # Полоса прокрутки
-        scrollbar = tk.Scrollbar(list_frame)
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        
-        # Список классов
-        classes_listbox = tk.Listbox(list_frame, 
-                                  selectmode=tk.MULTIPLE, 
-                                  yscrollcommand=scrollbar.set,
-                                  font=("Courier New", 10),
-                                  height=15)
-        scrollbar.config(command=classes_listbox.yview)
-        classes_listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-        
-        # Заполняем список классов
-        for i, (name, path) in enumerate(all_classes):
+        # Список классов с поиском (в списке находятся только видимые строки)
+        display_names = []
+        for name, path in all_classes:
             if "надпис" in name.lower():
-                display_name = "* {}".format(name)
+                display_names.append("* {}".format(name))
             else:
-                display_name = "  {}".format(name)
-            classes_listbox.insert(tk.END, display_name)
-            
-            # Если класс в списке предварительно выбранных
-            if preselected and (name, path) in preselected:
-                classes_listbox.selection_set(i)
+                display_names.append("  {}".format(name))
+        classes_list = VirtualList(main_frame, all_classes, labels=display_names,
+                                   selectmode=tk.MULTIPLE, height=15, font=("Courier New", 10))
+        classes_list.pack(fill=tk.BOTH, expand=True, pady=10)
+        
+        # Отмечаем предварительно выбранные классы
+        if preselected:
+            classes_list.select(preselected)
+        classes_list.focus_search()
         
         # Функции для кнопок
         def on_continue():
-            selected_indices = classes_listbox.curselection()
-            for i in selected_indices:
-                name, path = all_classes[i]
-                selected_classes.append((name, path))
+            selected_classes.extend(classes_list.selection())
             result["action"] = "continue"
             dialog.destroy()
         
@@ -1010,8 +3099,12 @@ class LabelClassProcessor:
             # Очищаем кэш рабочих пространств
             arcpy.ClearWorkspaceCache_management()
             
+            # Пустой класс сетки мог быть создан заранее вместе с набором данных из пула
+            provisioned_grid = output_path in provisioned_outputs
+            provisioned_outputs.discard(output_path)
+            
             # Проверяем, существует ли выходной класс
-            if arcpy.Exists(output_path):
+            if arcpy.Exists(output_path) and not provisioned_grid:
                 logging.warning("Выходной класс {} уже существует".format(output_name))
                 if messagebox.askyesno("Предупреждение", 
                                      "Класс объектов {} уже существует. Хотите заменить его?".format(output_name)):
@@ -1027,324 +3120,84 @@ class LabelClassProcessor:
                     logging.info("Операция идентичности отменена пользователем")
                     return False
             
-            # Создаем копию целевого слоя как основу
-            arcpy.CopyFeatures_management(target_fc_path, output_path)
-            logging.info("Создана копия целевого слоя как основа для Identity: {}".format(output_path))
-
             # Проверяем пространственные привязки
             target_sr = arcpy.Describe(target_fc_path).spatialReference
             logging.info("Пространственная привязка целевого класса: {}".format(target_sr.name))
+            self.harmonize_spatial_reference(target_sr)
             
-            # Обрабатываем каждый класс прошлого тура по очереди
-            for i, label_class in enumerate(self.labels_classes):
-                try:
-                    logging.info("Обработка класса надписей {}/{}: {}".format(
-                        i+1, len(self.labels_classes), os.path.basename(label_class)))
-                    
-                    # Создаем временный слой для текущего класса надписей
-                    temp_label_layer = "temp_label_layer_{}".format(i)
-                    # Если есть поле NPP, применяем фильтр NPP > 0
-                    field_names = [f.name for f in arcpy.ListFields(label_class)]
-                    where_clause = "NPP > 0" if "NPP" in field_names else None
-                    
-                    arcpy.MakeFeatureLayer_management(label_class, temp_label_layer, where_clause)
-                    
-                    # Создаем временный слой для текущего результата
-                    temp_output_layer = "temp_output_layer_{}".format(i)
-                    arcpy.MakeFeatureLayer_management(output_path, temp_output_layer)
-                    
-                    # Создаем временный результат для текущей операции Identity
-                    temp_result = "in_memory\\temp_identity_{}".format(i)
-                    
-                    # Выполняем Identity для текущего класса надписей
-                    arcpy.Identity_analysis(
-                        in_features=temp_output_layer,
-                        identity_features=temp_label_layer,
-                        out_feature_class=temp_result,
-                        join_attributes="ALL",
-                        cluster_tolerance="0.001 Meters"
-                    )
-                    
-                    # Если операция успешна, заменяем текущий результат
-                    if arcpy.Exists(temp_result):
-                        # Удаляем предыдущий результат
-                        arcpy.Delete_management(output_path)
-                        # Копируем новый результат
-                        arcpy.CopyFeatures_management(temp_result, output_path)
-                        logging.info("Успешно выполнена операция Identity с классом {}".format(
-                            os.path.basename(label_class)))
-                    
-                    # Очищаем временные данные
-                    for temp_layer in [temp_label_layer, temp_output_layer, temp_result]:
-                        if arcpy.Exists(temp_layer):
-                            arcpy.Delete_management(temp_layer)
+            # Крупные лесхозы обрабатываем по тайлам, чтобы потребление памяти не росло вместе с данными
+            target_count = int(arcpy.GetCount_management(target_fc_path).getOutput(0))
+            self.join_engine = self.choose_join_engine(target_fc_path)
+            logging.info("Способ присоединения NPP: {}".format(self.join_engine))
+            
+            workers = identity_workers()
+            use_tiles = workers > 1 or TiledProcessor.is_required(target_count)
+            streaming = PIPELINE_MODE == "streaming" and not use_tiles
+            if PIPELINE_MODE == "streaming" and use_tiles:
+                logging.info("Потоковая сборка не поддерживает обработку по тайлам, сетка собирается прежним способом")
+            if provisioned_grid and not streaming and arcpy.Exists(output_path):
+                # Прежний способ создает класс сетки инструментами, заготовка из пула ему не нужна
+                arcpy.Delete_management(output_path)
+                provisioned_grid = False
+            with track_stage("grid_pipeline" if streaming else "npp_join",
+                             [target_fc_path] + list(self.labels_classes), output_path,
+                             engine=self.join_engine, tiled=use_tiles, workers=workers) as stage_event:
+                stage_event["counts"]["input"] = target_count
+                if streaming:
+                    logging.info("Сетка собирается потоковым конвейером с одной записью результата")
+                    GridPipeline(self, target_fc_path, output_path, provisioned_grid).run()
+                elif use_tiles:
+                    # Сетка строится по охвату Lots_"Сокр", если он есть в наборе данных
+                    lots_clip_path = os.path.join(dataset_path, "Lots_{}".format(self.shortened_name))
+                    grid_source = lots_clip_path if arcpy.Exists(lots_clip_path) else target_fc_path
+                    if workers > 1:
+                        logging.info("Identity выполняется по тайлам в {} процессах".format(workers))
+                        TiledProcessor(grid_source).process_identity_parallel(
+                            self, target_fc_path, output_path, workers)
+                    else:
+                        logging.info("Слой содержит {} объектов, Identity выполняется по тайлам".format(target_count))
+                        TiledProcessor(grid_source).process_identity(self, target_fc_path, output_path)
+                else:
+                    self.run_npp_stage(target_fc_path, output_path)
                 
-                except Exception as e:
-                    logging.error("Ошибка при обработке класса {}: {}".format(
-                        os.path.basename(label_class), str(e)))
-                    logging.error(traceback.format_exc())
+                result_count = int(arcpy.GetCount_management(output_path).getOutput(0)) if arcpy.Exists(output_path) else None
+                stage_event["counts"]["output"] = result_count
+            
+            if streaming and PIPELINE_VALIDATE and result_count:
+                self.validate_pipeline(target_fc_path, output_path)
             
             # Проверяем результат операции
-            if arcpy.Exists(output_path):
-                result_count = int(arcpy.GetCount_management(output_path).getOutput(0))
+            if result_count is not None:
                 logging.info("Итоговый класс сетки содержит {} объектов".format(result_count))
                 
+                if result_count > 0 and not streaming:
+                    # Очистка NPP и отбор за пределами Lots_"Сокр" выбирают объекты по LandType и LandCode
+                    refresh_indexes(output_path, ["LandType", "LandCode"])
+                
+                if result_count > 0 and not use_tiles and not streaming:
+                    # Обрабатываем поля в слое Land_"Сокр"_сетка
+                    with track_stage("process_fields", [output_path], output_path) as stage_event:
+                        stage_event["counts"]["input"] = result_count
+                        self.process_fields(output_path)
+                
                 if result_count > 0:
-                    # Применяем инструмент MultipartToSinglepart (Раздробить составной объект)
-                    try:
-                        logging.info("Применение инструмента 'Раздробить составной объект' к слою {}".format(output_path))
-                        
-                        # Создаем временный класс объектов для результата
-                        temp_singlepart_path = "in_memory\\temp_singlepart"
-                        
-                        # Применяем инструмент MultipartToSinglepart
-                        arcpy.MultipartToSinglepart_management(
-                            output_path,
-                            temp_singlepart_path
-                        )
-                        
-                        # Получаем количество объектов после раздробления
-                        singlepart_count = int(arcpy.GetCount_management(temp_singlepart_path).getOutput(0))
-                        logging.info("После раздробления слой содержит {} объектов".format(singlepart_count))
-                        
-                        # Удаляем исходный слой и заменяем его на слой с раздробленными объектами
-                        arcpy.Delete_management(output_path)
-                        arcpy.CopyFeatures_management(temp_singlepart_path, output_path)
+                    if not streaming:
+                        # Сравниваем с границами Lots_"сокр" и удаляем объекты за пределами контура
+                        with track_stage("lots_filter", [output_path], output_path) as stage_event:
+                            stage_event["counts"]["input"] = result_count
+                            self.filter_by_lots_boundary(output_path)
                         
-                        # Очищаем временные данные
-                        arcpy.Delete_management(temp_singlepart_path)
-                        
-                        logging.info("Инструмент 'Раздробить составной объект' успешно применен")
-                    except Exception as multipart_err:
-                        logging.error("Ошибка при применении инструмента 'Раздробить составной объект': {}".format(str(multipart_err)))
-                        logging.error(traceback.format_exc())
-                        messagebox.showwarning("Предупреждение", 
-                                            "Ошибка при применении инструмента 'Раздробить составной объект':\n{}".format(str(multipart_err)))
-                    
-                    # Обрабатываем поля в слое Land_"Сокр"_сетка
-                    self.process_fields(output_path)
+                        # Копируем данные из Land_"Сокр"_контур в Land_"Сокр"_сетка
+                        self.copy_contour_to_grid(target_fc_path, output_path)
                     
-                    # Сравниваем с границами Lots_"сокр" и удаляем объекты за пределами контура
-                    self.filter_by_lots_boundary(output_path)
 
-                    # Копируем данные из Land_"Сокр"_контур в Land_"Сокр"_сетка
-                    try:
-                        logging.info("Копирование данных из Land_\"Сокр\"_контур в Land_\"Сокр\"_сетка...")
-                        
-                        # Ищем путь к Land_"Сокр"_контур
-                        land_contour_name = os.path.basename(target_fc_path)
-                        
-                        # Убеждаемся, что это Land_"Сокр"
-                        if not land_contour_name.endswith("_контур"):
-                            # Если входной слой был Land_"Сокр", то формируем имя для Land_"Сокр"_контур
-                            land_contour_name = land_contour_name + "_контур"
-                        
-                        land_contour_path = os.path.join(dataset_path, land_contour_name)
-                        
-                        if arcpy.Exists(land_contour_path):
-                            logging.info("Найден класс Land_\"Сокр\"_контур: {}".format(land_contour_path))
-                            
-                            # Создаем временный слой для Land_"Сокр"_контур
-                            temp_contour_layer = "temp_contour_layer"
-                            arcpy.MakeFeatureLayer_management(land_contour_path, temp_contour_layer)
-                            
-                            # Подсчитываем количество объектов в Land_"Сокр"_контур
-                            contour_count = int(arcpy.GetCount_management(temp_contour_layer).getOutput(0))
-                            logging.info("Количество объектов в Land_\"Сокр\"_контур: {}".format(contour_count))
-                            
-                            if contour_count > 0:
-                                # Добавляем данные из Land_"Сокр"_контур в Land_"Сокр"_сетка
-                                arcpy.Append_management(
-                                    inputs=temp_contour_layer,
-                                    target=output_path,
-                                    schema_type="NO_TEST"  # Не проверяем схему данных
-                                )
-                                logging.info("Данные из Land_\"Сокр\"_контур скопированы в Land_\"Сокр\"_сетка")
-                                
-                                # Проверяем итоговое количество объектов
-                                final_output_count = int(arcpy.GetCount_management(output_path).getOutput(0))
-                                logging.info("Итоговое количество объектов в Land_\"Сокр\"_сетка после копирования: {}".format(final_output_count))
-                            else:
-                                logging.info("Land_\"Сокр\"_контур не содержит объектов для копирования")
-                            
-                            # Удаляем временный слой
-                            arcpy.Delete_management(temp_contour_layer)
-                        else:
-                            logging.warning("Не найден класс Land_\"Сокр\"_контур: {}".format(land_contour_path))
-                            messagebox.showwarning("Предупреждение", 
-                                                 "Не найден класс Land_\"Сокр\"_контур для копирования данных")
-                    
-                    except Exception as copy_err:
-                        logging.error("Ошибка при копировании данных из Land_\"Сокр\"_контур: {}".format(str(copy_err)))
-                        logging.error(traceback.format_exc())
-                        messagebox.showwarning("Предупреждение", 
-                                             "Ошибка при копировании данных из Land_\"Сокр\"_контур:\n{}".format(str(copy_err)))
-                    
-                    # Добавляем класс в таблицу содержания
-                    try:
-                        # Пытаемся определить продукт ArcGIS
-                        product_info = arcpy.ProductInfo()
-                        logging.info("Определен продукт ArcGIS: {}".format(product_info))
-                        
-                        # Проверяем, запущен ли скрипт из ArcMap (более широкий список возможных значений)
-                        if product_info in ["ArcView", "ArcEditor", "ArcInfo", "Desktop"]:
-                            logging.info("Добавление слоя в таблицу содержания ArcMap...")
-                            try:
-                                import arcpy.mapping as mapping
-                                
-                                # Получаем текущий документ карты
-                                mxd = mapping.MapDocument("CURRENT")
-                                logging.info("Получен документ карты")
-                                
-                                # Получаем активный фрейм данных
-                                if mapping.ListDataFrames(mxd):
-                                    df = mapping.ListDataFrames(mxd)[0]  # Берем первый фрейм данных
-                                    logging.info("Получен фрейм данных: {}".format(df.name))
-                                    
-                                    # Создаем слой из класса объектов
-                                    try:
-                                        new_layer = mapping.Layer(output_path)
-                                        logging.info("Создан слой из класса объектов")
-                                        
-                                        # Добавляем слой в документ карты
-                                        mapping.AddLayer(df, new_layer, "TOP")
-                                        logging.info("Слой добавлен в фрейм данных")
-                                        
-                                        # Сохраняем документ карты
-                                        mxd.save()
-                                        logging.info("Документ карты сохранен")
-                                        
-                                        # Обновляем вид
-                                        arcpy.RefreshTOC()
-                                        arcpy.RefreshActiveView()
-                                        logging.info("Вид обновлен")
-                                        
-                                        # Показываем сообщение пользователю
-                                        messagebox.showinfo("Успех", "Слой Land_\"Сокр\"_сетка успешно добавлен в таблицу содержания")
-                                    except Exception as layer_err:
-                                        logging.error("Ошибка при создании слоя: {}".format(str(layer_err)))
-                                        
-                                        # Пробуем альтернативный способ добавления
-                                        try:
-                                            # Добавляем через MakeFeatureLayer и добавление временного слоя
-                                            temp_layer_name = "temp_siatka_layer"
-                                            arcpy.MakeFeatureLayer_management(output_path, temp_layer_name)
-                                            logging.info("Создан временный слой: {}".format(temp_layer_name))
-                                            
-                                            # Добавляем временный слой в таблицу содержания
-                                            result = arcpy.mapping.Layer(temp_layer_name)
-                                            arcpy.mapping.AddLayer(df, result, "TOP")
-                                            logging.info("Временный слой добавлен в таблицу содержания")
-                                            
-                                            # Сохраняем документ карты
-                                            mxd.save()
-                                            arcpy.RefreshTOC()
-                                            arcpy.RefreshActiveView()
-                                            
-                                            # Показываем сообщение пользователю
-                                            messagebox.showinfo("Успех", "Слой Land_\"Сокр\"_сетка успешно добавлен в таблицу содержания")
-                                        except Exception as temp_err:
-                                            logging.error("Ошибка при альтернативном методе добавления слоя: {}".format(str(temp_err)))
-                                            messagebox.showwarning("Предупреждение", 
-                                                                "Не удалось автоматически добавить слой в таблицу содержания.\n"
-                                                                "Пожалуйста, добавьте его вручную из: {}".format(output_path))
-                                else:
-                                    logging.warning("Не найдены фреймы данных в документе карты")
-                                    messagebox.showwarning("Предупреждение", 
-                                                         "Не найдены фреймы данных в документе карты.\n"
-                                                         "Пожалуйста, добавьте слой вручную из: {}".format(output_path))
-                            except ImportError as ie:
-                                logging.error("Ошибка импорта модуля arcpy.mapping: {}".format(str(ie)))
-                                messagebox.showwarning("Предупреждение", 
-                                                     "Не удалось импортировать модуль для работы с картой.\n"
-                                                     "Пожалуйста, добавьте слой вручную из: {}".format(output_path))
-                        
-                        elif product_info in ["ArcGISPro", "Pro"]:  # Если это ArcGIS Pro
-                            logging.info("Добавление слоя в таблицу содержания ArcGIS Pro...")
-                            try:
-                                import arcpy.mp as mp
-                                
-                                # Получаем текущий проект и активную карту
-                                aprx = mp.ArcGISProject("CURRENT")
-                                
-                                if aprx.listMaps():
-                                    m = aprx.activeMap
-                                    logging.info("Получена активная карта: {}".format(m.name))
-                                    
-                                    # Добавляем слой
-                                    m.addDataFromPath(output_path)
-                                    logging.info("Слой добавлен в карту")
-                                    
-                                    # Сохраняем проект
-                                    aprx.save()
-                                    logging.info("Проект сохранен")
-                                    
-                                    # Показываем сообщение пользователю
-                                    messagebox.showinfo("Успех", "Слой Land_\"Сокр\"_сетка успешно добавлен в таблицу содержания")
-                                else:
-                                    logging.warning("Не найдены карты в проекте")
-                                    messagebox.showwarning("Предупреждение", 
-                                                         "Не найдены карты в проекте.\n"
-                                                         "Пожалуйста, добавьте слой вручную из: {}".format(output_path))
-                            except ImportError as ie:
-                                logging.error("Ошибка импорта модуля arcpy.mp: {}".format(str(ie)))
-                                messagebox.showwarning("Предупреждение", 
-                                                     "Не удалось импортировать модуль для работы с проектом.\n"
-                                                     "Пожалуйста, добавьте слой вручную из: {}".format(output_path))
-                        else:
-                            # Если не удалось определить продукт, пробуем универсальный подход для ArcMap, 
-                            # так как по логам видно, что это ArcMap 10.4
-                            logging.warning("Не определен продукт ArcGIS ({}), пробуем универсальный подход".format(product_info))
-                            try:
-                                # Пробуем использовать arcpy.mapping напрямую
-                                import arcpy.mapping as mapping
-                                
-                                try:
-                                    # Создаем временный слой
-                                    temp_layer_name = "temp_siatka_layer_universal"
-                                    arcpy.MakeFeatureLayer_management(output_path, temp_layer_name)
-                                    logging.info("Создан временный слой: {}".format(temp_layer_name))
-                                    
-                                    # Получаем текущий документ
-                                    try:
-                                        mxd = mapping.MapDocument("CURRENT")
-                                        df = mapping.ListDataFrames(mxd)[0]
-                                        
-                                        # Создаем слой из временного слоя
-                                        temp_layer = mapping.Layer(temp_layer_name)
-                                        mapping.AddLayer(df, temp_layer, "TOP")
-                                        
-                                        # Сохраняем документ и обновляем вид
-                                        mxd.save()
-                                        arcpy.RefreshTOC()
-                                        arcpy.RefreshActiveView()
-                                        
-                                        logging.info("Успешно добавлен слой в таблицу содержания универсальным методом")
-                                        messagebox.showinfo("Успех", "Слой Land_\"Сокр\"_сетка успешно добавлен в таблицу содержания")
-                                    except Exception as mxd_err:
-                                        logging.error("Ошибка при работе с документом карты: {}".format(str(mxd_err)))
-                                        # Сообщаем пользователю о необходимости ручного добавления
-                                        messagebox.showwarning("Предупреждение", 
-                                                            "Не удалось автоматически добавить слой в таблицу содержания.\n"
-                                                            "Пожалуйста, добавьте его вручную из:\n{}".format(output_path))
-                                        
-                                except Exception as universal_err:
-                                    logging.error("Ошибка при универсальном методе добавления слоя: {}".format(str(universal_err)))
-                                    messagebox.showwarning("Предупреждение", 
-                                                        "Не удалось автоматически добавить слой в таблицу содержания.\n"
-                                                        "Пожалуйста, добавьте его вручную из:\n{}".format(output_path))
-                            except ImportError:
-                                logging.error("Не удалось импортировать модуль arcpy.mapping для универсального метода")
-                                messagebox.showwarning("Предупреждение", 
-                                                    "Не удалось автоматически добавить слой в таблицу содержания.\n"
-                                                    "Пожалуйста, добавьте его вручную из:\n{}".format(output_path))
+                    # Индексы по полям, по которым слой фильтруется и подписывается в карте; после удаления
+                    # объектов за пределами Lots_"Сокр" и добавления контура перестраиваем пространственный индекс
+                    refresh_indexes(output_path, ["NPP", "LandType", "LandCode"], spatial=not streaming)
                     
-                    except Exception as add_err:
-                        logging.error("Общая ошибка при добавлении слоя в таблицу содержания: {}".format(str(add_err)))
-                        logging.error(traceback.format_exc())
-                        messagebox.showwarning("Предупреждение", 
-                                             "Произошла ошибка при добавлении слоя в таблицу содержания.\n"
-                                             "Пожалуйста, добавьте его вручную из: {}".format(output_path))
+                    # Слой добавляется в таблицу содержания один раз в конце задания (map_updates.flush)
+                    map_updates.add_layer(output_path)
+                    map_updates.save()
                     
                     # Применяем дополнительную обработку участков в самом конце
                     try:
@@ -1394,15 +3247,267 @@ class LabelClassProcessor:
             messagebox.showerror("Ошибка", error_message)
             return False
 
-    def save_named_mxd(self, mxd, output_path, method_name=""):
-        """Сохраняет именованную копию MXD файла на основе пути к выходному классу"""
-        try:
-            # Формируем путь к MXD на основе имени набора данных
-            dataset_path = os.path.dirname(output_path)
-            gdb_path = os.path.dirname(dataset_path)
-            dataset_name = os.path.basename(dataset_path)
-            mxd_path = os.path.join(os.path.dirname(gdb_path), "{}.mxd".format(dataset_name))
-            
+    def harmonize_spatial_reference(self, target_sr):
+        """Заменяет классы надписей в другой системе координат их копиями, заранее
+        перепроецированными в target_sr (LabelProjectionCache), чтобы Identity
+        не проецировал надписи на лету при каждом запуске
+        
+        Returns:
+            int: число замененных классов надписей
+        """
+        if not LABEL_PROJECTION_CACHE:
+            return 0
+        
+        mismatched = []
+        for label_class in self.labels_classes:
+            desc = arcpy.Describe(label_class)
+            if same_spatial_reference(desc.spatialReference, target_sr):
+                continue
+            if getattr(desc, "featureType", "") == "esriFTAnnotation":
+                logging.info("Класс аннотаций %s проецируется на лету", os.path.basename(label_class))
+                continue
+            logging.info("Система координат класса надписей %s (%s) отличается от системы координат Land (%s)",
+                os.path.basename(label_class), desc.spatialReference.name, target_sr.name)
+            mismatched.append(label_class)
+        if not mismatched:
+            return 0
+        
+        cache = LabelProjectionCache()
+        projected = {}
+        with track_stage("label_projection", mismatched, cache.gdb_path,
+                         spatial_reference=target_sr.name) as stage_event:
+            stage_event["counts"]["input"] = len(mismatched)
+            for label_class in mismatched:
+                try:
+                    projected[label_class] = cache.projected(label_class, target_sr)
+                except Exception as e:
+                    logging.warning("Не удалось перепроецировать класс %s, он будет проецироваться на лету: %s",
+                        os.path.basename(label_class), str(e))
+            stage_event["counts"]["output"] = len(projected)
+        
+        self.labels_classes = [projected.get(label_class, label_class) for label_class in self.labels_classes]
+        return len(projected)
+    
+    def choose_join_engine(self, target_fc_path):
+        """Выбирает способ присоединения NPP с учетом NPP_JOIN_ENGINE и геометрии надписей"""
+        if NPP_JOIN_ENGINE != "auto":
+            return NPP_JOIN_ENGINE
+        
+        target_sr = arcpy.Describe(target_fc_path).spatialReference
+        target_mean_area = mean_shape_area(target_fc_path)
+        for label_class in self.labels_classes:
+            desc = arcpy.Describe(label_class)
+            if desc.shapeType in ("Point", "Multipoint") or getattr(desc, "featureType", "") == "esriFTAnnotation":
+                continue
+            if desc.shapeType != "Polygon":
+                return "identity"
+            
+            label_mean_area = mean_shape_area(label_class, target_sr)
+            if target_mean_area <= 0 or label_mean_area > target_mean_area * LABEL_SMALL_POLYGON_RATIO:
+                logging.info("Полигоны класса %s не малы относительно полигонов Land (средняя площадь %.1f и %.1f)",
+                    os.path.basename(label_class), label_mean_area, target_mean_area)
+                return "identity"
+        return "point_in_polygon"
+    
+    def run_npp_stage(self, input_fc, output_path, extent=None, extent_sr=None):
+        """Присоединяет NPP из классов надписей способом self.join_engine
+        и раздробляет составные объекты результата"""
+        self.npp_joined = self.join_engine == "point_in_polygon"
+        if self.npp_joined:
+            NppLabelJoiner(self).run(input_fc, output_path, extent, extent_sr)
+            return
+        
+        self.run_identity_chain(input_fc, output_path, extent, extent_sr)
+        if int(arcpy.GetCount_management(output_path).getOutput(0)) > 0:
+            # Применяем инструмент MultipartToSinglepart (Раздробить составной объект)
+            self.explode_multipart(output_path)
+    
+    def make_label_layer(self, label_class, layer_name, extent=None, extent_sr=None):
+        """Создает слой надписей с фильтром NPP > 0, ограниченный охватом extent
+        
+        Args:
+            extent (tuple): охват (xmin, ymin, xmax, ymax) обрабатываемых объектов или None
+            extent_sr: система координат, в которой задан охват
+        
+        Returns:
+            int: число отобранных надписей; 0 - лист не пересекается с охватом и слой не создан
+        """
+        desc = arcpy.Describe(label_class)
+        field_names = [f.name for f in desc.fields]
+        # Если есть поле NPP, применяем фильтр NPP > 0
+        where_clause = "NPP > 0" if "NPP" in field_names else None
+        
+        if extent is not None:
+            # Быстрая проверка по охвату класса без чтения объектов
+            label_extent = desc.extent
+            if extent_sr is not None and not same_spatial_reference(desc.spatialReference, extent_sr):
+                try:
+                    transformation = geographic_transformation(desc.spatialReference, extent_sr, label_extent)
+                    if transformation:
+                        label_extent = label_extent.projectAs(extent_sr, transformation)
+                    else:
+                        label_extent = label_extent.projectAs(extent_sr)
+                except Exception:
+                    label_extent = None
+            if label_extent is not None and not extents_intersect(
+                    extent, (label_extent.XMin, label_extent.YMin, label_extent.XMax, label_extent.YMax)):
+                return 0
+            
+            if LABEL_SPATIAL_INDEX and not getattr(desc, "hasSpatialIndex", True):
+                arcpy.AddSpatialIndex_management(label_class)
+                logging.info("Построен пространственный индекс класса {}".format(os.path.basename(label_class)))
+        
+        arcpy.MakeFeatureLayer_management(label_class, layer_name, where_clause)
+        if extent is None:
+            return int(arcpy.GetCount_management(layer_name).getOutput(0))
+        
+        # Отбираем только надписи, пересекающие охват обрабатываемых объектов
+        arcpy.SelectLayerByLocation_management(layer_name, "INTERSECT", extent_polygon(extent, extent_sr))
+        fid_set = arcpy.Describe(layer_name).FIDSet
+        if not fid_set:
+            arcpy.Delete_management(layer_name)
+            return 0
+        return len(fid_set.split(";"))
+    
+    def run_identity_chain(self, input_fc, output_path, extent=None, extent_sr=None):
+        """Копирует входной слой в output_path и последовательно выполняет Identity с каждым классом надписей
+        
+        Каждый класс надписей предварительно ограничивается охватом extent (по умолчанию -
+        охватом входного слоя); листы, не пересекающиеся с ним, пропускаются.
+        """
+        # Создаем копию целевого слоя как основу
+        arcpy.CopyFeatures_management(input_fc, output_path)
+        logging.info("Создана копия целевого слоя как основа для Identity: {}".format(output_path))
+        ScratchManager.forget_estimate(output_path)
+        
+        if extent is None:
+            output_desc = arcpy.Describe(output_path)
+            extent = (output_desc.extent.XMin, output_desc.extent.YMin,
+                      output_desc.extent.XMax, output_desc.extent.YMax)
+            extent_sr = output_desc.spatialReference
+        
+        # Обрабатываем каждый класс прошлого тура по очереди
+        applied_count = 0
+        for i, label_class in enumerate(self.labels_classes):
+            # Временные слои и результат листа освобождаются после обработки листа
+            scratch = ScratchManager("identity")
+            try:
+                logging.info("Обработка класса надписей %s/%s: %s",
+                    i+1, len(self.labels_classes), os.path.basename(label_class))
+                
+                # Создаем временный слой для текущего класса надписей
+                temp_label_layer = scratch.layer("temp_label_layer_{}".format(i))
+                label_count = self.make_label_layer(label_class, temp_label_layer, extent, extent_sr)
+                if label_count == 0:
+                    logging.info("Лист %s не пересекается с охватом обрабатываемого слоя, Identity пропущен",
+                        os.path.basename(label_class))
+                    continue
+                logging.info("Отобрано надписей в охвате слоя: %s", label_count)
+                
+                # Создаем временный слой для текущего результата
+                temp_output_layer = scratch.layer("temp_output_layer_{}".format(i))
+                arcpy.MakeFeatureLayer_management(output_path, temp_output_layer)
+                
+                # Создаем временный результат для текущей операции Identity
+                temp_result = scratch.dataset("temp_identity_{}".format(i), [output_path, temp_label_layer])
+                
+                # Выполняем Identity для текущего класса надписей
+                with track_stage("identity", [output_path, label_class], temp_result) as stage_event:
+                    stage_event["counts"]["labels"] = label_count
+                    arcpy.Identity_analysis(
+                        in_features=temp_output_layer,
+                        identity_features=temp_label_layer,
+                        out_feature_class=temp_result,
+                        join_attributes="ALL",
+                        cluster_tolerance="0.001 Meters"
+                    )
+                
+                # Если операция успешна, заменяем текущий результат
+                if arcpy.Exists(temp_result):
+                    # Удаляем предыдущий результат
+                    arcpy.Delete_management(output_path)
+                    # Копируем новый результат
+                    arcpy.CopyFeatures_management(temp_result, output_path)
+                    # Результат растет с каждым листом: следующий лист оценивает его заново
+                    ScratchManager.forget_estimate(output_path)
+                    applied_count += 1
+                    logging.info("Успешно выполнена операция Identity с классом %s",
+                        os.path.basename(label_class))
+            
+            except Exception as e:
+                logging.error("Ошибка при обработке класса %s: %s",
+                    os.path.basename(label_class), str(e))
+                logging.error(traceback.format_exc())
+            finally:
+                # Очищаем временные данные
+                scratch.release()
+        
+        if applied_count == 0 and "NPP" not in [f.name for f in arcpy.ListFields(output_path)]:
+            # Ни один лист не пересекся со слоем - добавляем пустое поле NPP, чтобы схема
+            # результата совпадала с результатом обработки других тайлов
+            arcpy.AddField_management(output_path, "NPP", "SHORT")
+            logging.info("Ни один класс надписей не пересекается со слоем, добавлено пустое поле NPP")
+    
+    def explode_multipart(self, output_path):
+        """Раздробляет составные объекты слоя output_path на месте
+        
+        Первая часть составного объекта остается в исходной строке, остальные части
+        добавляются курсором вставки с теми же атрибутами. Однокомпонентные объекты
+        не переписываются, а класс не пересоздается через временную копию.
+        """
+        try:
+            logging.info("Применение инструмента 'Раздробить составной объект' к слою {}".format(output_path))
+            
+            desc = arcpy.Describe(output_path)
+            spatial_reference = desc.spatialReference
+            field_names = ["SHAPE@"] + [f.name for f in desc.fields
+                                        if f.editable and f.type not in ("OID", "Geometry")]
+            
+            # Дополнительные части составных объектов; обычно их немного по сравнению с числом строк
+            extra_rows = []
+            source_count = 0
+            multipart_count = 0
+            with arcpy.da.UpdateCursor(output_path, field_names) as cursor:
+                for row in cursor:
+                    source_count += 1
+                    shape = row[0]
+                    if shape is None or not shape.isMultipart or shape.partCount < 2:
+                        continue
+                    
+                    parts = [arcpy.Polygon(shape.getPart(i), spatial_reference, desc.hasZ, desc.hasM)
+                             for i in range(shape.partCount)]
+                    row[0] = parts[0]
+                    cursor.updateRow(row)
+                    for part in parts[1:]:
+                        extra_rows.append([part] + list(row[1:]))
+                    multipart_count += 1
+            
+            if extra_rows:
+                with arcpy.da.InsertCursor(output_path, field_names) as cursor:
+                    for row in extra_rows:
+                        cursor.insertRow(row)
+            
+            singlepart_count = source_count + len(extra_rows)
+            logging.info("Раздроблено составных объектов: {}, после раздробления слой содержит {} объектов".format(
+                multipart_count, singlepart_count))
+            logging.info("Инструмент 'Раздробить составной объект' успешно применен")
+            return singlepart_count
+        except Exception as multipart_err:
+            logging.error("Ошибка при применении инструмента 'Раздробить составной объект': {}".format(str(multipart_err)))
+            logging.error(traceback.format_exc())
+            messagebox.showwarning("Предупреждение", 
+                                "Ошибка при применении инструмента 'Раздробить составной объект':\n{}".format(str(multipart_err)))
+            return None
+
+    def save_named_mxd(self, mxd, output_path, method_name=""):
+        """Сохраняет именованную копию MXD файла на основе пути к выходному классу"""
+        try:
+            # Формируем путь к MXD на основе имени набора данных
+            dataset_path = os.path.dirname(output_path)
+            gdb_path = os.path.dirname(dataset_path)
+            dataset_name = os.path.basename(dataset_path)
+            mxd_path = os.path.join(os.path.dirname(gdb_path), "{}.mxd".format(dataset_name))
+            
             # Сохраняем копию карты
             mxd.saveACopy(mxd_path)
             logging.info("Сохранена копия карты с добавленным слоем сетки{}: {}".format(
@@ -1438,6 +3543,13 @@ class LabelClassProcessor:
                 messagebox.showwarning("Предупреждение", "Не найдено полей NPP для обработки в слое")
                 return False
             
+            # Если NPP записано NppLabelJoiner (присоединение без наложения), объединять нечего.
+            # Единственное поле NPP после Identity по одному листу так не обрабатывается:
+            # в нем остаются нули, которые объединение ниже заменяет на пустые значения
+            if self.npp_joined and npp_fields == ["NPP"]:
+                logging.info("Поле NPP уже содержит итоговые значения, объединение полей NPP не требуется")
+                return self.finish_fields(output_path, fields, "NPP")
+            
             # Создаем новое поле NPP_Combined для объединения данных - типа Short Integer
             new_field_name = "NPP_Combined"
             try:
@@ -1483,6 +3595,21 @@ class LabelClassProcessor:
                 messagebox.showerror("Ошибка", "Не удалось скопировать данные из полей NPP: {}".format(str(update_err)))
                 return False
             
+            return self.finish_fields(output_path, fields, new_field_name)
+            
+        except Exception as e:
+            error_message = "Общая ошибка при обработке полей: {}".format(str(e))
+            logging.error(error_message)
+            log_exception(e, "Ошибка при обработке полей в слое")
+            messagebox.showerror("Ошибка", error_message)
+            return False
+    
+    def finish_fields(self, output_path, fields, new_field_name):
+        """Завершает обработку полей: удаляет лишние поля, переименовывает new_field_name в NPP
+        и очищает NPP там, где LandType не входит в список разрешенных"""
+        try:
+            field_names = [field.name for field in fields]
+            
             # Определяем список полей для сохранения
             system_fields = ["OBJECTID", "Shape", "SHAPE", "FID", "OID", "SHAPE_Length", "SHAPE_Area"]
             # Добавляем LandType и LandCode в список сохраняемых полей
@@ -1498,28 +3625,29 @@ class LabelClassProcessor:
                 if fields_to_delete:
                     logging.info("Удаление {} лишних полей: {}".format(len(fields_to_delete), ", ".join(fields_to_delete[:10]) + ("..." if len(fields_to_delete) > 10 else "")))
                     arcpy.DeleteField_management(output_path, fields_to_delete)
-                    logging.info("Удалены все лишние поля, оставлены только NPP_Combined, LandType, LandCode и системные поля")
+                    logging.info("Удалены все лишние поля, оставлены только {}, LandType, LandCode и системные поля".format(new_field_name))
                 else:
                     logging.info("Нет полей для удаления")
             except Exception as del_field_err:
                 logging.error("Ошибка при удалении лишних полей: {}".format(str(del_field_err)))
                 messagebox.showwarning("Предупреждение", "Не удалось удалить все лишние поля: {}".format(str(del_field_err)))
             
-            # Переименовываем поле NPP_Combined в NPP
+            # Переименовываем поле NPP_Combined в NPP (если поле уже называется NPP, переименование не нужно)
             try:
-                # Проверяем, нет ли уже поля NPP
-                if "NPP" in field_names and "NPP" != new_field_name:
-                    logging.info("Поле NPP уже существует, удаляем его")
-                    arcpy.DeleteField_management(output_path, "NPP")
-                
-                # Переименовываем NPP_Combined в NPP
-                arcpy.AlterField_management(
-                    output_path,
-                    new_field_name,
-                    "NPP",
-                    "NPP"
-                )
-                logging.info("Поле {} переименовано в NPP".format(new_field_name))
+                if new_field_name != "NPP":
+                    # Проверяем, нет ли уже поля NPP
+                    if "NPP" in field_names:
+                        logging.info("Поле NPP уже существует, удаляем его")
+                        arcpy.DeleteField_management(output_path, "NPP")
+                    
+                    # Переименовываем NPP_Combined в NPP
+                    arcpy.AlterField_management(
+                        output_path,
+                        new_field_name,
+                        "NPP",
+                        "NPP"
+                    )
+                    logging.info("Поле {} переименовано в NPP".format(new_field_name))
             except Exception as rename_err:
                 logging.error("Ошибка при переименовании поля {} в NPP: {}".format(new_field_name, str(rename_err)))
                 logging.info("Пробуем альтернативный метод переименования")
@@ -1539,30 +3667,25 @@ class LabelClassProcessor:
                 # Определяем имя поля NPP (это может быть NPP или NPP_Combined, в зависимости от того, удалось ли переименование)
                 npp_field_name = "NPP" if "NPP" in [f.name for f in arcpy.ListFields(output_path)] else new_field_name
                 
-                # Проверяем наличие поля LandType
-                if "LandType" in [f.name for f in arcpy.ListFields(output_path)]:
-                    logging.info("Начало очистки поля NPP на основе значений LandType")
-                    
-                    # Разрешенные значения LandType, при которых NPP не очищается
-                    allowed_types = [101, 102, 103]
-                    logging.info("Разрешенные значения LandType: {}".format(", ".join(map(str, allowed_types))))
+                # Проверяем наличие полей, используемых правилом очистки
+                npp_rule = get_rule("npp_clear")
+                existing_fields = [f.name for f in arcpy.ListFields(output_path)]
+                missing_fields = [name for name in npp_rule.fields if name not in existing_fields]
+                if not missing_fields:
+                    logging.info("Начало очистки поля NPP по правилу npp_clear: {}".format(npp_rule.where_clause()))
                     
-                    # Создаем курсор обновления с полями NPP и LandType
+                    # Курсор обновления читает только объекты, у которых NPP нужно очистить
                     cleared_count = 0
-                    with arcpy.da.UpdateCursor(output_path, [npp_field_name, "LandType"]) as cursor:
+                    with arcpy.da.UpdateCursor(output_path, [npp_field_name], npp_rule.where_clause()) as cursor:
                         for row in cursor:
-                            npp_value = row[0]
-                            land_type = row[1]
-                            
-                            # Если LandType не входит в список разрешенных, очищаем NPP
-                            if land_type is not None and land_type not in allowed_types:
+                            if row[0] is not None:
                                 row[0] = None  # Устанавливаем NPP в NULL
                                 cursor.updateRow(row)
                                 cleared_count += 1
                     
-                    logging.info("Очищено {} значений в поле NPP, где LandType не входит в список разрешенных".format(cleared_count))
+                    logging.info("Очищено {} значений в поле NPP по правилу npp_clear".format(cleared_count))
                 else:
-                    logging.warning("Поле LandType не найдено, очистка NPP не выполнена")
+                    logging.warning("Поля {} не найдены, очистка NPP не выполнена".format(", ".join(missing_fields)))
             except Exception as clear_err:
                 logging.error("Ошибка при очистке поля NPP на основе LandType: {}".format(str(clear_err)))
                 messagebox.showwarning("Предупреждение", "Не удалось выполнить очистку поля NPP на основе LandType: {}".format(str(clear_err)))
@@ -1577,12 +3700,115 @@ class LabelClassProcessor:
             messagebox.showerror("Ошибка", error_message)
             return False
 
+    def validate_pipeline(self, target_fc_path, output_path):
+        """Собирает сетку прежним способом во временный класс и сравнивает с результатом
+        потокового конвейера (PIPELINE_VALIDATE)"""
+        legacy_path = output_path + "_проверка"
+        try:
+            if arcpy.Exists(legacy_path):
+                arcpy.Delete_management(legacy_path)
+            with track_stage("pipeline_validate", [target_fc_path, output_path], legacy_path) as stage_event:
+                self.run_npp_stage(target_fc_path, legacy_path)
+                if int(arcpy.GetCount_management(legacy_path).getOutput(0)) > 0:
+                    self.process_fields(legacy_path)
+                    self.filter_by_lots_boundary(legacy_path)
+                    self.copy_contour_to_grid(target_fc_path, legacy_path)
+                comparison = compare_grid_outputs(legacy_path, output_path)
+                stage_event["counts"]["output"] = comparison["actual_count"]
+                stage_event["comparison"] = comparison
+            
+            if comparison["equal"]:
+                logging.info("Проверка потоковой сборки: результат совпадает с прежним способом ({} объектов)".format(
+                    comparison["actual_count"]))
+            else:
+                logging.warning("Проверка потоковой сборки: расхождения с прежним способом - объектов {} и {}, "
+                                "отсутствует {}, лишних {}, площадь {:.2f} и {:.2f}".format(
+                                    comparison["expected_count"], comparison["actual_count"],
+                                    comparison["missing"], comparison["extra"],
+                                    comparison["expected_area"], comparison["actual_area"]))
+            return comparison["equal"]
+        except Exception as e:
+            logging.error("Ошибка при проверке потоковой сборки: {}".format(str(e)))
+            logging.error(traceback.format_exc())
+            return False
+        finally:
+            if arcpy.Exists(legacy_path):
+                arcpy.Delete_management(legacy_path)
+    
+    def contour_path_for(self, target_fc_path):
+        """Возвращает путь к Land_"Сокр"_контур в наборе данных входного слоя"""
+        land_contour_name = os.path.basename(target_fc_path)
+        
+        # Убеждаемся, что это Land_"Сокр"
+        if not land_contour_name.endswith("_контур"):
+            # Если входной слой был Land_"Сокр", то формируем имя для Land_"Сокр"_контур
+            land_contour_name = land_contour_name + "_контур"
+        
+        return os.path.join(os.path.dirname(target_fc_path), land_contour_name)
+    
+    def copy_contour_to_grid(self, target_fc_path, output_path):
+        """Копирует данные из Land_"Сокр"_контур в Land_"Сокр"_сетка"""
+        try:
+            logging.info("Копирование данных из Land_\"Сокр\"_контур в Land_\"Сокр\"_сетка...")
+            
+            # Ищем путь к Land_"Сокр"_контур
+            land_contour_path = self.contour_path_for(target_fc_path)
+            
+            if arcpy.Exists(land_contour_path):
+                logging.info("Найден класс Land_\"Сокр\"_контур: {}".format(land_contour_path))
+                
+                # Переносим объекты курсорами напрямую в Land_"Сокр"_сетка (NPP остается пустым)
+                with track_stage("contour_append", [land_contour_path], output_path) as stage_event:
+                    contour_count = self.append_contour_features(land_contour_path, output_path)
+                    stage_event["counts"]["input"] = contour_count
+                
+                if contour_count > 0:
+                    logging.info("Скопировано {} объектов из Land_\"Сокр\"_контур в Land_\"Сокр\"_сетка".format(contour_count))
+                else:
+                    logging.info("Land_\"Сокр\"_контур не содержит объектов для копирования")
+            else:
+                logging.warning("Не найден класс Land_\"Сокр\"_контур: {}".format(land_contour_path))
+                messagebox.showwarning("Предупреждение", 
+                                     "Не найден класс Land_\"Сокр\"_контур для копирования данных")
+        
+        except Exception as copy_err:
+            logging.error("Ошибка при копировании данных из Land_\"Сокр\"_контур: {}".format(str(copy_err)))
+            logging.error(traceback.format_exc())
+            messagebox.showwarning("Предупреждение", 
+                                 "Ошибка при копировании данных из Land_\"Сокр\"_контур:\n{}".format(str(copy_err)))
+    
+    def append_contour_features(self, contour_path, output_path):
+        """Дописывает объекты Land_"Сокр"_контур в Land_"Сокр"_сетка курсором вставки
+        
+        Переносятся геометрия и поля, имеющиеся в обоих классах (как при Append с NO_TEST);
+        поля сетки, которых нет в контуре (NPP), остаются пустыми.
+        
+        Returns:
+            int: количество перенесенных объектов
+        """
+        skip_types = ("OID", "Geometry", "GlobalID", "Raster", "Blob")
+        output_fields = set(f.name.upper() for f in arcpy.ListFields(output_path)
+                            if f.editable and f.type not in skip_types)
+        fields = [f.name for f in arcpy.ListFields(contour_path)
+                  if f.editable and f.type not in skip_types and f.name.upper() in output_fields]
+        logging.info("Поля, переносимые из контура: {}".format(", ".join(fields)))
+        
+        cursor_fields = ["SHAPE@"] + fields
+        count = 0
+        with arcpy.da.SearchCursor(contour_path, cursor_fields) as search_cursor:
+            with arcpy.da.InsertCursor(output_path, cursor_fields) as insert_cursor:
+                for row in search_cursor:
+                    insert_cursor.insertRow(row)
+                    count += 1
+        return count
+    
     def filter_by_lots_boundary(self, grid_path):
         """Сравнивает объекты Land_"Сокр"_сетка с границами Lots_"Сокр" и удаляет объекты за пределами контура
         
         Args:
             grid_path (str): Путь к слою Land_"Сокр"_сетка
         """
+        scratch = ScratchManager("lots_filter")
         try:
             logging.info("Начало сравнения слоя Land_\"Сокр\"_сетка с границами Lots_\"Сокр\"")
             
@@ -1603,8 +3829,8 @@ class LabelClassProcessor:
             logging.info("Найден класс Lots_\"Сокр\": {}".format(lots_path))
             
             # Создаем временные слои для работы
-            grid_layer = "temp_grid_layer"
-            lots_layer = "temp_lots_layer"
+            grid_layer = scratch.layer("temp_grid_layer")
+            lots_layer = scratch.layer("temp_lots_layer")
             
             # Создаем временный слой для Lots_"Сокр"
             arcpy.MakeFeatureLayer_management(lots_path, lots_layer)
@@ -1614,12 +3840,8 @@ class LabelClassProcessor:
             arcpy.MakeFeatureLayer_management(grid_path, grid_layer)
             logging.info("Создан временный слой для Land_\"Сокр\"_сетка")
             
-            # Коды LandCode, которые нужно проверять за пределами контура
-            target_codes = [123, 3, 6, 7]
-            logging.info("Целевые коды LandCode для проверки за пределами контура: {}".format(", ".join(map(str, target_codes))))
-            
-            # Строим SQL-выражение для выборки целевых кодов
-            land_code_clause = "LandCode IN ({})".format(",".join(map(str, target_codes)))
+            # Объекты, которые нужно проверять за пределами контура (правило outside_lots_drop)
+            land_code_clause = get_rule("outside_lots_drop").where_clause()
             logging.info("SQL-выражение для выборки: {}".format(land_code_clause))
             
             # Выбираем объекты с целевыми кодами LandCode
@@ -1638,9 +3860,10 @@ class LabelClassProcessor:
                 return True
             
             # Создаем временный слой для хранения только объектов с целевыми кодами
-            target_codes_layer = "temp_target_codes_layer"
-            arcpy.CopyFeatures_management(grid_layer, "in_memory\\target_codes_objects")
-            arcpy.MakeFeatureLayer_management("in_memory\\target_codes_objects", target_codes_layer)
+            target_codes_layer = scratch.layer("temp_target_codes_layer")
+            target_codes_objects = scratch.dataset("target_codes_objects", [grid_layer])
+            arcpy.CopyFeatures_management(grid_layer, target_codes_objects)
+            arcpy.MakeFeatureLayer_management(target_codes_objects, target_codes_layer)
             logging.info("Создан временный слой только с объектами целевых кодов")
             
             # Выбираем объекты с целевыми кодами, которые пересекаются с Lots_"Сокр"
@@ -1664,13 +3887,12 @@ class LabelClassProcessor:
             
             if outside_count == 0:
                 logging.info("Нет объектов с целевыми кодами за пределами контура Lots_\"Сокр\"")
-                arcpy.Delete_management("in_memory\\target_codes_objects")
-                arcpy.Delete_management(target_codes_layer)
                 return True
             
             # Теперь выберем эти же объекты в исходном слое grid_layer
             # Создаем временную таблицу с идентификаторами объектов для удаления
-            arcpy.CopyFeatures_management(target_codes_layer, "in_memory\\objects_to_delete")
+            objects_to_delete = scratch.dataset("objects_to_delete", [target_codes_layer])
+            arcpy.CopyFeatures_management(target_codes_layer, objects_to_delete)
             
             # Очищаем текущую выборку в grid_layer
             arcpy.SelectLayerByAttribute_management(grid_layer, "CLEAR_SELECTION")
@@ -1679,7 +3901,7 @@ class LabelClassProcessor:
             arcpy.SelectLayerByLocation_management(
                 grid_layer,
                 "ARE_IDENTICAL_TO",  # Объекты должны быть идентичны
-                "in_memory\\objects_to_delete",
+                objects_to_delete,
                 "#",  # Дистанция поиска
                 "NEW_SELECTION"  # Создаем новую выборку
             )
@@ -1690,19 +3912,12 @@ class LabelClassProcessor:
             
             # Удаляем выбранные объекты с целевыми кодами, находящиеся за пределами контура
             arcpy.DeleteFeatures_management(grid_layer)
-            logging.info("Удалено {} объектов с кодами {} за пределами контура Lots_\"Сокр\"".format(
-                to_delete_count, ", ".join(map(str, target_codes))))
+            logging.info("Удалено {} объектов ({}) за пределами контура Lots_\"Сокр\"".format(
+                to_delete_count, land_code_clause))
             
             # Снимаем выборку
             arcpy.SelectLayerByAttribute_management(grid_layer, "CLEAR_SELECTION")
             
-            # Очищаем временные слои и данные
-            arcpy.Delete_management("in_memory\\target_codes_objects")
-            arcpy.Delete_management("in_memory\\objects_to_delete")
-            arcpy.Delete_management(target_codes_layer)
-            arcpy.Delete_management(grid_layer)
-            arcpy.Delete_management(lots_layer)
-            
             # Обновляем количество объектов после удаления
             final_count = int(arcpy.GetCount_management(grid_path).getOutput(0))
             logging.info("Итоговое количество объектов в слое Land_\"Сокр\"_сетка после фильтрации: {}".format(final_count))
@@ -1715,6 +3930,9 @@ class LabelClassProcessor:
             log_exception(e, "Ошибка при фильтрации объектов за границами контура")
             messagebox.showwarning("Предупреждение", error_message)
             return False
+        finally:
+            # Очищаем временные слои и данные
+            scratch.release()
 
 class ValueSelector:
     def __init__(self, master, gdb_path):
@@ -1739,34 +3957,17 @@ class ValueSelector:
         
         # Инструкция
         self.instruction = tk.Label(self.main_frame,
-                                  text="Дважды щелкните на элементе списка или выделите элемент и нажмите кнопку 'Выбрать'",
+                                  text="Введите часть названия для поиска. Дважды щелкните на элементе списка\nили выделите элемент и нажмите кнопку 'Выбрать'",
                                   font=("Arial", 9),
                                   fg="blue")
         self.instruction.pack(pady=5)
         
-        # Фрейм для списка
-        self.list_frame = tk.Frame(self.main_frame)
-        self.list_frame.pack(fill=tk.BOTH, expand=True, pady=10)
-        
-        # Скроллбар для списка
-        self.scrollbar = tk.Scrollbar(self.list_frame)
-        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        
-        # Список значений
-        self.listbox = tk.Listbox(self.list_frame, 
-                                 yscrollcommand=self.scrollbar.set,
-                                 font=("Arial", 10),
-                                 height=15,
-                                 width=70,
-                                 selectmode=tk.SINGLE)
-        self.listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-        self.scrollbar.config(command=self.listbox.yview)
+        # Список значений с поиском (в списке находятся только видимые строки)
+        self.value_list = VirtualList(self.main_frame, height=15, width=70, selectmode=tk.SINGLE)
+        self.value_list.pack(fill=tk.BOTH, expand=True, pady=10)
         
         # Привязка двойного клика для выбора
-        self.listbox.bind('<Double-1>', lambda event: self.select_value())
-        
-        # Привязка клавиши Enter для выбора
-        self.listbox.bind('<Return>', lambda event: self.select_value())
+        self.value_list.listbox.bind('<Double-1>', lambda event: self.select_value())
         
         # Привязка обработки нажатия клавиши Enter для всего окна
         self.master.bind('<Return>', lambda event: self.select_value())
@@ -1803,8 +4004,8 @@ class ValueSelector:
         # Заполнить список значениями
         self.load_values()
         
-        # Фокус на список
-        self.listbox.focus_set()
+        # Фокус на строку поиска
+        self.value_list.focus_search()
     
     def load_values(self):
         if not ARCPY_AVAILABLE:
@@ -1850,8 +4051,7 @@ class ValueSelector:
             sorted_values = sorted(values)
             
             # Добавляем в список
-            for value in sorted_values:
-                self.listbox.insert(tk.END, value)
+            self.value_list.set_items(sorted_values)
                 
         except Exception as e:
             messagebox.showerror("Ошибка", "Не удалось загрузить значения: {}".format(str(e)))
@@ -1859,29 +4059,631 @@ class ValueSelector:
     
     def select_value(self):
         # Получить выбранное значение
-        selection = self.listbox.curselection()
+        selection = self.value_list.selection()
         if not selection:
             messagebox.showwarning("Предупреждение", "Пожалуйста, выберите значение из списка")
             return
         
         # Получить выбранное значение
-        self.selected_value = self.listbox.get(selection[0])
+        self.selected_value = selection[0]
         
-        # Запросить сокращенное название
+        # Запросить сокращенное название (предлагается сокращение из таблицы или выведенное автоматически)
+        short_names = read_short_names()
+        suggested = short_names.get(to_text(self.selected_value)) or derive_short_name(self.selected_value, short_names.values())
         short_name = simpledialog.askstring(
             "Ввод сокращения", 
             "Введите сокращенное название для '{}'".format(self.selected_value),
+            initialvalue=suggested,
             parent=self.master
         )
         
         if short_name:
-            self.shortened_name = short_name
+            self.shortened_name = short_name.strip()
+            try:
+                remember_short_name(self.selected_value, self.shortened_name)
+            except (IOError, OSError) as e:
+                logging.warning("Не удалось сохранить таблицу сокращений: {}".format(str(e)))
             messagebox.showinfo("Успех", 
                                 "Выбрано: {}\nСокращение: {}".format(self.selected_value, self.shortened_name))
             self.master.destroy()
         else:
             messagebox.showwarning("Предупреждение", "Необходимо ввести сокращенное название")
 
+def dataset_name_for(selected_value):
+    """Имя набора данных лесничества: "_" + UsName_1, пробелы заменены на "_", кавычки удалены"""
+    cleaned_usname = selected_value.replace(" ", "_").replace("\"", "").replace("'", "")
+    return "_{}".format(cleaned_usname)
+
+def derive_short_name(selected_value, taken=()):
+    """Детерминированное сокращение UsName_1 для имен выходных классов: первое значимое слово
+    (без кавычек и слов SHORT_NAME_STOP_WORDS), обрезанное до SHORT_NAME_LENGTH символов,
+    и первые буквы остальных значимых слов. Если сокращение уже занято (taken), добавляется номер"""
+    words = [word for word in re.split(r"[^\w]+", to_text(selected_value), flags=re.UNICODE) if word]
+    significant = [word for word in words if word.lower() not in SHORT_NAME_STOP_WORDS] or words or ["Лесничество"]
+    base = significant[0][:SHORT_NAME_LENGTH] + "".join(word[0].upper() for word in significant[1:])
+    taken = set(taken)
+    short_name = base
+    suffix = 2
+    while short_name in taken:
+        short_name = "{}{}".format(base, suffix)
+        suffix += 1
+    return short_name
+
+def read_short_names():
+    """Таблица сокращений из SHORT_NAMES_FILE; поврежденный файл считается пустым"""
+    if not os.path.exists(SHORT_NAMES_FILE):
+        return {}
+    try:
+        with io.open(SHORT_NAMES_FILE, "r", encoding="utf-8-sig") as names_file:
+            return dict((to_text(value), to_text(short)) for value, short in json.load(names_file).items() if short)
+    except (ValueError, AttributeError):
+        logging.warning("Таблица сокращений {} повреждена и будет перезаписана".format(SHORT_NAMES_FILE))
+        return {}
+
+def write_short_names(short_names):
+    text = to_text(json.dumps(short_names, ensure_ascii=False, indent=1, sort_keys=True))
+    with io.open(SHORT_NAMES_FILE, "w", encoding="utf-8") as names_file:
+        names_file.write(text)
+
+def short_name_for(selected_value, short_names=None):
+    """Сокращение лесничества из таблицы сокращений; для нового лесничества выводится
+    derive_short_name (без совпадения с сокращениями других лесничеств) и добавляется в таблицу"""
+    short_names = read_short_names() if short_names is None else short_names
+    value = to_text(selected_value)
+    if value not in short_names:
+        short_names[value] = derive_short_name(value, short_names.values())
+        logging.info("Сокращение для '{}' выведено автоматически: {}".format(value, short_names[value]))
+        write_short_names(short_names)
+    return short_names[value]
+
+def remember_short_name(selected_value, shortened_name):
+    """Сохраняет сокращение, указанное пользователем или в файле заданий, в таблице сокращений"""
+    short_names = read_short_names()
+    value = to_text(selected_value)
+    shortened_name = to_text(shortened_name)
+    if short_names.get(value) == shortened_name:
+        return
+    others = [other for other, short in short_names.items() if short == shortened_name and other != value]
+    if others:
+        logging.warning("Сокращение {} уже используется для лесничеств: {}".format(shortened_name, ", ".join(others)))
+    short_names[value] = shortened_name
+    write_short_names(short_names)
+
+# Разбиение Lots по лесничествам: {(путь к Lots, UsName_1): {"path": класс участков, "count": N}}
+lots_partition_cache = {}
+
+class LotsPartitioner:
+    """Извлечение участков нескольких лесничеств из Lots за один проход курсора.
+    
+    Вместо Select_analysis с UsName_1 = '<значение>' на каждое лесничество Lots читается
+    один раз с отбором UsName_1 IN (...), а строки раскладываются курсорами вставки
+    по классам лесничеств во временной GDB. Разбиение сохраняется в lots_partition_cache,
+    и DataProcessor.process_data копирует готовый класс вместо нового просмотра Lots.
+    """
+    value_field = "UsName_1"
+    scratch_gdb = None
+    
+    def __init__(self, lots_path):
+        self.lots_path = lots_path
+    
+    @classmethod
+    def workspace(cls):
+        """Временная GDB для классов разбиения (одна на процесс, удаляется при выходе)"""
+        if cls.scratch_gdb is None or not arcpy.Exists(cls.scratch_gdb):
+            scratch_root = tempfile.mkdtemp(prefix="lots_partition_", dir=arcpy.env.scratchFolder or None)
+            arcpy.CreateFileGDB_management(scratch_root, "lots_partition.gdb")
+            cls.scratch_gdb = os.path.join(scratch_root, "lots_partition.gdb")
+            atexit.register(shutil.rmtree, scratch_root, True)
+        return cls.scratch_gdb
+    
+    def partition(self, values):
+        """Раскладывает участки лесничеств values по отдельным классам за один проход по Lots
+        
+        Returns:
+            dict: {UsName_1: количество участков}
+        """
+        pending = []
+        for value in values:
+            if (self.lots_path, value) not in lots_partition_cache and value not in pending:
+                pending.append(value)
+        if not pending:
+            return dict((value, lots_partition_cache[(self.lots_path, value)]["count"]) for value in values)
+        
+        desc = arcpy.Describe(self.lots_path)
+        fields = [f.name for f in desc.fields if f.editable and f.type not in ("OID", "Geometry", "GlobalID")]
+        value_names = [name for name in fields if name.upper() == self.value_field.upper()]
+        if not value_names:
+            raise ValueError("В классе {} нет поля {}".format(self.lots_path, self.value_field))
+        value_index = fields.index(value_names[0]) + 1
+        cursor_fields = ["SHAPE@"] + fields
+        
+        gdb_path = self.workspace()
+        outputs = {}
+        for value in pending:
+            out_name = "lots_{}".format(len(lots_partition_cache) + len(outputs))
+            arcpy.CreateFeatureclass_management(gdb_path, out_name, desc.shapeType.upper(), template=self.lots_path,
+                                                has_m="ENABLED" if desc.hasM else "DISABLED",
+                                                has_z="ENABLED" if desc.hasZ else "DISABLED",
+                                                spatial_reference=desc.spatialReference)
+            outputs[value] = os.path.join(gdb_path, out_name)
+        
+        where_clause = "{} IN ({})".format(arcpy.AddFieldDelimiters(self.lots_path, value_names[0]),
+                                           FilterRule.sql_values(pending))
+        logging.info("Разбиение Lots по {} лесничествам за один проход: {}".format(len(pending), where_clause))
+        
+        counts = dict((value, 0) for value in pending)
+        cursors = {}
+        try:
+            for value in pending:
+                cursors[value] = arcpy.da.InsertCursor(outputs[value], cursor_fields)
+            with arcpy.da.SearchCursor(self.lots_path, cursor_fields, where_clause) as search_cursor:
+                for row in search_cursor:
+                    value = row[value_index]
+                    if value in cursors:
+                        cursors[value].insertRow(row)
+                        counts[value] += 1
+        finally:
+            # Курсоры вставки освобождают классы при удалении последней ссылки
+            cursors.clear()
+        
+        for value in pending:
+            lots_partition_cache[(self.lots_path, value)] = {"path": outputs[value], "count": counts[value]}
+            logging.info("Лесничество '%s': %s участков", value, counts[value])
+        return dict((value, lots_partition_cache[(self.lots_path, value)]["count"]) for value in values)
+
+# Пустые классы, созданные заранее в наборах данных пула и выданные заданию: {путь к классу}
+provisioned_outputs = set()
+
+class DatasetPool:
+    """Пул заранее созданных наборов данных по шаблону "Копия".
+    
+    provision создает наборы _pool_<N> с пространственной привязкой "Копия" и пустыми
+    классами итоговых схем: контур (схема Lots) и сетка (LandType, LandCode, NPP).
+    claim переименовывает свободный набор и его классы в имена задания, поэтому
+    DataProcessor.process_data не описывает "Копия" и не создает набор и классы заново.
+    """
+    prefix = "_pool_"
+    contour_suffix = "_контур"
+    grid_suffix = "_сетка"
+    
+    def __init__(self, gdb_path, template_name="Копия"):
+        self.gdb_path = gdb_path
+        self.template_name = template_name
+    
+    def free_datasets(self):
+        """Свободные наборы данных пула в порядке номеров"""
+        previous_workspace = arcpy.env.workspace
+        try:
+            arcpy.env.workspace = self.gdb_path
+            datasets = arcpy.ListDatasets("{}*".format(self.prefix), "Feature") or []
+        finally:
+            arcpy.env.workspace = previous_workspace
+        numbered = [name for name in datasets if name[len(self.prefix):].isdigit()]
+        return sorted(numbered, key=lambda name: int(name[len(self.prefix):]))
+    
+    def class_names(self, dataset_name):
+        """Имена пустых классов контура и сетки в наборе пула (уникальны в пределах базы)"""
+        base = "pool_{}".format(dataset_name[len(self.prefix):])
+        return base + self.contour_suffix, base + self.grid_suffix
+    
+    def provision(self, count):
+        """Дополняет пул до count свободных наборов данных
+        
+        Returns:
+            int: число свободных наборов после пополнения
+        """
+        free = self.free_datasets()
+        if len(free) >= count:
+            return len(free)
+        
+        template_path = os.path.join(self.gdb_path, self.template_name)
+        if not arcpy.Exists(template_path):
+            logging.warning("Набор данных '{}' не найден, пул наборов не создан".format(self.template_name))
+            return len(free)
+        lots_path = find_feature_class(self.gdb_path, "Lots")
+        land_path = find_feature_class(self.gdb_path, "Land")
+        if not lots_path or not land_path:
+            logging.warning("Классы 'Lots' и 'Land' не найдены, пул наборов не создан")
+            return len(free)
+        
+        spatial_reference = arcpy.Describe(template_path).spatialReference
+        lots_desc = arcpy.Describe(lots_path)
+        number = max([int(name[len(self.prefix):]) for name in free] or [0])
+        while len(free) < count:
+            number += 1
+            dataset_name = "{}{}".format(self.prefix, number)
+            if arcpy.Exists(os.path.join(self.gdb_path, dataset_name)):
+                continue
+            arcpy.CreateFeatureDataset_management(self.gdb_path, dataset_name, spatial_reference)
+            dataset_path = os.path.join(self.gdb_path, dataset_name)
+            contour_name, grid_name = self.class_names(dataset_name)
+            arcpy.CreateFeatureclass_management(dataset_path, contour_name, lots_desc.shapeType.upper(),
+                                                template=lots_path,
+                                                has_m="ENABLED" if lots_desc.hasM else "DISABLED",
+                                                has_z="ENABLED" if lots_desc.hasZ else "DISABLED",
+                                                spatial_reference=spatial_reference)
+            create_grid_class(land_path, os.path.join(dataset_path, grid_name), spatial_reference)
+            free.append(dataset_name)
+            logging.info("Создан набор данных пула: %s", dataset_name)
+        return len(free)
+    
+    def claim(self, new_dataset_name, shortened_name):
+        """Переименовывает свободный набор пула в new_dataset_name, а его классы - в
+        Lots_"Сокр"_контур и Land_"Сокр"_сетка
+        
+        Returns:
+            str: путь к набору данных или None, если свободных наборов нет
+        """
+        free = self.free_datasets()
+        if not free:
+            return None
+        
+        dataset_name = free[0]
+        contour_name, grid_name = self.class_names(dataset_name)
+        new_dataset_path = os.path.join(self.gdb_path, new_dataset_name)
+        claimed = [(contour_name, "Lots_{}_контур".format(shortened_name)),
+                   (grid_name, "Land_{}_сетка".format(shortened_name))]
+        try:
+            arcpy.Rename_management(os.path.join(self.gdb_path, dataset_name), new_dataset_path, "FeatureDataset")
+            for old_name, new_name in claimed:
+                new_path = os.path.join(new_dataset_path, new_name)
+                arcpy.Rename_management(os.path.join(new_dataset_path, old_name), new_path, "FeatureClass")
+                provisioned_outputs.add(new_path)
+        except Exception as e:
+            logging.warning("Не удалось взять набор данных '{}' из пула: {}".format(dataset_name, str(e)))
+            # Частично переименованный набор удаляется, чтобы набор задания был создан заново
+            for old_name, new_name in claimed:
+                provisioned_outputs.discard(os.path.join(new_dataset_path, new_name))
+            if arcpy.Exists(new_dataset_path):
+                arcpy.Delete_management(new_dataset_path)
+            return None
+        
+        arcpy.ClearWorkspaceCache_management()
+        logging.info("Набор данных пула '{}' переименован в '{}'".format(dataset_name, new_dataset_name))
+        return new_dataset_path
+
+def ensure_attribute_index(fc, fields):
+    """Создает атрибутивные индексы по полям fields, для которых их еще нет
+    
+    Returns:
+        list: поля, по которым построены индексы
+    """
+    names = dict((f.name.upper(), f.name) for f in arcpy.ListFields(fc))
+    indexed = set()
+    for index in arcpy.ListIndexes(fc):
+        if len(index.fields) == 1:
+            indexed.add(index.fields[0].name.upper())
+    
+    created = []
+    for field in fields:
+        name = names.get(field.upper())
+        if name is None or name.upper() in indexed:
+            continue
+        try:
+            arcpy.AddIndex_management(fc, [name], "idx_{}".format(name))
+        except Exception as e:
+            # Класс может быть заблокирован открытым документом карты
+            logging.warning("Не удалось построить индекс %s по полю %s: %s", os.path.basename(fc), name, str(e))
+            continue
+        indexed.add(name.upper())
+        created.append(name)
+    if created:
+        logging.info("Построены атрибутивные индексы {} по полям: {}".format(os.path.basename(fc), ", ".join(created)))
+    return created
+
+def index_probe_seconds(fc, fields=(), spatial=False):
+    """Время типовых запросов последующих этапов к fc: отбор по значению каждого из полей fields
+    (значение берется из первой строки) и при spatial=True выборка по расположению
+    в центральной четверти охвата класса"""
+    names = dict((f.name.upper(), f.name) for f in arcpy.ListFields(fc))
+    fields = [names[field.upper()] for field in fields if field.upper() in names]
+    clauses = []
+    if fields:
+        with arcpy.da.SearchCursor(fc, fields) as cursor:
+            for row in cursor:
+                for name, value in zip(fields, row):
+                    delimited = arcpy.AddFieldDelimiters(fc, name)
+                    if value is None:
+                        clauses.append("{} IS NULL".format(delimited))
+                    else:
+                        clauses.append("{} = {}".format(delimited, FilterRule.sql_values([value])))
+                break
+    
+    start = time.time()
+    for clause in clauses:
+        with arcpy.da.SearchCursor(fc, ["OID@"], clause) as cursor:
+            for _ in cursor:
+                pass
+    if spatial:
+        desc = arcpy.Describe(fc)
+        extent = desc.extent
+        window = (extent.XMin + extent.width / 4.0, extent.YMin + extent.height / 4.0,
+                  extent.XMax - extent.width / 4.0, extent.YMax - extent.height / 4.0)
+        with ScratchManager("index_probe") as scratch:
+            probe_layer = scratch.layer("index_probe_layer")
+            arcpy.MakeFeatureLayer_management(fc, probe_layer)
+            arcpy.SelectLayerByLocation_management(probe_layer, "INTERSECT",
+                                                   extent_polygon(window, desc.spatialReference))
+    return time.time() - start
+
+def refresh_indexes(fc, fields=(), spatial=False, source=False):
+    """Строит недостающие атрибутивные индексы по полям fields и при spatial=True перестраивает
+    пространственный индекс fc; время записывается в журнал событий этапом "index".
+    Исходные классы пользователя (source=True) индексируются только при INDEX_SOURCES.
+    Ошибки построения индексов записываются в журнал как предупреждения
+    
+    Выигрыш от индексов оценивается по времени типовых запросов (index_probe_seconds) до и после
+    построения: в событие записываются время построения, запросов до и после и чистый выигрыш.
+    
+    Returns:
+        list: поля, по которым построены индексы
+    """
+    if not INDEX_OUTPUTS or (source and not INDEX_SOURCES) or not arcpy.Exists(fc):
+        return []
+    with track_stage("index", [fc], fc, fields=list(fields), spatial=spatial) as stage_event:
+        query_before = index_probe_seconds(fc, fields, spatial)
+        build_start = time.time()
+        created = ensure_attribute_index(fc, fields) if fields else []
+        if spatial:
+            # Для класса файловой GDB с индексом инструмент пересчитывает сетку индекса
+            try:
+                arcpy.AddSpatialIndex_management(fc)
+                logging.info("Перестроен пространственный индекс {}".format(os.path.basename(fc)))
+            except Exception as e:
+                logging.warning("Не удалось перестроить пространственный индекс %s: %s", os.path.basename(fc), str(e))
+        build_seconds = time.time() - build_start
+        stage_event["counts"]["output"] = len(created)
+        if created or spatial:
+            query_after = index_probe_seconds(fc, fields, spatial)
+            gain = query_before - query_after
+            stage_event["build_seconds"] = build_seconds
+            stage_event["query_seconds_before"] = query_before
+            stage_event["query_seconds_after"] = query_after
+            stage_event["net_seconds"] = gain - build_seconds
+            logging.info("Индексы %s: построение %.2f с, типовые запросы %.3f -> %.3f с, %s",
+                os.path.basename(fc), build_seconds, query_before, query_after,
+                "окупаются за {} запусков запросов".format(int(math.ceil(build_seconds / gain)))
+                if gain > 0 else "выигрыша нет")
+    return created
+
+def layer_role(path):
+    """Роль слоя результата для выбора шаблона: "сетка", "контур" или префикс имени (Lots, Land, Admi)"""
+    name = os.path.basename(path)
+    for suffix in ("сетка", "контур"):
+        if name.endswith("_" + suffix):
+            return suffix
+    return name.split("_")[0]
+
+def feature_class_gdb(path):
+    """База геоданных класса объектов, лежащего в корне базы или в наборе данных"""
+    dataset_path = os.path.dirname(path)
+    return dataset_path if dataset_path.lower().endswith(".gdb") else os.path.dirname(dataset_path)
+
+def layer_file_path(path, extension):
+    """Путь файла слоя результата: рядом с базой геоданных, по имени класса объектов"""
+    return os.path.join(os.path.dirname(feature_class_gdb(path)), os.path.basename(path) + extension)
+
+class MapUpdateQueue:
+    """Отложенные изменения документа карты (ArcMap) или проекта (ArcGIS Pro) за одно задание.
+    
+    Этапы обработки только регистрируют слои, обновление каталога и сохранение, а flush
+    применяет их разом: одно добавление слоев, одно обновление таблицы содержания и вида,
+    одно сохранение. В режиме без интерфейса документ карты не изменяется.
+    """
+    arcmap_products = ("ArcView", "ArcEditor", "ArcInfo", "Desktop")
+    pro_products = ("ArcGISPro", "Pro")
+    
+    @staticmethod
+    def template_path(path, extension):
+        """Шаблон слоя для роли класса path или None"""
+        template = os.path.join(LAYER_TEMPLATE_DIR, layer_role(path) + extension)
+        return template if os.path.exists(template) else None
+    
+    @staticmethod
+    def emit_layer_file(layer, path, extension):
+        """Сохраняет файл слоя результата, чтобы при проверке он открывался с готовыми настройками"""
+        if not LAYER_FILES_EMIT:
+            return
+        try:
+            arcpy.SaveToLayerFile_management(layer, layer_file_path(path, extension), "RELATIVE")
+        except Exception as e:
+            logging.warning("Не удалось сохранить файл слоя для {}: {}".format(path, str(e)))
+    
+    def arcmap_layer(self, mapping, path):
+        """Слой ArcMap из шаблона роли (с заменой источника данных) или с настройками по умолчанию"""
+        role = layer_role(path)
+        template = self.template_path(path, ".lyr")
+        if template:
+            layer = mapping.Layer(template)
+            layer.replaceDataSource(feature_class_gdb(path), "FILEGDB_WORKSPACE", os.path.basename(path))
+            layer.name = os.path.basename(path)
+            logging.info("Слой {} создан по шаблону {}".format(os.path.basename(path), template))
+        else:
+            layer = mapping.Layer(path)
+            if LAYER_MIN_SCALES.get(role):
+                layer.minScale = LAYER_MIN_SCALES[role]
+        if LAYER_DEFINITION_QUERIES.get(role):
+            layer.definitionQuery = LAYER_DEFINITION_QUERIES[role]
+        return layer
+    
+    def pro_layer(self, active_map, path):
+        """Добавляет слой в карту ArcGIS Pro из шаблона роли или с настройками по умолчанию"""
+        role = layer_role(path)
+        template = self.template_path(path, ".lyrx")
+        if template:
+            import arcpy.mp as mp
+            layer = active_map.addLayer(mp.LayerFile(template))[0]
+            connection = layer.connectionProperties
+            connection["connection_info"]["database"] = feature_class_gdb(path)
+            connection["dataset"] = os.path.basename(path)
+            layer.updateConnectionProperties(layer.connectionProperties, connection)
+            layer.name = os.path.basename(path)
+        else:
+            layer = active_map.addDataFromPath(path)
+            if LAYER_MIN_SCALES.get(role):
+                layer.minThreshold = LAYER_MIN_SCALES[role]
+        if LAYER_DEFINITION_QUERIES.get(role):
+            layer.definitionQuery = LAYER_DEFINITION_QUERIES[role]
+        return layer
+    
+    def __init__(self):
+        self.clear()
+    
+    def clear(self):
+        self.layers = []
+        self.catalog_paths = []
+        # [(путь без расширения, спрашивать ли о замене существующего файла)]
+        self.copies = []
+        self.save_current = False
+    
+    def add_layer(self, path):
+        """Добавить класс объектов в таблицу содержания"""
+        if path not in self.layers:
+            self.layers.append(path)
+    
+    def refresh_catalog(self, path):
+        if path not in self.catalog_paths:
+            self.catalog_paths.append(path)
+    
+    def save(self):
+        """Сохранить текущий документ карты"""
+        self.save_current = True
+    
+    def save_copy(self, base_path, confirm=False):
+        """Сохранить копию документа как base_path.mxd (base_path.aprx в ArcGIS Pro)"""
+        for n, (path, path_confirm) in enumerate(self.copies):
+            if path == base_path:
+                self.copies[n] = (path, path_confirm or confirm)
+                return
+        self.copies.append((base_path, confirm))
+    
+    def flush(self):
+        """Применяет накопленные изменения и очищает очередь
+        
+        Returns:
+            bool: True, если документ карты был обновлен
+        """
+        try:
+            if not self.layers and not self.copies and not self.save_current:
+                return False
+            if isinstance(messagebox, HeadlessMessageBox) or not ARCPY_AVAILABLE:
+                logging.info("Режим без интерфейса: документ карты не изменяется ({} слоев)".format(len(self.layers)))
+                return False
+            
+            product_info = arcpy.ProductInfo()
+            with track_stage("map_update", self.layers, None, product=product_info) as stage_event:
+                if product_info in self.arcmap_products:
+                    added = self.flush_arcmap()
+                elif product_info in self.pro_products:
+                    added = self.flush_pro()
+                else:
+                    logging.warning("Скрипт запущен вне ArcMap/ArcGIS Pro или не удалось определить продукт ({})".format(product_info))
+                    added = None
+                stage_event["counts"]["output"] = len(added or [])
+            
+            if added is None:
+                return False
+            missing = [path for path in self.layers if path not in added and arcpy.Exists(path)]
+            if missing:
+                messagebox.showwarning("Предупреждение",
+                                       "Не удалось автоматически добавить слои в таблицу содержания.\n"
+                                       "Пожалуйста, добавьте их вручную из:\n{}".format("\n".join(missing)))
+            return True
+        except Exception as e:
+            logging.warning("Не удалось обновить документ карты: {}".format(str(e)))
+            logging.error(traceback.format_exc())
+            return False
+        finally:
+            self.clear()
+    
+    def copy_allowed(self, file_path, confirm):
+        """Проверяет, можно ли записать копию документа в file_path"""
+        if not confirm or not os.path.exists(file_path):
+            return True
+        if messagebox.askyesno("Предупреждение", "Файл {} уже существует. Заменить?".format(os.path.basename(file_path))):
+            return True
+        logging.info("Пользователь отменил сохранение файла {}".format(file_path))
+        return False
+    
+    def flush_arcmap(self):
+        import arcpy.mapping as mapping
+        mxd = mapping.MapDocument("CURRENT")
+        data_frames = mapping.ListDataFrames(mxd)
+        if not data_frames:
+            logging.warning("Не найдены фреймы данных в документе карты")
+            return []
+        df = mxd.activeDataFrame or data_frames[0]
+        
+        added = []
+        for path in self.layers:
+            if not arcpy.Exists(path):
+                continue
+            try:
+                layer = self.arcmap_layer(mapping, path)
+                mapping.AddLayer(df, layer, "TOP")
+                self.emit_layer_file(layer, path, ".lyr")
+            except Exception as layer_err:
+                # Альтернативный способ: через временный слой MakeFeatureLayer
+                logging.warning("Не удалось создать слой из %s: %s", path, str(layer_err))
+                try:
+                    layer_name = ScratchManager.unique_name("map_layer")
+                    arcpy.MakeFeatureLayer_management(path, layer_name)
+                    mapping.AddLayer(df, mapping.Layer(layer_name), "TOP")
+                except Exception as temp_err:
+                    logging.error("Ошибка при альтернативном методе добавления слоя: %s", str(temp_err))
+                    continue
+            added.append(path)
+            logging.info("Слой '%s' добавлен в таблицу содержания ArcMap", os.path.basename(path))
+        
+        for path in self.catalog_paths:
+            arcpy.RefreshCatalog(path)
+        if self.save_current:
+            mxd.save()
+            logging.info("Документ карты сохранен")
+        for base_path, confirm in self.copies:
+            mxd_path = base_path + ".mxd"
+            if self.copy_allowed(mxd_path, confirm):
+                mxd.saveACopy(mxd_path)
+                logging.info("Файл карты сохранен: %s", mxd_path)
+        arcpy.RefreshTOC()
+        arcpy.RefreshActiveView()
+        return added
+    
+    def flush_pro(self):
+        import arcpy.mp as mp
+        aprx = mp.ArcGISProject("CURRENT")
+        maps = aprx.listMaps()
+        if not maps:
+            logging.warning("Не найдены карты в проекте")
+            return []
+        active_map = aprx.activeMap or maps[0]
+        
+        added = []
+        for path in self.layers:
+            if not arcpy.Exists(path):
+                continue
+            try:
+                layer = self.pro_layer(active_map, path)
+                self.emit_layer_file(layer, path, ".lyrx")
+            except Exception as layer_err:
+                logging.error("Ошибка при добавлении слоя %s: %s", path, str(layer_err))
+                continue
+            added.append(path)
+            logging.info("Слой '%s' добавлен в таблицу содержания ArcGIS Pro", os.path.basename(path))
+        
+        if self.save_current:
+            aprx.save()
+            logging.info("Проект сохранен")
+        for base_path, confirm in self.copies:
+            aprx_path = base_path + ".aprx"
+            if self.copy_allowed(aprx_path, confirm):
+                aprx.saveACopy(aprx_path)
+                logging.info("Файл проекта сохранен: %s", aprx_path)
+        return added
+
+# Изменения документа карты текущего задания
+map_updates = MapUpdateQueue()
+
 class DataProcessor:
     def __init__(self, gdb_path, selected_value, shortened_name):
         self.gdb_path = gdb_path
@@ -1895,6 +4697,9 @@ class DataProcessor:
             messagebox.showerror("Ошибка", "Модуль arcpy не доступен для обработки данных")
             return False
         
+        # Новое задание: оценки объема входных классов прошлого задания устарели
+        ScratchManager.reset_estimates()
+        
         try:
             logging.info("Начало обработки данных")
             logging.info("Параметры: GDB={}, выбранное значение={}, сокращение={}".format(
@@ -1908,9 +4713,7 @@ class DataProcessor:
             logging.info("Установлено рабочее пространство: {}".format(self.gdb_path))
             
             # Формируем имя нового набора данных на основе значения UsName_1
-            # Заменяем пробелы на "_" и удаляем кавычки
-            cleaned_usname = self.selected_value.replace(" ", "_").replace("\"", "").replace("'", "")
-            new_dataset_name = "_{}".format(cleaned_usname)
+            new_dataset_name = dataset_name_for(self.selected_value)
             logging.info("Имя нового набора данных: {}".format(new_dataset_name))
             
             # Проверяем существование набора "Копия"
@@ -1946,34 +4749,37 @@ class DataProcessor:
                     logging.info("Пользователь отменил замену существующего набора данных")
                     return False
             
-            # Копируем набор "Копия" с новым именем
+            # Копируем набор "Копия" с новым именем (или берем готовый набор из пула)
             try:
-                logging.info("Копирование набора 'Копия' с новым именем '{}'".format(new_dataset_name))
-                
-                # Получаем информацию о пространственной привязке исходного набора
-                source_path = os.path.join(self.gdb_path, "Копия")
-                desc = arcpy.Describe(source_path)
-                spatial_reference = desc.spatialReference
-                logging.info("Пространственная привязка: {}".format(spatial_reference.name))
-                
-                # Создаем новый набор данных с той же пространственной привязкой
-                create_result = arcpy.CreateFeatureDataset_management(
-                    self.gdb_path,
-                    new_dataset_name,
-                    spatial_reference
-                )
-                
-                logging.info("Создан новый набор данных: {}".format(create_result.getOutput(0)))
-                
-                # Обновляем кэш и получаем список классов объектов в исходном наборе
-                arcpy.ClearWorkspaceCache_management()
-                arcpy.env.workspace = source_path
-                source_fcs = arcpy.ListFeatureClasses()
-                logging.info("Классы объектов в исходном наборе: {}".format(", ".join(source_fcs) if source_fcs else "нет"))
-                
-                # Возвращаемся к корневому рабочему пространству
-                arcpy.env.workspace = self.gdb_path
-                
+                if DatasetPool(self.gdb_path).claim(new_dataset_name, self.shortened_name):
+                    logging.info("Набор данных '{}' взят из пула заранее созданных наборов".format(new_dataset_name))
+                else:
+                    logging.info("Копирование набора 'Копия' с новым именем '{}'".format(new_dataset_name))
+                    
+                    # Получаем информацию о пространственной привязке исходного набора
+                    source_path = os.path.join(self.gdb_path, "Копия")
+                    desc = arcpy.Describe(source_path)
+                    spatial_reference = desc.spatialReference
+                    logging.info("Пространственная привязка: {}".format(spatial_reference.name))
+                    
+                    # Создаем новый набор данных с той же пространственной привязкой
+                    create_result = arcpy.CreateFeatureDataset_management(
+                        self.gdb_path,
+                        new_dataset_name,
+                        spatial_reference
+                    )
+                    
+                    logging.info("Создан новый набор данных: {}".format(create_result.getOutput(0)))
+                    
+                    # Обновляем кэш и получаем список классов объектов в исходном наборе
+                    arcpy.ClearWorkspaceCache_management()
+                    arcpy.env.workspace = source_path
+                    source_fcs = arcpy.ListFeatureClasses()
+                    logging.info("Классы объектов в исходном наборе: {}".format(", ".join(source_fcs) if source_fcs else "нет"))
+                    
+                    # Возвращаемся к корневому рабочему пространству
+                    arcpy.env.workspace = self.gdb_path
+                    
             except Exception as copy_err:
                 logging.error("Ошибка при создании нового набора данных: {}".format(str(copy_err)))
                 messagebox.showerror("Ошибка", "Не удалось создать новый набор данных: {}".format(str(copy_err)))
@@ -2002,7 +4808,7 @@ class DataProcessor:
                         
                         if "Lots" in ds_fcs:
                             lots_path = os.path.join(self.gdb_path, ds, "Lots")
-                            logging.info("Найден класс объектов 'Lots' в наборе '{}': {}".format(ds, lots_path))
+                            logging.info("Найден класс объектов 'Lots' в наборе '%s': %s", ds, lots_path)
                             break
                 
                 # Сбрасываем рабочее пространство
@@ -2047,18 +4853,29 @@ class DataProcessor:
                 # Устанавливаем параметр перезаписи существующих данных
                 arcpy.env.overwriteOutput = True
                 
-                # Выполняем инструмент Select_analysis
-                select_result = arcpy.Select_analysis(
-                    lots_path,
-                    target_fc_path,
-                    where_clause
-                )
-                
-                logging.info("Создан новый класс объектов: {}".format(select_result.getOutput(0)))
-                
-                # Проверяем количество извлеченных объектов
-                count_result = arcpy.GetCount_management(target_fc_path)
-                feature_count = int(count_result.getOutput(0))
+                # Выполняем инструмент Select_analysis (или берем участки из разбиения Lots пакетного режима)
+                cached_partition = lots_partition_cache.get((lots_path, self.selected_value))
+                if not cached_partition:
+                    refresh_indexes(lots_path, ["UsName_1"], source=True)
+                with track_stage("select_lots", [lots_path], target_fc_path, where_clause=where_clause,
+                                 cached=bool(cached_partition)) as stage_event:
+                    if cached_partition and arcpy.Exists(cached_partition["path"]):
+                        arcpy.CopyFeatures_management(cached_partition["path"], target_fc_path)
+                        logging.info("Создан новый класс объектов из разбиения Lots: {}".format(target_fc_path))
+                        feature_count = cached_partition["count"]
+                    else:
+                        select_result = arcpy.Select_analysis(
+                            lots_path,
+                            target_fc_path,
+                            where_clause
+                        )
+                        
+                        logging.info("Создан новый класс объектов: {}".format(select_result.getOutput(0)))
+                        
+                        # Проверяем количество извлеченных объектов
+                        count_result = arcpy.GetCount_management(target_fc_path)
+                        feature_count = int(count_result.getOutput(0))
+                    stage_event["counts"]["output"] = feature_count
                 logging.info("Количество извлеченных объектов: {}".format(feature_count))
                 
                 # Создаем копию слоя с названием Lots_"Сокр"_контур
@@ -2067,8 +4884,11 @@ class DataProcessor:
                     contour_fc_path = os.path.join(self.gdb_path, new_dataset_name, contour_fc_name)
                     logging.info("Создание копии слоя с названием: {}".format(contour_fc_name))
                     
+                    # Пустой класс контура мог быть создан заранее вместе с набором данных из пула
+                    provisioned_contour = contour_fc_path in provisioned_outputs
+                    
                     # Проверяем существование класса объектов
-                    if arcpy.Exists(contour_fc_path):
+                    if arcpy.Exists(contour_fc_path) and not provisioned_contour:
                         logging.warning("Класс объектов '{}' уже существует".format(contour_fc_path))
                         if messagebox.askyesno("Предупреждение", "Класс объектов '{}' уже существует. Заменить?".format(contour_fc_name)):
                             arcpy.Delete_management(contour_fc_path)
@@ -2077,26 +4897,32 @@ class DataProcessor:
                             logging.info("Пользователь отменил замену существующего класса объектов - контур")
                             # Продолжаем выполнение без создания контура
                     
-                    if not arcpy.Exists(contour_fc_path):
-                        # Копируем класс объектов с новым именем
-                        arcpy.Copy_management(target_fc_path, contour_fc_path)
-                        logging.info("Создана копия класса объектов: {}".format(contour_fc_path))
-                        
-                        # Проверяем количество объектов в новом классе
-                        contour_count = int(arcpy.GetCount_management(contour_fc_path).getOutput(0))
-                        logging.info("Количество объектов в контуре: {}".format(contour_count))
+                    if provisioned_contour or not arcpy.Exists(contour_fc_path):
+                        if provisioned_contour:
+                            provisioned_outputs.discard(contour_fc_path)
+                            logging.info("Используется заранее созданный пустой класс контура: {}".format(contour_fc_path))
+                        else:
+                            # Копируем класс объектов с новым именем
+                            arcpy.Copy_management(target_fc_path, contour_fc_path)
+                            logging.info("Создана копия класса объектов: {}".format(contour_fc_path))
+                            
+                            # Проверяем количество объектов в новом классе
+                            contour_count = int(arcpy.GetCount_management(contour_fc_path).getOutput(0))
+                            logging.info("Количество объектов в контуре: {}".format(contour_count))
                         
                         # Обработка контурного слоя: удаление данных из таблицы атрибутов и создание буфера
+                        scratch = ScratchManager("contour_buffer")
                         try:
                             logging.info("Начало обработки контурного слоя...")
                             
                             # 1. Удаляем все данные из таблицы атрибутов контурного слоя
-                            arcpy.DeleteRows_management(contour_fc_path)
-                            logging.info("Данные из таблицы атрибутов контурного слоя удалены")
+                            if not provisioned_contour:
+                                arcpy.DeleteRows_management(contour_fc_path)
+                                logging.info("Данные из таблицы атрибутов контурного слоя удалены")
                             
                             # 2. Создаем буфер вокруг исходных полигонов (0.5 км = 500 м)
                             buffer_distance = "500 Meters"
-                            temp_buffer_path = os.path.join("in_memory", "temp_buffer")
+                            temp_buffer_path = scratch.dataset("temp_buffer", [target_fc_path])
                             
                             logging.info("Создание буфера с расстоянием {} вокруг участков".format(buffer_distance))
                             arcpy.Buffer_analysis(
@@ -2110,7 +4936,7 @@ class DataProcessor:
                             
                             # 3. Объединяем полигоны в пределах 2 км друг от друга
                             # Сначала создаем буфер 2 км, затем растворяем его и снова создаем буфер внутрь на 1.5 км
-                            dissolve_buffer_path = os.path.join("in_memory", "dissolve_buffer")
+                            dissolve_buffer_path = scratch.dataset("dissolve_buffer", [target_fc_path])
                             
                             # Создаем буфер 2 км для определения близлежащих участков
                             logging.info("Создание буфера 2 км для определения близлежащих участков")
@@ -2124,7 +4950,7 @@ class DataProcessor:
                             )
                             
                             # Создаем отрицательный буфер -1.5 км (2 км - 0.5 км), чтобы получить контур с отступом 0.5 км
-                            final_buffer_path = os.path.join("in_memory", "final_buffer")
+                            final_buffer_path = scratch.dataset("final_buffer", [target_fc_path])
                             logging.info("Создание итогового контура с отступом 0.5 км")
                             arcpy.Buffer_analysis(
                                 dissolve_buffer_path,
@@ -2143,8 +4969,8 @@ class DataProcessor:
                                 "NO_TEST"  # Не проверяем схему данных
                             )
                             
-                            # 5. Очищаем временные данные
-                            arcpy.Delete_management("in_memory")
+                            # 5. Очищаем временные данные (только буферы этого этапа)
+                            scratch.release()
                             
                             logging.info("Обработка контурного слоя завершена успешно")
                             
@@ -2171,7 +4997,7 @@ class DataProcessor:
                                         
                                         if "Land" in ds_fcs:
                                             land_path = os.path.join(self.gdb_path, ds, "Land")
-                                            logging.info("Найден класс объектов 'Land' в наборе '{}': {}".format(ds, land_path))
+                                            logging.info("Найден класс объектов 'Land' в наборе '%s': %s", ds, land_path)
                                             break
                                 
                                 # Сбрасываем рабочее пространство
@@ -2201,76 +5027,32 @@ class DataProcessor:
                                         logging.info("Вырезание данных из '{}' по '{}', сохранение в '{}'".format(
                                             land_path, target_fc_path, land_clip_path))
                                         
-                                        # Используем инструмент Clip
-                                        arcpy.Clip_analysis(
-                                            land_path,  # Входной класс
-                                            target_fc_path,  # Вырезающий класс
-                                            land_clip_path  # Выходной класс
-                                        )
+                                        # Используем инструмент Clip (для крупных лесхозов - по тайлам);
+                                        # из Land читаются только объекты, удовлетворяющие правилу land_keep
+                                        land_rule = get_rule("land_keep")
+                                        logging.info("Отбор объектов Land по правилу land_keep: {}".format(land_rule.where_clause()))
+                                        refresh_indexes(land_path, land_rule.fields + get_rule("contour_drop").fields,
+                                                        source=True)
+                                        with track_stage("clip_land", [land_path, target_fc_path], land_clip_path,
+                                                         where_clause=land_rule.where_clause()) as stage_event:
+                                            TiledProcessor(target_fc_path).clip(
+                                                land_path,  # Входной класс
+                                                target_fc_path,  # Вырезающий класс
+                                                land_clip_path,  # Выходной класс
+                                                land_rule.where_clause()
+                                            )
+                                            
+                                            # Получаем количество объектов в результате
+                                            clip_count = int(arcpy.GetCount_management(land_clip_path).getOutput(0))
+                                            stage_event["counts"]["output"] = clip_count
                                         
                                         logging.info("Вырезание данных завершено успешно")
-                                        
-                                        # Получаем количество объектов в результате
-                                        clip_count = int(arcpy.GetCount_management(land_clip_path).getOutput(0))
-                                        logging.info("Количество объектов в результате вырезания: {}".format(clip_count))
+                                        logging.info("Итоговое количество объектов в Land_\"Сокр\": {}".format(clip_count))
                                         
                                         # Глобальная переменная для использования в других частях кода
                                         self.land_clip_path = land_clip_path
                                         self.land_clip_name = land_clip_name
                                         
-                                        # Оставляем только объекты с LandType 101, 102, 103
-                                        try:
-                                            logging.info("Оставляем только объекты с LandType 101, 102, 103...")
-                                            
-                                            # Создаем временный слой
-                                            temp_land_layer = "temp_land_layer"
-                                            arcpy.MakeFeatureLayer_management(land_clip_path, temp_land_layer)
-                                            
-                                            # Формируем SQL-выражение для выбора нужных типов
-                                            landtype_sql = "LandType IN (101, 102, 103)"
-                                            
-                                            # Выбираем объекты с нужными типами
-                                            arcpy.SelectLayerByAttribute_management(
-                                                temp_land_layer,
-                                                "NEW_SELECTION",
-                                                landtype_sql
-                                            )
-                                            
-                                            # Проверяем количество выбранных объектов для сохранения
-                                            to_keep_count = int(arcpy.GetCount_management(temp_land_layer).getOutput(0))
-                                            logging.info("Количество объектов для сохранения (LandType 101, 102, 103): {}".format(to_keep_count))
-                                            
-                                            # Инвертируем выборку, чтобы выбрать все, кроме нужных типов
-                                            arcpy.SelectLayerByAttribute_management(
-                                                temp_land_layer,
-                                                "SWITCH_SELECTION"
-                                            )
-                                            
-                                            # Проверяем количество выбранных объектов для удаления
-                                            to_delete_count = int(arcpy.GetCount_management(temp_land_layer).getOutput(0))
-                                            logging.info("Количество объектов для удаления (не LandType 101, 102, 103): {}".format(to_delete_count))
-                                            
-                                            # Удаляем выбранные объекты
-                                            if to_delete_count > 0:
-                                                arcpy.DeleteFeatures_management(temp_land_layer)
-                                                logging.info("Удалено {} объектов с LandType не равным 101, 102, 103".format(to_delete_count))
-                                            
-                                            # Снимаем выборку
-                                            arcpy.SelectLayerByAttribute_management(temp_land_layer, "CLEAR_SELECTION")
-                                            
-                                            # Удаляем временный слой
-                                            arcpy.Delete_management(temp_land_layer)
-                                            
-                                            # Получаем итоговое количество объектов
-                                            final_land_count = int(arcpy.GetCount_management(land_clip_path).getOutput(0))
-                                            logging.info("Итоговое количество объектов в Land_\"Сокр\" после фильтрации: {}".format(final_land_count))
-                                            
-                                        except Exception as filter_err:
-                                            logging.error("Ошибка при фильтрации объектов Land_\"Сокр\": {}".format(str(filter_err)))
-                                            logging.error(traceback.format_exc())
-                                            messagebox.showwarning("Предупреждение", 
-                                                                "Ошибка при фильтрации объектов Land_\"Сокр\":\n{}".format(str(filter_err)))
-                                            
                                         # Создаем Land_"Сокр"_контур напрямую из Land по границам Lots_"Сокр"_контур
                                         land_contour_name = "Land_{}_контур".format(self.shortened_name)
                                         land_contour_path = os.path.join(self.gdb_path, new_dataset_name, land_contour_name)
@@ -2291,81 +5073,28 @@ class DataProcessor:
                                             logging.info("Вырезание данных из '{}' по '{}', сохранение в '{}'".format(
                                                 land_path, contour_fc_path, land_contour_path))
                                             
-                                            # Используем инструмент Clip
-                                            arcpy.Clip_analysis(
-                                                land_path,  # Входной класс (Land)
-                                                contour_fc_path,  # Вырезающий класс (Lots_"Сокр"_контур)
-                                                land_contour_path  # Выходной класс (Land_"Сокр"_контур)
-                                            )
-                                            
-                                            logging.info("Вырезание данных Land_\"Сокр\"_контур завершено успешно")
-                                            
-                                            # Удаляем объекты с LandType 101, 102, 103 и LandCode 326 из Land_"Сокр"_контур
-                                            try:
-                                                logging.info("Удаляем объекты с LandType 101, 102, 103 и LandCode 326 из Land_\"Сокр\"_контур...")
-                                                
-                                                # Создаем временный слой
-                                                temp_contour_layer = "temp_contour_layer"
-                                                arcpy.MakeFeatureLayer_management(land_contour_path, temp_contour_layer)
-                                                
-                                                # Формируем SQL-выражение для выбора объектов с LandType 101, 102, 103
-                                                landtype_sql = "LandType IN (101, 102, 103)"
-                                                
-                                                # Выбираем объекты с LandType 101, 102, 103
-                                                arcpy.SelectLayerByAttribute_management(
-                                                    temp_contour_layer,
-                                                    "NEW_SELECTION",
-                                                    landtype_sql
+                                            # Используем инструмент Clip (для крупных лесхозов - по тайлам);
+                                            # объекты, удовлетворяющие правилу contour_drop, не читаются из Land
+                                            contour_rule = get_rule("contour_drop")
+                                            logging.info("Отбор объектов Land для контура: {}".format(contour_rule.exclusion_clause()))
+                                            with track_stage("clip_land_contour", [land_path, contour_fc_path], land_contour_path,
+                                                             where_clause=contour_rule.exclusion_clause()) as stage_event:
+                                                TiledProcessor(contour_fc_path).clip(
+                                                    land_path,  # Входной класс (Land)
+                                                    contour_fc_path,  # Вырезающий класс (Lots_"Сокр"_контур)
+                                                    land_contour_path,  # Выходной класс (Land_"Сокр"_контур)
+                                                    contour_rule.exclusion_clause()
                                                 )
                                                 
-                                                # Проверяем количество выбранных объектов
-                                                landtype_count = int(arcpy.GetCount_management(temp_contour_layer).getOutput(0))
-                                                logging.info("Выбрано {} объектов с LandType 101, 102, 103".format(landtype_count))
-                                                
-                                                # Удаляем выбранные объекты
-                                                if landtype_count > 0:
-                                                    arcpy.DeleteFeatures_management(temp_contour_layer)
-                                                    logging.info("Удалено {} объектов с LandType 101, 102, 103".format(landtype_count))
-                                                
-                                                # Снимаем выборку
-                                                arcpy.SelectLayerByAttribute_management(temp_contour_layer, "CLEAR_SELECTION")
-                                                
-                                                # Выбираем объекты с LandCode 326
-                                                landcode_sql = "LandCode = 326"
-                                                arcpy.SelectLayerByAttribute_management(
-                                                    temp_contour_layer,
-                                                    "NEW_SELECTION",
-                                                    landcode_sql
-                                                )
-                                                
-                                                # Проверяем количество выбранных объектов
-                                                landcode_count = int(arcpy.GetCount_management(temp_contour_layer).getOutput(0))
-                                                logging.info("Выбрано {} объектов с LandCode 326".format(landcode_count))
-                                                
-                                                # Удаляем выбранные объекты
-                                                if landcode_count > 0:
-                                                    arcpy.DeleteFeatures_management(temp_contour_layer)
-                                                    logging.info("Удалено {} объектов с LandCode 326".format(landcode_count))
-                                                
-                                                # Снимаем выборку
-                                                arcpy.SelectLayerByAttribute_management(temp_contour_layer, "CLEAR_SELECTION")
-                                                
-                                                # Удаляем временный слой
-                                                arcpy.Delete_management(temp_contour_layer)
-                                                
-                                                # Получаем итоговое количество объектов
                                                 final_contour_count = int(arcpy.GetCount_management(land_contour_path).getOutput(0))
-                                                logging.info("Итоговое количество объектов в Land_\"Сокр\"_контур после фильтрации: {}".format(final_contour_count))
-                                                
-                                                # Сохраняем ссылки на пути
-                                                self.land_contour_path = land_contour_path
-                                                self.land_contour_name = land_contour_name
-                                                
-                                            except Exception as contour_filter_err:
-                                                logging.error("Ошибка при фильтрации объектов Land_\"Сокр\"_контур: {}".format(str(contour_filter_err)))
-                                                logging.error(traceback.format_exc())
-                                                messagebox.showwarning("Предупреждение", 
-                                                                    "Ошибка при фильтрации объектов Land_\"Сокр\"_контур:\n{}".format(str(contour_filter_err)))
+                                                stage_event["counts"]["output"] = final_contour_count
+                                            
+                                            logging.info("Вырезание данных Land_\"Сокр\"_контур завершено успешно")
+                                            logging.info("Итоговое количество объектов в Land_\"Сокр\"_контур: {}".format(final_contour_count))
+                                            
+                                            # Сохраняем ссылки на пути
+                                            self.land_contour_path = land_contour_path
+                                            self.land_contour_name = land_contour_name
                             
                             except Exception as clip_err:
                                 logging.error("Ошибка при вырезании данных из Land: {}".format(str(clip_err)))
@@ -2397,7 +5126,7 @@ class DataProcessor:
                                         
                                         if "Admi" in ds_fcs:
                                             admi_path = os.path.join(self.gdb_path, ds, "Admi")
-                                            logging.info("Найден класс объектов 'Admi' в наборе '{}': {}".format(ds, admi_path))
+                                            logging.info("Найден класс объектов 'Admi' в наборе '%s': %s", ds, admi_path)
                                             break
                                 
                                 # Сбрасываем рабочее пространство
@@ -2453,6 +5182,7 @@ class DataProcessor:
                                 # Продолжаем выполнение
                         
                         except Exception as process_err:
+                            scratch.release()
                             logging.error("Ошибка при обработке контурного слоя: {}".format(str(process_err)))
                             logging.error(traceback.format_exc())
                             messagebox.showwarning(
@@ -2472,104 +5202,19 @@ class DataProcessor:
                 
                 # Обновляем кэш
                 arcpy.ClearWorkspaceCache_management()
-                arcpy.RefreshCatalog(self.gdb_path)
-                arcpy.RefreshCatalog(os.path.join(self.gdb_path, new_dataset_name))
-                arcpy.RefreshTOC()  # Обновляем таблицу содержания
-                arcpy.RefreshActiveView()  # Обновляем активный вид
                 
-                # Добавляем слой в таблицу содержания текущего документа карты и отображаем на экране
-                try:
-                    # Проверяем, запущен ли скрипт из ArcMap или ArcGIS Pro
-                    if arcpy.ProductInfo() in ['ArcView', 'ArcEditor', 'ArcInfo']:  # ArcMap
-                        import arcpy.mapping as mapping
-                        mxd = mapping.MapDocument("CURRENT")
-                        df = mxd.activeDataFrame
-                        layer = mapping.Layer(target_fc_path)
-                        mapping.AddLayer(df, layer, "TOP")
-                        logging.info("Слой '{}' добавлен в таблицу содержания ArcMap".format(new_fc_name))
-                        
-                        # Добавляем контурный слой в карту, если он существует
-                        if 'contour_fc_path' in locals() and arcpy.Exists(contour_fc_path):
-                            contour_layer = mapping.Layer(contour_fc_path)
-                            mapping.AddLayer(df, contour_layer, "TOP")
-                            logging.info("Контурный слой '{}' добавлен в таблицу содержания ArcMap".format(contour_fc_name))
-                        
-                        # Добавляем вырезанный слой Land в карту, если он существует
-                        if hasattr(self, 'land_clip_path') and arcpy.Exists(self.land_clip_path):
-                            land_clip_layer = mapping.Layer(self.land_clip_path)
-                            mapping.AddLayer(df, land_clip_layer, "TOP")
-                            logging.info("Вырезанный слой Land '{}' добавлен в таблицу содержания ArcMap".format(self.land_clip_name))
-                        
-                        # Добавляем вырезанный слой Admi в карту, если он существует
-                        if hasattr(self, 'admi_clip_path') and arcpy.Exists(self.admi_clip_path):
-                            admi_clip_layer = mapping.Layer(self.admi_clip_path)
-                            mapping.AddLayer(df, admi_clip_layer, "TOP")
-                            logging.info("Вырезанный слой Admi '{}' добавлен в таблицу содержания ArcMap".format(self.admi_clip_name))
-                        
-                        # Сохраняем MXD файл с именем _UsName_1.mxd (без кавычек)
-                        cleaned_usname = self.selected_value.replace(" ", "_").replace("\"", "").replace("'", "")
-                        mxd_name = "_{}".format(cleaned_usname)
-                        mxd_path = os.path.join(os.path.dirname(self.gdb_path), "{}.mxd".format(mxd_name))
-                        
-                        # Проверяем, существует ли файл MXD
-                        if os.path.exists(mxd_path):
-                            if messagebox.askyesno("Предупреждение", "Файл карты {}.mxd уже существует. Заменить?".format(mxd_name)):
-                                mxd.saveACopy(mxd_path)
-                                logging.info("Файл карты сохранен: {}".format(mxd_path))
-                            else:
-                                logging.info("Пользователь отменил сохранение файла карты")
-                        else:
-                            mxd.saveACopy(mxd_path)
-                            logging.info("Файл карты сохранен: {}".format(mxd_path))
-                        
-                        # Обновляем каталог, чтобы слой и набор данных отображались в ArcMap
-                        arcpy.RefreshCatalog(self.gdb_path)
-                        arcpy.RefreshCatalog(os.path.join(self.gdb_path, new_dataset_name))
-                        arcpy.RefreshTOC()  # Обновляем таблицу содержания
-                        arcpy.RefreshActiveView()  # Обновляем активный вид
-                        
-                    elif arcpy.ProductInfo() == 'ArcGISPro':  # ArcGIS Pro
-                        import arcpy.mp as mp
-                        aprx = mp.ArcGISProject("CURRENT")
-                        m = aprx.activeMap
-                        m.addDataFromPath(target_fc_path)
-                        logging.info("Слой '{}' добавлен в таблицу содержания ArcGIS Pro".format(new_fc_name))
-                        
-                        # Добавляем контурный слой в карту ArcGIS Pro
-                        if 'contour_fc_path' in locals() and arcpy.Exists(contour_fc_path):
-                            m.addDataFromPath(contour_fc_path)
-                            logging.info("Слой '{}' добавлен в таблицу содержания ArcGIS Pro".format(contour_fc_name))
-                        
-                        # Добавляем вырезанный слой Land в карту ArcGIS Pro
-                        if hasattr(self, 'land_clip_path') and arcpy.Exists(self.land_clip_path):
-                            m.addDataFromPath(self.land_clip_path)
-                            logging.info("Слой '{}' добавлен в таблицу содержания ArcGIS Pro".format(self.land_clip_name))
-                        
-                        # Добавляем вырезанный слой Admi в карту ArcGIS Pro
-                        if hasattr(self, 'admi_clip_path') and arcpy.Exists(self.admi_clip_path):
-                            m.addDataFromPath(self.admi_clip_path)
-                            logging.info("Слой '{}' добавлен в таблицу содержания ArcGIS Pro".format(self.admi_clip_name))
-                        
-                        # Сохраняем APRX файл с именем _UsName_1.aprx (без кавычек)
-                        cleaned_usname = self.selected_value.replace(" ", "_").replace("\"", "").replace("'", "")
-                        aprx_name = "_{}".format(cleaned_usname)
-                        aprx_path = os.path.join(os.path.dirname(self.gdb_path), "{}.aprx".format(aprx_name))
-                        
-                        # Проверяем, существует ли файл APRX
-                        if os.path.exists(aprx_path):
-                            if messagebox.askyesno("Предупреждение", "Файл проекта {}.aprx уже существует. Заменить?".format(aprx_name)):
-                                aprx.saveACopy(aprx_path)
-                                logging.info("Файл проекта сохранен: {}".format(aprx_path))
-                            else:
-                                logging.info("Пользователь отменил сохранение файла проекта")
-                        else:
-                            aprx.saveACopy(aprx_path)
-                            logging.info("Файл проекта сохранен: {}".format(aprx_path))
-                    else:
-                        logging.warning("Скрипт запущен вне ArcMap/ArcGIS Pro или не удалось определить продукт")
-                except Exception as map_err:
-                    logging.warning("Не удалось добавить слой в таблицу содержания или сохранить файл: {}".format(str(map_err)))
-                    # Продолжаем выполнение, так как это некритичная ошибка
+                # Слои, обновление каталога и копия карты _UsName_1 применяются одним
+                # обновлением в конце задания (map_updates.flush)
+                map_updates.refresh_catalog(self.gdb_path)
+                map_updates.refresh_catalog(os.path.join(self.gdb_path, new_dataset_name))
+                map_updates.add_layer(target_fc_path)
+                if 'contour_fc_path' in locals() and arcpy.Exists(contour_fc_path):
+                    map_updates.add_layer(contour_fc_path)
+                if hasattr(self, 'land_clip_path') and arcpy.Exists(self.land_clip_path):
+                    map_updates.add_layer(self.land_clip_path)
+                if hasattr(self, 'admi_clip_path') and arcpy.Exists(self.admi_clip_path):
+                    map_updates.add_layer(self.admi_clip_path)
+                map_updates.save_copy(os.path.join(os.path.dirname(self.gdb_path), new_dataset_name), confirm=True)
                 
                 # Отображаем сообщение об успехе
                 messagebox.showinfo(
@@ -2605,59 +5250,276 @@ class DataProcessor:
             messagebox.showerror("Ошибка", "Произошла ошибка при обработке данных: {}".format(str(e)))
             return False
 
-def main():
-    # Создание и запуск интерфейса выбора GDB
-    root = tk.Tk()
-    gdb_selector = GDBSelector(root)
-    
-    # Делаем диалог модальным
-    root.grab_set()
-    root.focus_set()
-    root.wait_window()
-    
-    gdb_path = gdb_selector.gdb_path
-    if not gdb_path:
-        logging.info("Пользователь отменил выбор базы геоданных или возникла ошибка")
-        return
+def read_recent_jobs():
+    """Последние задания из RECENT_JOBS_FILE, от нового к старому; поврежденный файл считается пустым"""
+    if not os.path.exists(RECENT_JOBS_FILE):
+        return []
+    try:
+        with io.open(RECENT_JOBS_FILE, "r", encoding="utf-8") as recent_file:
+            jobs = json.load(recent_file)
+    except ValueError:
+        logging.warning("Список последних заданий {} поврежден и будет перезаписан".format(RECENT_JOBS_FILE))
+        return []
+    return [job for job in jobs if isinstance(job, dict) and job.get("gdb") and job.get("old_db")]
+
+def write_recent_jobs(jobs):
+    text = to_text(json.dumps(jobs[:RECENT_JOBS_LIMIT], ensure_ascii=False, indent=1, default=to_text))
+    with io.open(RECENT_JOBS_FILE, "w", encoding="utf-8") as recent_file:
+        recent_file.write(text)
+
+def same_path(first, second):
+    return os.path.normcase(os.path.abspath(first)) == os.path.normcase(os.path.abspath(second))
+
+def catalog_snapshot(gdb_path):
+    """Снимок каталога базы геоданных: классы объектов (относительно базы) и время изменения состава базы"""
+    return {
+        "mtime": catalog_mtime(gdb_path),
+        "feature_classes": [os.path.relpath(fc, gdb_path) for fc in gdb_feature_classes(gdb_path)]
+    }
+
+def record_recent_job(gdb_path, old_db_path, selected_value, shortened_name, label_classes):
+    """Добавляет выполненное задание в начало списка последних заданий (повтор того же задания
+    заменяет прежнюю запись). Время изменения баз снимается после обработки, поэтому
+    при следующем запуске метаданные берутся из списка, только если базы с тех пор не менялись"""
+    try:
+        job = {
+            "gdb": to_text(gdb_path),
+            "old_db": to_text(old_db_path),
+            "value": to_text(selected_value),
+            "short": to_text(shortened_name),
+            "label_classes": [to_text(fc) for fc in label_classes],
+            "old_db_mtime": catalog_mtime(old_db_path),
+            "catalog": catalog_snapshot(gdb_path),
+            "time": datetime.datetime.now().isoformat()
+        }
+        jobs = [previous for previous in read_recent_jobs()
+                if not (same_path(previous["gdb"], gdb_path) and same_path(previous["old_db"], old_db_path)
+                        and previous.get("value") == job["value"])]
+        write_recent_jobs([job] + jobs)
+        logging.info("Задание {} ({}) добавлено в список последних заданий".format(selected_value, shortened_name))
+    except Exception as e:
+        # Список последних заданий - вспомогательный, его ошибка не влияет на результат задания
+        logging.warning("Не удалось сохранить список последних заданий: {}".format(str(e)))
+
+def recent_label_classes(old_db_path, recent_jobs):
+    """Классы надписей, найденные в базе прошлого тура одним из последних заданий, если состав базы
+    с тех пор не изменялся и все классы на месте; иначе None (нужен новый поиск)"""
+    mtime = catalog_mtime(old_db_path)
+    for job in recent_jobs:
+        if not same_path(job["old_db"], old_db_path) or not job.get("label_classes"):
+            continue
+        if job.get("old_db_mtime") != mtime:
+            logging.info("Состав базы прошлого тура %s изменился после задания %s, классы надписей будут найдены заново",
+                old_db_path, job.get("value"))
+            return None
+        if all(arcpy.Exists(fc) for fc in job["label_classes"]):
+            return list(job["label_classes"])
+    return None
+
+def check_recent_job(job):
+    """Проверяет, что базы задания на месте и в базе геоданных есть Lots. Пока состав базы не изменялся,
+    достаточно снимка каталога; иначе базы проверяются через arcpy.
     
-    # Создание и запуск интерфейса выбора базы данных прошлого тура
-    root = tk.Tk()
-    old_forest_selector = OldForestGDBSelector(root)
+    Returns:
+        str: текст ошибки или None
+    """
+    for path in (job["gdb"], job["old_db"]):
+        if not os.path.exists(path):
+            return "Не найдена база данных: {}".format(path)
+    catalog = job.get("catalog") or {}
+    if catalog.get("mtime") is not None and catalog.get("mtime") == catalog_mtime(job["gdb"]):
+        if "Lots" in [os.path.basename(fc) for fc in catalog.get("feature_classes", [])]:
+            logging.info("База геоданных {} не изменялась, используется снимок каталога".format(job["gdb"]))
+            return None
+    for path in (job["gdb"], job["old_db"]):
+        is_workspace, error = describe_workspace(path)
+        if error or not is_workspace:
+            return error or "Путь не является базой данных: {}".format(path)
+    if not find_feature_class(job["gdb"], "Lots"):
+        return "Класс объектов 'Lots' не найден в базе геоданных {}".format(job["gdb"])
+    return None
+
+class RecentJobsDialog:
+    """Выбор одного из последних заданий для повторного запуска без выбора баз и значения"""
+    def __init__(self, master, jobs):
+        self.master = master
+        self.jobs = jobs
+        self.selected_job = None
+        self.action = "cancel"
+        
+        # Настройка окна
+        master.title("Последние задания")
+        master.geometry("700x360")
+        
+        # Фрейм для содержимого
+        self.main_frame = tk.Frame(master, padx=20, pady=20)
+        self.main_frame.pack(fill=tk.BOTH, expand=True)
+        
+        # Заголовок
+        self.label = tk.Label(self.main_frame,
+                             text="Повторить одно из последних заданий или начать новое",
+                             font=("Arial", 12))
+        self.label.pack(pady=10)
+        
+        # Фрейм для списка
+        self.list_frame = tk.Frame(self.main_frame)
+        self.list_frame.pack(fill=tk.BOTH, expand=True, pady=5)
+        
+        self.scrollbar = tk.Scrollbar(self.list_frame)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        
+        self.listbox = tk.Listbox(self.list_frame,
+                                 yscrollcommand=self.scrollbar.set,
+                                 font=("Arial", 10),
+                                 height=10,
+                                 selectmode=tk.SINGLE)
+        self.listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.scrollbar.config(command=self.listbox.yview)
+        
+        for job in jobs:
+            self.listbox.insert(tk.END, u"{}   {} ({})   {}  <-  {}".format(
+                job.get("time", "")[:16].replace("T", " "), job.get("value"), job.get("short"),
+                os.path.basename(job["gdb"]), os.path.basename(job["old_db"])))
+        if jobs:
+            self.listbox.selection_set(0)
+        
+        # Двойной щелчок и Enter запускают выбранное задание
+        self.listbox.bind('<Double-1>', lambda event: self.launch())
+        self.master.bind('<Return>', lambda event: self.launch())
+        
+        # Кнопки
+        self.button_frame = tk.Frame(self.main_frame)
+        self.button_frame.pack(pady=10)
+        
+        self.launch_button = tk.Button(self.button_frame,
+                                     text="Запустить",
+                                     command=self.launch)
+        self.launch_button.pack(side=tk.LEFT, padx=5)
+        
+        self.new_button = tk.Button(self.button_frame,
+                                  text="Новое задание",
+                                  command=self.new_job)
+        self.new_button.pack(side=tk.LEFT, padx=5)
+        
+        self.cancel_button = tk.Button(self.button_frame,
+                                     text="Отмена",
+                                     command=master.destroy)
+        self.cancel_button.pack(side=tk.LEFT, padx=5)
+        
+        self.listbox.focus_set()
     
-    # Делаем диалог модальным
-    root.grab_set()
-    root.focus_set()
-    root.wait_window()
+    def launch(self):
+        selection = self.listbox.curselection()
+        if not selection:
+            messagebox.showerror("Ошибка", "Задание не выбрано")
+            return
+        job = self.jobs[int(selection[0])]
+        error = check_recent_job(job) if ARCPY_AVAILABLE else None
+        if error:
+            messagebox.showerror("Ошибка", error)
+            return
+        self.selected_job = job
+        self.action = "launch"
+        self.master.destroy()
     
-    old_db_path = old_forest_selector.db_path
-    if not old_db_path:
-        logging.info("Пользователь отменил выбор базы данных прошлого тура или возникла ошибка")
-        return
+    def new_job(self):
+        self.action = "new"
+        self.master.destroy()
+
+def main():
+    write_event({"event": "run_start", "argv": sys.argv, "python": sys.version.split()[0]})
+    
+    # Последние задания: повторный запуск без выбора баз и значения
+    recent_jobs = read_recent_jobs()
+    recent_job = None
+    if recent_jobs:
+        root = tk.Tk()
+        recent_dialog = RecentJobsDialog(root, recent_jobs)
+        
+        # Делаем диалог модальным
+        root.grab_set()
+        root.focus_set()
+        root.wait_window()
+        
+        if recent_dialog.action == "cancel":
+            logging.info("Пользователь отменил выбор задания")
+            return
+        recent_job = recent_dialog.selected_job
+    
+    if recent_job:
+        gdb_path = recent_job["gdb"]
+        old_db_path = recent_job["old_db"]
+        logging.info("Повторный запуск задания {} ({}) от {}".format(
+            recent_job.get("value"), recent_job.get("short"), recent_job.get("time")))
+    else:
+        # Создание и запуск интерфейса выбора GDB
+        root = tk.Tk()
+        gdb_selector = GDBSelector(root)
+        if recent_jobs:
+            gdb_selector.path_var.set(recent_jobs[0]["gdb"])
+        
+        # Делаем диалог модальным
+        root.grab_set()
+        root.focus_set()
+        root.wait_window()
+        
+        gdb_path = gdb_selector.gdb_path
+        if not gdb_path:
+            logging.info("Пользователь отменил выбор базы геоданных или возникла ошибка")
+            return
+        
+        # Создание и запуск интерфейса выбора базы данных прошлого тура
+        root = tk.Tk()
+        old_forest_selector = OldForestGDBSelector(root)
+        if recent_jobs:
+            old_forest_selector.path_var.set(recent_jobs[0]["old_db"])
+        
+        # Делаем диалог модальным
+        root.grab_set()
+        root.focus_set()
+        root.wait_window()
+        
+        old_db_path = old_forest_selector.db_path
+        if not old_db_path:
+            logging.info("Пользователь отменил выбор базы данных прошлого тура или возникла ошибка")
+            return
     
     # Информация о типе выбранной базы данных
     is_mdb = os.path.isfile(old_db_path) and old_db_path.lower().endswith('.mdb')
     db_type = "MDB" if is_mdb else "GDB"
     logging.info("Выбрана база данных прошлого тура: {} (тип: {})".format(old_db_path, db_type))
     
-    # Продолжаем с выбором значения
-    root = tk.Tk()
-    value_selector = ValueSelector(root, gdb_path)
-    
-    # Делаем диалог модальным
-    root.grab_set()
-    root.focus_set()
-    root.wait_window()
-    
-    selected_value = value_selector.selected_value
-    shortened_name = value_selector.shortened_name
+    if recent_job:
+        selected_value = recent_job.get("value")
+        shortened_name = recent_job.get("short")
+    else:
+        # Продолжаем с выбором значения
+        root = tk.Tk()
+        value_selector = ValueSelector(root, gdb_path)
+        
+        # Делаем диалог модальным
+        root.grab_set()
+        root.focus_set()
+        root.wait_window()
+        
+        selected_value = value_selector.selected_value
+        shortened_name = value_selector.shortened_name
     
     if not selected_value or not shortened_name:
         logging.info("Пользователь отменил выбор значения или не указал сокращение")
         return
     
-    # Находим классы надписей в базе данных прошлого тура
+    # Находим классы надписей в базе данных прошлого тура (или берем найденные
+    # одним из последних заданий, если база прошлого тура с тех пор не изменялась)
     label_processor = LabelClassProcessor(old_db_path, shortened_name)
-    success, message = label_processor.find_label_classes()
+    cached_label_classes = recent_label_classes(old_db_path, recent_jobs) if ARCPY_AVAILABLE else None
+    if cached_label_classes:
+        label_processor.labels_classes = cached_label_classes
+        success, message = True, "Классы надписей взяты из списка последних заданий"
+        logging.info("Классы надписей взяты из списка последних заданий: {}".format(
+            ", ".join(os.path.basename(fc) for fc in cached_label_classes)))
+    else:
+        success, message = label_processor.find_label_classes()
     
     if not success:
         # Проверяем тип проблемы
@@ -2696,8 +5558,7 @@ def main():
         land_clip_name = "Land_{}".format(shortened_name)
         
         # Определяем полный путь к созданному набору данных
-        cleaned_usname = selected_value.replace(" ", "_").replace("\"", "").replace("'", "")
-        new_dataset_name = "_{}".format(cleaned_usname)
+        new_dataset_name = dataset_name_for(selected_value)
         dataset_path = os.path.join(gdb_path, new_dataset_name)
         
         # Полный путь к слою Land_"Сокр"
@@ -2708,6 +5569,10 @@ def main():
             messagebox.showerror("Ошибка", "Не найден класс объектов '{}'".format(land_clip_name))
             return
         
+        # Исходные классы надписей для списка последних заданий (process_identity может
+        # заменить их перепроецированными копиями из кэша)
+        source_label_classes = list(label_processor.labels_classes)
+        
         # Выполняем операцию идентичности с Land_"Сокр" (не с Land_"Сокр"_контур)
         success = label_processor.process_identity(land_clip_path)
         
@@ -2715,65 +5580,905 @@ def main():
             logging.info("Операция идентичности успешно выполнена")
             messagebox.showinfo("Успех", "Операция идентичности успешно выполнена")
             
-            # После успешного выполнения всех операций сохраняем MXD файл
-            # ВАЖНО: Убраны промежуточные сохранения MXD из всех функций
-            # Теперь файл карты сохраняется только один раз - здесь, в конце работы скрипта
-            try:
-                if ARCPY_AVAILABLE:
-                    # Определяем продукт ArcGIS
-                    product_info = arcpy.ProductInfo()
-                    
-                    # Формируем имя для MXD файла на основе выбранного значения
-                    mxd_name = "_{}".format(cleaned_usname)
-                    mxd_path = os.path.join(os.path.dirname(gdb_path), "{}.mxd".format(mxd_name))
-                    
-                    # Для ArcMap
-                    if product_info in ["ArcView", "ArcEditor", "ArcInfo", "Desktop"]:
-                        import arcpy.mapping as mapping
-                        try:
-                            # Получаем текущий документ карты
-                            mxd = mapping.MapDocument("CURRENT")
-                            
-                            # Сохраняем копию карты
-                            mxd.saveACopy(mxd_path)
-                            logging.info("Финальная копия карты сохранена: {}".format(mxd_path))
-                            
-                            # Обновляем вид
-                            arcpy.RefreshTOC()
-                            arcpy.RefreshActiveView()
-                        except Exception as mxd_err:
-                            logging.error("Ошибка при сохранении финальной копии карты: {}".format(str(mxd_err)))
-                    
-                    # Для ArcGIS Pro
-                    elif product_info in ["ArcGISPro", "Pro"]:
-                        import arcpy.mp as mp
-                        try:
-                            # Получаем текущий проект
-                            aprx = mp.ArcGISProject("CURRENT")
-                            
-                            # Формируем имя для APRX файла
-                            aprx_path = os.path.join(os.path.dirname(gdb_path), "{}.aprx".format(mxd_name))
-                            
-                            # Сохраняем копию проекта
-                            aprx.saveACopy(aprx_path)
-                            logging.info("Финальная копия проекта сохранена: {}".format(aprx_path))
-                        except Exception as aprx_err:
-                            logging.error("Ошибка при сохранении финальной копии проекта: {}".format(str(aprx_err)))
-                    
-                    # Если не удалось определить продукт
-                    else:
-                        logging.warning("Не удалось определить продукт ArcGIS для финального сохранения документа карты")
-            except Exception as final_save_err:
-                logging.error("Общая ошибка при финальном сохранении документа карты: {}".format(str(final_save_err)))
         else:
             logging.error("Операция идентичности завершилась с ошибкой")
             messagebox.showerror("Ошибка", "Операция идентичности завершилась с ошибкой")
         
+        # Сжатие до добавления результатов в карту: после flush слои открыты
+        # документом карты и Compact не получает блокировку базы
+        if GDB_MAINTENANCE:
+            maintain_gdb(gdb_path, gdb_feature_classes(gdb_path, new_dataset_name))
+        
+        if success:
+            record_recent_job(gdb_path, old_db_path, selected_value, shortened_name, source_label_classes)
+        
     except Exception as e:
         error_message = "Ошибка при выполнении операции идентичности: {}".format(str(e))
         logging.error(error_message)
         log_exception(e, "Ошибка при выполнении операции идентичности")
         messagebox.showerror("Ошибка", error_message)
+    finally:
+        # Все изменения документа карты за задание: одно добавление слоев, обновление и сохранение.
+        # Выполняется и при ошибке после Identity, чтобы уже созданные слои попали в карту
+        map_updates.flush()
+
+def parse_command_line(argv=None):
+    """Разбирает параметры командной строки для запуска служебных режимов без интерфейса"""
+    parser = argparse.ArgumentParser(description="Подготовка слоя Land_\"Сокр\"_сетка")
+    parser.add_argument("--benchmark-identity", nargs=2, metavar=("TARGET_FC", "OLD_DB"),
+                        help="Замерить ускорение параллельного Identity для слоя TARGET_FC "
+                             "и классов надписей базы прошлого тура OLD_DB")
+    parser.add_argument("--workers", default="",
+                        help="Числа процессов для бенчмарка через запятую, например 1,2,4")
+    parser.add_argument("--analyze-events", nargs="?", const=EVENT_LOG_FILE, metavar="EVENTS_JSONL",
+                        help="Показать самые медленные этапы и регрессии по журналу событий")
+    parser.add_argument("--golden", nargs=3, metavar=("FIXTURE_GDB", "OLD_DB", "SHORT_NAME"),
+                        help="Собрать сетку базовой и оптимизированной конфигурацией настроек на копиях FIXTURE_GDB "
+                             "и сравнить результаты по геометрии, атрибутам и времени")
+    parser.add_argument("--optimized", default="",
+                        help="Настройки оптимизированного прогона, например PIPELINE_MODE=streaming,IDENTITY_WORKERS=4")
+    parser.add_argument("--baseline", "--legacy", dest="baseline", default="",
+                        help="Настройки базового прогона (дополняют GOLDEN_BASELINE_SETTINGS)")
+    parser.add_argument("--baseline-script", metavar="SCRIPT",
+                        help="Собрать базовую сетку прежней версией скрипта (например \"select_gdb 24.py\") "
+                             "вместо базовой конфигурации текущего кода")
+    parser.add_argument("--keep-scratch", action="store_true",
+                        help="Не удалять базы прогонов сравнения")
+    parser.add_argument("--batch", nargs=3, metavar=("GDB", "OLD_DB", "JOBS_FILE"),
+                        help="Обработать без интерфейса лесничества из JOBS_FILE (строки \"UsName_1;Сокр\" или \"UsName_1\", "
+                             "сокращение берется из таблицы сокращений)")
+    parser.add_argument("--dry-run", nargs=3, metavar=("GDB", "OLD_DB", "USNAME_OR_JOBS_FILE"),
+                        help="Оценить задания без выполнения геообработки: число объектов, вершин и охваты "
+                             "входных классов, длительность и память этапов по журналу событий, тайлинг")
+    parser.add_argument("--maintain", metavar="GDB",
+                        help="Сжать базу геоданных GDB, перестроить пространственные индексы и показать "
+                             "размер и скорость чтения до и после")
+    parser.add_argument("--provision-pool", nargs=2, metavar=("GDB", "COUNT"),
+                        help="Заранее создать в GDB COUNT наборов данных по шаблону \"Копия\" с пустыми классами "
+                             "контура и сетки")
+    return parser.parse_args(argv)
+
+def run_identity_benchmark(target_fc_path, old_db_path, workers=""):
+    """Запускает бенчмарк параллельного Identity из командной строки"""
+    if not ARCPY_AVAILABLE:
+        logging.error("Модуль arcpy недоступен, бенчмарк невозможен")
+        return False
+    
+    enable_headless_mode()
+    label_processor = LabelClassProcessor(old_db_path, "")
+    success, message = label_processor.find_label_classes(interactive=False)
+    if not success:
+        logging.error("Бенчмарк не выполнен: {}".format(message))
+        return False
+    
+    worker_counts = [int(value) for value in workers.split(",") if value.strip()] if workers else None
+    benchmark_parallel_identity(target_fc_path, label_processor.labels_classes, worker_counts)
+    return True
+
+# Настройки базового и оптимизированного прогонов в сравнении --golden. Без --baseline-script
+# сравниваются конфигурации текущего кода: базовая отключает настраиваемые ускорения, но раздробление
+# курсором, движок правил отбора и копирование контура курсором общие для обоих прогонов. Проверка
+# на результатах прежних версий скрипта - базовый прогон прежним скриптом (--baseline-script)
+GOLDEN_BASELINE_SETTINGS = {"PIPELINE_MODE": "legacy", "NPP_JOIN_ENGINE": "identity",
+                            "TILING_MODE": "off", "IDENTITY_WORKERS": 0, "SCRATCH_WORKSPACE": "in_memory",
+                            "LABEL_PROJECTION_CACHE": False, "INDEX_OUTPUTS": False}
+GOLDEN_OPTIMIZED_SETTINGS = {"PIPELINE_MODE": "streaming", "NPP_JOIN_ENGINE": "auto", "TILING_MODE": "auto",
+                             "SCRATCH_WORKSPACE": "auto"}
+# Допуски сравнения геометрии: разность площадей (м2) и расстояние Хаусдорфа (м)
+GOLDEN_AREA_TOLERANCE = 0.1
+GOLDEN_HAUSDORFF_TOLERANCE = 0.01
+
+def parse_settings(text):
+    """Разбирает строку вида "PIPELINE_MODE=streaming,IDENTITY_WORKERS=4" в словарь настроек
+    
+    Значения приводятся к типу текущего значения настройки модуля.
+    """
+    settings = {}
+    for item in (text or "").split(","):
+        if not item.strip():
+            continue
+        name, _, value = item.partition("=")
+        name = name.strip().upper()
+        value = value.strip()
+        if name not in globals():
+            raise ValueError("Неизвестная настройка: {}".format(name))
+        current = globals()[name]
+        if isinstance(current, bool):
+            value = value.lower() in ("1", "true", "yes", "on", "да")
+        elif isinstance(current, int):
+            value = int(value)
+        elif isinstance(current, float):
+            value = float(value)
+        settings[name] = value
+    return settings
+
+def apply_settings(settings):
+    """Устанавливает настройки модуля и возвращает их прежние значения"""
+    previous = {}
+    for name, value in settings.items():
+        previous[name] = globals()[name]
+        globals()[name] = value
+    return previous
+
+def find_feature_class(gdb_path, name):
+    """Ищет класс объектов по имени в корне базы геоданных и в ее наборах данных"""
+    previous_workspace = arcpy.env.workspace
+    try:
+        arcpy.env.workspace = gdb_path
+        if name in (arcpy.ListFeatureClasses() or []):
+            return os.path.join(gdb_path, name)
+        for dataset in arcpy.ListDatasets("", "Feature") or []:
+            if name in (arcpy.ListFeatureClasses(feature_dataset=dataset) or []):
+                return os.path.join(gdb_path, dataset, name)
+        return None
+    finally:
+        arcpy.env.workspace = previous_workspace
+
+def shape_rings(shape):
+    """Кольца полигона arcpy в виде списков координат (x, y)"""
+    rings = []
+    for part in shape:
+        ring = []
+        for point in part:
+            if point is None:
+                # Разделитель между внешним кольцом и дырками части
+                if ring:
+                    rings.append(ring)
+                ring = []
+            else:
+                ring.append((point.X, point.Y))
+        if ring:
+            rings.append(ring)
+    return rings
+
+def rings_area(rings):
+    """Площадь полигона по формуле шнурков; дырки обходятся в обратную сторону и вычитаются"""
+    total = 0.0
+    for ring in rings:
+        ring_sum = 0.0
+        for i in range(len(ring)):
+            x1, y1 = ring[i - 1]
+            x2, y2 = ring[i]
+            ring_sum += x1 * y2 - x2 * y1
+        total += ring_sum / 2.0
+    return abs(total)
+
+def hausdorff_distance(points_a, points_b):
+    """Дискретное расстояние Хаусдорфа между наборами вершин двух геометрий
+    
+    Ближайшая вершина ищется в списке, упорядоченном по X, от позиции вершины в обе стороны,
+    пока разность по X меньше найденного расстояния. Поиск для вершины прекращается, как только
+    найдена вершина ближе текущего максимума: такая вершина максимум не увеличит.
+    """
+    if points_a == points_b:
+        return 0.0
+    if not points_a or not points_b:
+        return float("inf")
+    
+    def directed(source, target):
+        target = sorted(target)
+        xs = [x for x, y in target]
+        worst = 0.0
+        for ax, ay in source:
+            nearest = float("inf")
+            right = bisect.bisect_left(xs, ax)
+            left = right - 1
+            while left >= 0 or right < len(target):
+                if right < len(target) and (left < 0 or xs[right] - ax <= ax - xs[left]):
+                    bx, by = target[right]
+                    right += 1
+                else:
+                    bx, by = target[left]
+                    left -= 1
+                dx = (ax - bx) ** 2
+                if dx >= nearest:
+                    break
+                distance = dx + (ay - by) ** 2
+                if distance < nearest:
+                    nearest = distance
+                    if nearest <= worst:
+                        break
+            if nearest > worst:
+                worst = nearest
+        return worst
+    
+    return math.sqrt(max(directed(points_a, points_b), directed(points_b, points_a)))
+
+def read_golden_features(fc, fields):
+    """Читает объекты класса в виде словарей с атрибутами, вершинами, площадью и охватом"""
+    existing = [f.name for f in arcpy.ListFields(fc)]
+    read_fields = [name for name in fields if name in existing]
+    features = []
+    with arcpy.da.SearchCursor(fc, ["SHAPE@"] + read_fields) as cursor:
+        for row in cursor:
+            values = dict(zip(read_fields, row[1:]))
+            rings = shape_rings(row[0]) if row[0] is not None else []
+            points = [point for ring in rings for point in ring]
+            feature = {"attrs": tuple(values.get(name) for name in fields), "points": points,
+                       "area": rings_area(rings), "extent": None, "centroid": None}
+            if points:
+                xs = [x for x, y in points]
+                ys = [y for x, y in points]
+                feature["extent"] = (min(xs), min(ys), max(xs), max(ys))
+                feature["centroid"] = (sum(xs) / len(xs), sum(ys) / len(ys))
+            features.append(feature)
+    return features
+
+def match_features(expected, actual, same_attrs=True, max_distance=None):
+    """Сопоставляет объекты двух выборок по ближайшему центру вершин среди пересекающихся охватов
+    
+    Returns:
+        tuple: (пары (ожидаемый, фактический), несопоставленные ожидаемые, несопоставленные фактические)
+    """
+    extent = None
+    for feature in actual:
+        if feature["extent"]:
+            extent = merge_extents(extent, feature["extent"]) if extent else feature["extent"]
+    index = GridIndex(grid_cell_size(extent, len(actual)) if extent else 1.0)
+    empty_ids = []
+    for i, feature in enumerate(actual):
+        if feature["extent"]:
+            index.insert(i, feature["extent"])
+        else:
+            empty_ids.append(i)
+    
+    used = set()
+    pairs = []
+    unmatched = []
+    for feature in expected:
+        if feature["extent"]:
+            candidates = index.query(feature["extent"])
+        else:
+            candidates = empty_ids
+        candidates = [i for i in candidates if i not in used and
+                      (not same_attrs or actual[i]["attrs"] == feature["attrs"])]
+        if max_distance is not None:
+            candidates = [i for i in candidates
+                          if hausdorff_distance(feature["points"], actual[i]["points"]) <= max_distance]
+        if not candidates:
+            unmatched.append(feature)
+            continue
+        
+        def distance(i):
+            if not feature["centroid"] or not actual[i]["centroid"]:
+                return (0.0, 0.0)
+            dx = feature["centroid"][0] - actual[i]["centroid"][0]
+            dy = feature["centroid"][1] - actual[i]["centroid"][1]
+            return (dx * dx + dy * dy, abs(feature["area"] - actual[i]["area"]))
+        
+        best = min(candidates, key=distance)
+        used.add(best)
+        pairs.append((feature, actual[best]))
+    
+    return pairs, unmatched, [feature for i, feature in enumerate(actual) if i not in used]
+
+def compare_golden_outputs(expected_fc, actual_fc, fields=("LandType", "LandCode", "NPP"),
+                           area_tolerance=None, hausdorff_tolerance=None):
+    """Сравнивает эталонный и проверяемый Land_"Сокр"_сетка по геометрии и атрибутам
+    
+    Объекты сопоставляются по атрибутам fields и положению; оставшиеся объекты
+    сопоставляются только по геометрии - такие пары считаются расхождением атрибутов.
+    
+    Returns:
+        dict: показатели сравнения; ключ "correct" - результат в пределах допусков
+    """
+    area_tolerance = GOLDEN_AREA_TOLERANCE if area_tolerance is None else area_tolerance
+    hausdorff_tolerance = GOLDEN_HAUSDORFF_TOLERANCE if hausdorff_tolerance is None else hausdorff_tolerance
+    expected = read_golden_features(expected_fc, fields)
+    actual = read_golden_features(actual_fc, fields)
+    
+    pairs, missing, extra = match_features(expected, actual)
+    attribute_pairs, missing, extra = match_features(missing, extra, same_attrs=False,
+                                                     max_distance=hausdorff_tolerance)
+    
+    result = {
+        "expected_count": len(expected),
+        "actual_count": len(actual),
+        "matched": len(pairs),
+        "attribute_mismatches": len(attribute_pairs),
+        "missing": len(missing),
+        "extra": len(extra),
+        "area_mismatches": 0,
+        "geometry_mismatches": 0,
+        "max_area_diff": 0.0,
+        "max_hausdorff": 0.0
+    }
+    for expected_feature, actual_feature in pairs:
+        area_diff = abs(expected_feature["area"] - actual_feature["area"])
+        distance = hausdorff_distance(expected_feature["points"], actual_feature["points"])
+        result["max_area_diff"] = max(result["max_area_diff"], area_diff)
+        result["max_hausdorff"] = max(result["max_hausdorff"], distance)
+        if area_diff > area_tolerance:
+            result["area_mismatches"] += 1
+        if distance > hausdorff_tolerance:
+            result["geometry_mismatches"] += 1
+    for expected_feature, actual_feature in attribute_pairs[:10]:
+        logging.info("Расхождение атрибутов %s: %s -> %s",
+            list(fields), expected_feature["attrs"], actual_feature["attrs"])
+    
+    result["correct"] = not (result["attribute_mismatches"] or result["missing"] or result["extra"] or
+                             result["area_mismatches"] or result["geometry_mismatches"])
+    return result
+
+def load_script_module(script_path):
+    """Загружает прежнюю версию скрипта как модуль, не запуская ее main; сообщения ее
+    интерфейса пишутся в лог (HeadlessMessageBox)"""
+    module_name = "select_gdb_baseline_{}".format(hashlib.md5(to_text(script_path).encode("utf-8")).hexdigest()[:8])
+    if sys.version_info[0] < 3:
+        import imp
+        module = imp.load_source(module_name, script_path)
+    else:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location(module_name, script_path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    module.messagebox = HeadlessMessageBox()
+    return module
+
+def run_golden_config(fixture_gdb, old_db_path, shortened_name, settings, scratch_root, label, script=None):
+    """Копирует эталонную базу и собирает в ней Land_"Сокр"_сетка с настройками settings
+    или, если задан script, функцией process_identity прежней версии скрипта
+    
+    Returns:
+        tuple: (путь к полученной сетке, время сборки в секундах)
+    """
+    run_gdb = os.path.join(scratch_root, "{}.gdb".format(label))
+    shutil.copytree(fixture_gdb, run_gdb)
+    target_fc_path = find_feature_class(run_gdb, "Land_{}".format(shortened_name))
+    if not target_fc_path:
+        raise RuntimeError("В базе {} нет класса Land_{}".format(fixture_gdb, shortened_name))
+    
+    previous = apply_settings(settings)
+    ScratchManager.reset_estimates()
+    try:
+        label_processor = LabelClassProcessor(old_db_path, shortened_name)
+        success, message = label_processor.find_label_classes(interactive=False)
+        if not success:
+            raise RuntimeError(message)
+        
+        if script:
+            # Классы надписей находит текущий код: поиск прежних версий может открыть диалог
+            legacy_processor = load_script_module(script).LabelClassProcessor(old_db_path, shortened_name)
+            legacy_processor.labels_classes = list(label_processor.labels_classes)
+            label_processor = legacy_processor
+            logging.info("Прогон сравнения '{}' скриптом {}".format(label, script))
+        else:
+            logging.info("Прогон сравнения '{}' с настройками {}".format(label, settings))
+        start = time.time()
+        with track_stage("golden_" + label, [target_fc_path], None, settings=settings, script=script):
+            label_processor.process_identity(target_fc_path)
+        seconds = time.time() - start
+    finally:
+        apply_settings(previous)
+    
+    output_path = os.path.join(os.path.dirname(target_fc_path), "Land_{}_сетка".format(shortened_name))
+    if not arcpy.Exists(output_path):
+        raise RuntimeError("Прогон '{}' не создал {}".format(label, output_path))
+    return output_path, seconds
+
+def run_golden_harness(fixture_gdb, old_db_path, shortened_name, optimized_settings=None,
+                       baseline_settings=None, keep_scratch=False, baseline_script=None):
+    """Собирает сетку базовой и оптимизированной конфигурацией настроек на копиях одной эталонной
+    базы и сообщает о совпадении результатов и ускорении. При baseline_script базовая сетка
+    собирается прежней версией скрипта
+    
+    Returns:
+        dict: показатели compare_golden_outputs, дополненные временем прогонов, или None
+    """
+    if not ARCPY_AVAILABLE:
+        logging.error("Модуль arcpy недоступен, сравнение с эталоном невозможно")
+        return None
+    
+    enable_headless_mode()
+    baseline_settings = dict(GOLDEN_BASELINE_SETTINGS, **(baseline_settings or {}))
+    optimized_settings = dict(GOLDEN_OPTIMIZED_SETTINGS, **(optimized_settings or {}))
+    scratch_root = tempfile.mkdtemp(prefix="golden_")
+    try:
+        baseline_output, baseline_seconds = run_golden_config(
+            fixture_gdb, old_db_path, shortened_name, baseline_settings, scratch_root, "baseline", baseline_script)
+        optimized_output, optimized_seconds = run_golden_config(
+            fixture_gdb, old_db_path, shortened_name, optimized_settings, scratch_root, "optimized")
+        result = compare_golden_outputs(baseline_output, optimized_output)
+    finally:
+        arcpy.ClearWorkspaceCache_management()
+        if keep_scratch:
+            logging.info("Базы прогонов сохранены в {}".format(scratch_root))
+        else:
+            shutil.rmtree(scratch_root, ignore_errors=True)
+    
+    result["baseline_seconds"] = baseline_seconds
+    result["optimized_seconds"] = optimized_seconds
+    result["speedup"] = baseline_seconds / optimized_seconds if optimized_seconds > 0 else 0.0
+    write_event({"event": "golden", "fixture": fixture_gdb, "baseline_settings": baseline_settings,
+                 "baseline_script": baseline_script, "optimized_settings": optimized_settings, "result": result})
+    
+    baseline_name = "Скрипт {}".format(os.path.basename(baseline_script)) if baseline_script else "Базовая конфигурация"
+    print("{}: {} объектов, {:.1f} с; оптимизированная: {} объектов, {:.1f} с; ускорение {:.2f}".format(
+        baseline_name, result["expected_count"], baseline_seconds, result["actual_count"], optimized_seconds,
+        result["speedup"]))
+    print("Совпало: {}, расхождения атрибутов: {}, отсутствует: {}, лишних: {}".format(
+        result["matched"], result["attribute_mismatches"], result["missing"], result["extra"]))
+    print("Вне допуска по площади: {} (макс. {:.4f} м2), по Хаусдорфу: {} (макс. {:.4f} м)".format(
+        result["area_mismatches"], result["max_area_diff"], result["geometry_mismatches"], result["max_hausdorff"]))
+    print("Результат: {}".format("совпадает с базовым прогоном" if result["correct"]
+                                 else "ОТЛИЧАЕТСЯ от базового прогона"))
+    return result
+
+def gdb_size(gdb_path):
+    """Размер файловой базы геоданных на диске, байт"""
+    total = 0
+    for root, _, files in os.walk(gdb_path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def gdb_feature_classes(gdb_path, dataset_name=None):
+    """Классы объектов набора данных dataset_name или всей базы геоданных"""
+    previous_workspace = arcpy.env.workspace
+    try:
+        arcpy.env.workspace = gdb_path
+        if dataset_name:
+            datasets = [dataset_name]
+        else:
+            datasets = [""] + (arcpy.ListDatasets("", "Feature") or [])
+        feature_classes = []
+        for dataset in datasets:
+            for name in arcpy.ListFeatureClasses(feature_dataset=dataset) or []:
+                feature_classes.append(os.path.join(gdb_path, dataset, name) if dataset else os.path.join(gdb_path, name))
+        return feature_classes
+    finally:
+        arcpy.env.workspace = previous_workspace
+
+def read_throughput(feature_classes, sample_rows=None):
+    """Скорость последовательного чтения классов объектов с геометрией, объектов в секунду.
+    Из каждого класса читаются первые sample_rows объектов (по умолчанию GDB_MAINTENANCE_SAMPLE_ROWS)"""
+    if sample_rows is None:
+        sample_rows = GDB_MAINTENANCE_SAMPLE_ROWS
+    row_count = 0
+    start_time = time.time()
+    for fc in feature_classes:
+        with arcpy.da.SearchCursor(fc, ["OID@", "SHAPE@"]) as cursor:
+            for n, _ in enumerate(cursor, 1):
+                row_count += 1
+                if n >= sample_rows:
+                    break
+    duration = time.time() - start_time
+    return row_count / duration if duration > 0 else None
+
+def maintain_gdb(gdb_path, feature_classes=None):
+    """Обслуживание файловой базы геоданных после задания с многократным удалением и созданием классов:
+    сжатие базы и перестроение пространственных индексов feature_classes (по умолчанию - всех классов).
+    Размер базы и скорость чтения до и после записываются в событие этапа "gdb_maintenance".
+    
+    Returns:
+        dict: событие этапа
+    """
+    if feature_classes is None:
+        feature_classes = gdb_feature_classes(gdb_path)
+    feature_classes = [fc for fc in feature_classes if arcpy.Exists(fc)]
+    
+    with track_stage("gdb_maintenance", [gdb_path], gdb_path) as stage_event:
+        stage_event["counts"]["input"] = len(feature_classes)
+        stage_event["size_before"] = gdb_size(gdb_path)
+        stage_event["rows_per_second_before"] = read_throughput(feature_classes)
+        
+        try:
+            arcpy.Compact_management(gdb_path)
+        except Exception as e:
+            # База может быть заблокирована открытым документом карты
+            logging.warning("Не удалось сжать базу геоданных {}: {}".format(gdb_path, str(e)))
+        for fc in feature_classes:
+            try:
+                arcpy.AddSpatialIndex_management(fc)
+            except Exception as e:
+                logging.warning("Не удалось перестроить пространственный индекс %s: %s", fc, str(e))
+        
+        stage_event["size_after"] = gdb_size(gdb_path)
+        stage_event["rows_per_second_after"] = read_throughput(feature_classes)
+    
+    logging.info("Обслуживание базы {}: размер {:.1f} -> {:.1f} МБ, чтение {} -> {} объектов/с".format(
+        gdb_path, stage_event["size_before"] / 1048576.0, stage_event["size_after"] / 1048576.0,
+        int(stage_event["rows_per_second_before"] or 0), int(stage_event["rows_per_second_after"] or 0)))
+    return stage_event
+
+def read_batch_jobs(jobs_path):
+    """Читает список заданий пакетного режима: строки "UsName_1;Сокр" или "UsName_1"
+    (сокращение из таблицы сокращений); пустые строки и строки, начинающиеся с #, пропускаются"""
+    jobs = []
+    with io.open(jobs_path, "r", encoding="utf-8-sig") as jobs_file:
+        for line in jobs_file:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            value, _, shortened_name = line.partition(";")
+            jobs.append((value.strip(), shortened_name.strip()))
+    return jobs
+
+def run_batch_job(gdb_path, old_db_path, selected_value, shortened_name):
+    """Обрабатывает одно лесничество без диалогов: подготовка данных и сборка сетки"""
+    label_processor = LabelClassProcessor(old_db_path, shortened_name)
+    success, message = label_processor.find_label_classes(interactive=False)
+    if not success:
+        logging.error("Лесничество '{}': классы надписей не найдены: {}".format(selected_value, message))
+        return False
+    
+    if not DataProcessor(gdb_path, selected_value, shortened_name).process_data():
+        logging.error("Лесничество '{}': обработка данных завершилась с ошибкой".format(selected_value))
+        return False
+    
+    land_clip_path = os.path.join(gdb_path, dataset_name_for(selected_value), "Land_{}".format(shortened_name))
+    if not arcpy.Exists(land_clip_path):
+        logging.error("Лесничество '{}': не найден класс объектов '{}'".format(selected_value, land_clip_path))
+        return False
+    try:
+        return label_processor.process_identity(land_clip_path)
+    finally:
+        # В режиме без интерфейса документ карты не изменяется, очередь только очищается
+        map_updates.flush()
+
+def run_batch(gdb_path, old_db_path, jobs):
+    """Пакетная обработка нескольких лесничеств без интерфейса
+    
+    Участки всех лесничеств извлекаются из Lots одним проходом (LotsPartitioner),
+    для каждого задания заранее готовится набор данных из пула (DatasetPool),
+    затем лесничества обрабатываются по очереди.
+    
+    Args:
+        jobs (list): [(UsName_1, Сокр), ...]; пустое Сокр - из таблицы сокращений (short_name_for)
+    """
+    if not ARCPY_AVAILABLE:
+        logging.error("Модуль arcpy недоступен, пакетная обработка невозможна")
+        return False
+    
+    enable_headless_mode()
+    # Сокращения, не указанные в файле заданий, берутся из таблицы сокращений или выводятся автоматически;
+    # указанные сохраняются в таблице для следующих запусков
+    short_names = read_short_names()
+    named_jobs = []
+    for value, shortened_name in jobs:
+        if shortened_name:
+            remember_short_name(value, shortened_name)
+            short_names[to_text(value)] = to_text(shortened_name)
+        else:
+            shortened_name = short_name_for(value, short_names)
+        named_jobs.append((value, shortened_name))
+    jobs = named_jobs
+    
+    lots_path = find_feature_class(gdb_path, "Lots")
+    if not lots_path:
+        logging.error("Класс объектов 'Lots' не найден в базе данных {}".format(gdb_path))
+        return False
+    
+    refresh_indexes(lots_path, [LotsPartitioner.value_field], source=True)
+    with track_stage("lots_partition", [lots_path], None, jobs=len(jobs)) as stage_event:
+        lots_counts = LotsPartitioner(lots_path).partition([value for value, shortened_name in jobs])
+        stage_event["counts"]["output"] = sum(lots_counts.values())
+    
+    with track_stage("pool_provision", [gdb_path], None, jobs=len(jobs)) as stage_event:
+        stage_event["counts"]["output"] = DatasetPool(gdb_path).provision(len(jobs))
+    
+    results = []
+    for n, (selected_value, shortened_name) in enumerate(jobs):
+        logging.info("Пакетный режим: лесничество %s/%s '%s' (%s)", n + 1, len(jobs), selected_value, shortened_name)
+        start = time.time()
+        if not lots_counts.get(selected_value):
+            logging.warning("В Lots нет участков лесничества '%s', пропущено", selected_value)
+            success = False
+        else:
+            try:
+                success = bool(run_batch_job(gdb_path, old_db_path, selected_value, shortened_name))
+                if GDB_MAINTENANCE:
+                    maintain_gdb(gdb_path, gdb_feature_classes(gdb_path, dataset_name_for(selected_value)))
+            except Exception as e:
+                log_exception(e, "Ошибка при пакетной обработке лесничества '{}'".format(selected_value))
+                success = False
+        results.append((selected_value, shortened_name, success, time.time() - start))
+    
+    print("Лесничество | Сокр. | Результат | Время, с")
+    for selected_value, shortened_name, success, seconds in results:
+        print("{} | {} | {} | {:.1f}".format(selected_value, shortened_name, "готово" if success else "ОШИБКА", seconds))
+    return all(success for _, _, success, _ in results)
+
+# Счетчик события этапа, которому пропорциональна длительность этапа (для оценки по журналу событий)
+PLAN_STAGE_COUNTS = {
+    "select_lots": "output",
+    "clip_land": "output",
+    "clip_land_contour": "output",
+    "identity": "labels",
+    "npp_join": "input",
+    "grid_pipeline": "input"
+}
+
+def read_centroids(fc, where_clause=None, spatial_reference=None, sample_size=200):
+    """Центроиды (SHAPE@XY) всех объектов класса в системе координат spatial_reference
+    и среднее число вершин по первым sample_size геометриям
+    
+    Returns:
+        dict: {"x": array, "y": array, "mean_points": N, "coordinate_count": N, "field_count": N}
+    """
+    desc = arcpy.Describe(fc)
+    xs = array.array("d")
+    ys = array.array("d")
+    with arcpy.da.SearchCursor(fc, ["SHAPE@XY"], where_clause, spatial_reference) as cursor:
+        for (xy,) in cursor:
+            if xy is None or xy[0] is None:
+                continue
+            xs.append(xy[0])
+            ys.append(xy[1])
+    point_count = 0
+    sampled = 0
+    with arcpy.da.SearchCursor(fc, ["SHAPE@"], where_clause) as cursor:
+        for (shape,) in cursor:
+            point_count += shape.pointCount if shape is not None else 0
+            sampled += 1
+            if sampled >= sample_size:
+                break
+    return {
+        "x": xs,
+        "y": ys,
+        "mean_points": point_count / float(max(sampled, 1)),
+        "coordinate_count": 2 + (1 if desc.hasZ else 0) + (1 if desc.hasM else 0),
+        "field_count": len([f for f in desc.fields if f.type != "Geometry"])
+    }
+
+def feature_statistics(fc, where_clause=None, extent=None, spatial_reference=None, exact=False, sample_size=200,
+                       cache=None):
+    """Статистика класса объектов без геообработки (только чтение курсором)
+    
+    При exact=True читаются все геометрии: точное число вершин и охват. Иначе читаются
+    только центроиды (SHAPE@XY), учитываются объекты с центроидом в охвате extent
+    (xmin, ymin, xmax, ymax), а число вершин и объем оцениваются по первым sample_size геометриям.
+    Словарь cache сохраняет прочитанные центроиды между вызовами: при оценке нескольких заданий
+    класс читается один раз, а охват каждого задания отбирается из сохраненных центроидов.
+    
+    Returns:
+        dict: {"count": N, "vertices": N, "bytes": N, "extent": (xmin, ymin, xmax, ymax) или None}
+    """
+    count = 0
+    point_count = 0
+    bounds = None
+    
+    if exact:
+        desc = arcpy.Describe(fc)
+        coordinate_count = 2 + (1 if desc.hasZ else 0) + (1 if desc.hasM else 0)
+        field_count = len([f for f in desc.fields if f.type != "Geometry"])
+        with arcpy.da.SearchCursor(fc, ["SHAPE@"], where_clause, spatial_reference) as cursor:
+            for (shape,) in cursor:
+                if shape is None:
+                    continue
+                count += 1
+                point_count += shape.pointCount
+                box = (shape.extent.XMin, shape.extent.YMin, shape.extent.XMax, shape.extent.YMax)
+                bounds = box if bounds is None else (min(bounds[0], box[0]), min(bounds[1], box[1]),
+                                                     max(bounds[2], box[2]), max(bounds[3], box[3]))
+        mean_points = point_count / float(max(count, 1))
+    else:
+        key = (to_text(fc), where_clause,
+               spatial_reference.exportToString() if spatial_reference is not None else None)
+        centroids = cache.get(key) if cache is not None else None
+        if centroids is None:
+            centroids = read_centroids(fc, where_clause, spatial_reference, sample_size)
+            if cache is not None:
+                cache[key] = centroids
+        for x, y in zip(centroids["x"], centroids["y"]):
+            if extent and not (extent[0] <= x <= extent[2] and extent[1] <= y <= extent[3]):
+                continue
+            count += 1
+            bounds = (x, y, x, y) if bounds is None else (min(bounds[0], x), min(bounds[1], y),
+                                                          max(bounds[2], x), max(bounds[3], y))
+        mean_points = centroids["mean_points"]
+        coordinate_count = centroids["coordinate_count"]
+        field_count = centroids["field_count"]
+    
+    return {
+        "count": count,
+        "vertices": int(count * mean_points),
+        "bytes": int(count * (mean_points * coordinate_count + field_count) * 8),
+        "extent": bounds
+    }
+
+def stage_rates(events=None):
+    """Стоимость этапов по журналу событий
+    
+    Returns:
+        dict: {этап: (медиана секунд на 1000 объектов счетчика PLAN_STAGE_COUNTS или None,
+                      медиана длительности)}
+    """
+    events = read_events() if events is None else events
+    per_stage = {}
+    for event in events:
+        if event.get("event") != "stage" or event.get("status") != "ok" or event.get("duration") is None:
+            continue
+        if event.get("stage") not in PLAN_STAGE_COUNTS:
+            continue
+        per_stage.setdefault(event["stage"], []).append(event)
+    
+    rates = {}
+    for stage, stage_events in per_stage.items():
+        count_key = PLAN_STAGE_COUNTS[stage]
+        per_thousand = [event["duration"] * 1000.0 / event["counts"][count_key] for event in stage_events
+                        if event.get("counts", {}).get(count_key)]
+        rates[stage] = (median_value(per_thousand) if per_thousand else None,
+                        median_value([event["duration"] for event in stage_events]))
+    return rates
+
+def estimate_stage_seconds(rates, stage, count):
+    """Оценка длительности этапа для count объектов счетчика этапа; None - этап еще не выполнялся"""
+    if stage not in rates:
+        return None
+    per_thousand, median_duration = rates[stage]
+    if per_thousand is not None:
+        return per_thousand * count / 1000.0
+    return median_duration
+
+def plan_job(gdb_path, old_db_path, selected_value, rates=None, recent_jobs=None, centroid_cache=None):
+    """План задания без выполнения геообработки: статистика входных данных в охвате
+    участков лесничества, оценка длительности и памяти этапов и необходимость тайлинга.
+    centroid_cache - общий для всех заданий оценки кэш центроидов Land, Admi и классов надписей
+    
+    Returns:
+        dict: план задания (также записывается в журнал событий как событие "dry_run")
+    """
+    rates = stage_rates() if rates is None else rates
+    short_names = read_short_names()
+    plan = {
+        "value": to_text(selected_value),
+        "short": short_names.get(to_text(selected_value)) or derive_short_name(selected_value, short_names.values()),
+        "sources": {},
+        "stages": [],
+        "warnings": []
+    }
+    
+    lots_path = find_feature_class(gdb_path, "Lots")
+    land_path = find_feature_class(gdb_path, "Land")
+    admi_path = find_feature_class(gdb_path, "Admi")
+    if not lots_path or not land_path:
+        plan["warnings"].append("Классы 'Lots' и 'Land' не найдены в базе геоданных")
+        return plan
+    if arcpy.Exists(os.path.join(gdb_path, dataset_name_for(selected_value))):
+        plan["warnings"].append("Набор данных {} уже существует и будет перезаписан".format(dataset_name_for(selected_value)))
+    
+    lots_sr = arcpy.Describe(lots_path).spatialReference
+    where_clause = "{} = {}".format(arcpy.AddFieldDelimiters(lots_path, "UsName_1"), FilterRule.sql_values([selected_value]))
+    lots_stats = feature_statistics(lots_path, where_clause, exact=True)
+    plan["sources"]["Lots"] = lots_stats
+    if not lots_stats["count"]:
+        plan["warnings"].append("В Lots нет участков лесничества")
+        return plan
+    extent = lots_stats["extent"]
+    
+    land_stats = feature_statistics(land_path, extent=extent, spatial_reference=lots_sr, cache=centroid_cache)
+    plan["sources"]["Land"] = land_stats
+    if admi_path:
+        plan["sources"]["Admi"] = feature_statistics(admi_path, extent=extent, spatial_reference=lots_sr,
+                                                     cache=centroid_cache)
+    
+    # Классы надписей: из списка последних заданий, пока база прошлого тура не изменялась
+    label_classes = recent_label_classes(old_db_path, read_recent_jobs() if recent_jobs is None else recent_jobs)
+    if not label_classes:
+        label_processor = LabelClassProcessor(old_db_path, plan["short"])
+        success, message = label_processor.find_label_classes(interactive=False)
+        if not success:
+            plan["warnings"].append("Классы надписей не найдены: {}".format(message))
+        label_classes = label_processor.labels_classes if success else []
+    label_stats = []
+    for label_class in label_classes:
+        stats = feature_statistics(label_class, extent=extent, spatial_reference=lots_sr, cache=centroid_cache)
+        plan["sources"][os.path.basename(label_class)] = stats
+        label_stats.append((os.path.basename(label_class), stats))
+    
+    # Этапы в порядке выполнения: (этап, объект, значение счетчика, оценка объема временных данных)
+    land_count = land_stats["count"]
+    tiled = TiledProcessor.is_required(land_count)
+    stages = [
+        ("select_lots", "Lots", lots_stats["count"], lots_stats["bytes"], False),
+        ("clip_land", "Land", land_count, land_stats["bytes"], tiled),
+        ("clip_land_contour", "Land", land_count, land_stats["bytes"], tiled)
+    ]
+    identity_tiled = identity_workers() > 1 or tiled
+    for name, stats in label_stats:
+        stages.append(("identity", name, stats["count"], land_stats["bytes"] + stats["bytes"], identity_tiled))
+    stages.append(("grid_pipeline" if PIPELINE_MODE == "streaming" and not identity_tiled else "npp_join",
+                   "Land_{}".format(plan["short"]), land_count, land_stats["bytes"], identity_tiled))
+    
+    for stage, source, count, memory, stage_tiled in stages:
+        plan["stages"].append({
+            "stage": stage,
+            "source": source,
+            "count": count,
+            "seconds": estimate_stage_seconds(rates, stage, count),
+            "memory": memory,
+            "tiled": stage_tiled
+        })
+    
+    budget = SCRATCH_MEMORY_BUDGET_MB * 1024 * 1024
+    peak_memory = max(item["memory"] for item in plan["stages"])
+    plan["peak_memory"] = peak_memory
+    if peak_memory > budget and SCRATCH_WORKSPACE == "auto":
+        plan["warnings"].append("Временные классы не помещаются в {} МБ и будут вынесены во временную GDB".format(
+            SCRATCH_MEMORY_BUDGET_MB))
+    elif peak_memory > budget:
+        plan["warnings"].append("Временные классы превышают бюджет памяти {} МБ (SCRATCH_WORKSPACE = {})".format(
+            SCRATCH_MEMORY_BUDGET_MB, SCRATCH_WORKSPACE))
+    if tiled:
+        plan["warnings"].append("Land в охвате лесничества: {} объектов, обработка по тайлам".format(land_count))
+    
+    write_event({"event": "dry_run", "gdb": to_text(gdb_path), "old_db": to_text(old_db_path), "plan": plan})
+    return plan
+
+def print_plan(plan):
+    """Выводит план задания plan_job"""
+    print(u"Лесничество: {} (Сокр.: {})".format(plan["value"], plan["short"]))
+    if plan["sources"]:
+        print(u"{:<32} {:>10} {:>12} {:>10}".format(u"Класс", u"Объектов", u"Вершин", u"Объем, МБ"))
+        for name, stats in sorted(plan["sources"].items()):
+            print(u"{:<32} {:>10} {:>12} {:>10.1f}".format(
+                name, stats["count"], stats["vertices"], stats["bytes"] / 1048576.0))
+    if plan["stages"]:
+        print(u"{:<20} {:<32} {:>10} {:>10} {:>10} {:>6}".format(
+            u"Этап", u"Объект", u"Объектов", u"Время, с", u"Память, МБ", u"Тайлы"))
+        known = [item["seconds"] for item in plan["stages"] if item["seconds"] is not None]
+        for item in plan["stages"]:
+            print(u"{:<20} {:<32} {:>10} {:>10} {:>10.1f} {:>6}".format(
+                item["stage"], item["source"], item["count"],
+                "{:.1f}".format(item["seconds"]) if item["seconds"] is not None else "?",
+                item["memory"] / 1048576.0, u"да" if item["tiled"] else u""))
+        print(u"Оценка длительности: {:.0f} с{}".format(
+            sum(known), "" if len(known) == len(plan["stages"]) else
+            " (без этапов, которых нет в журнале событий: {})".format(len(plan["stages"]) - len(known))))
+    for warning in plan["warnings"]:
+        print(u"ВНИМАНИЕ: {}".format(warning))
+
+def run_dry_run(gdb_path, old_db_path, target):
+    """Предварительная оценка заданий без выполнения: target - значение UsName_1
+    или файл заданий пакетного режима"""
+    if not ARCPY_AVAILABLE:
+        logging.error("Модуль arcpy недоступен, оценка заданий невозможна")
+        return False
+    
+    enable_headless_mode()
+    values = [value for value, _ in read_batch_jobs(target)] if os.path.isfile(target) else [to_text(target)]
+    rates = stage_rates()
+    recent_jobs = read_recent_jobs()
+    # Land, Admi и классы надписей читаются один раз для всех заданий
+    centroid_cache = {}
+    plans = []
+    for value in values:
+        plan = plan_job(gdb_path, old_db_path, value, rates, recent_jobs, centroid_cache)
+        print_plan(plan)
+        print("")
+        plans.append(plan)
+    return all(plan["stages"] for plan in plans)
 
 if __name__ == "__main__":
-    main()
+    args = parse_command_line()
+    if args.analyze_events:
+        analyze_events(args.analyze_events)
+    elif args.batch:
+        batch_success = run_batch(args.batch[0], args.batch[1], read_batch_jobs(args.batch[2]))
+        sys.exit(0 if batch_success else 1)
+    elif args.dry_run:
+        sys.exit(0 if run_dry_run(*args.dry_run) else 1)
+    elif args.maintain:
+        if not ARCPY_AVAILABLE:
+            logging.error("Модуль arcpy недоступен, обслуживание базы геоданных невозможно")
+            sys.exit(1)
+        maintain_gdb(args.maintain)
+    elif args.provision_pool:
+        if not ARCPY_AVAILABLE:
+            logging.error("Модуль arcpy недоступен, пул наборов данных не создан")
+            sys.exit(1)
+        pool_size = DatasetPool(args.provision_pool[0]).provision(int(args.provision_pool[1]))
+        print("Свободных наборов данных в пуле: {}".format(pool_size))
+    elif args.golden:
+        golden_result = run_golden_harness(args.golden[0], args.golden[1], args.golden[2],
+                                           parse_settings(args.optimized), parse_settings(args.baseline),
+                                           args.keep_scratch, args.baseline_script)
+        sys.exit(0 if golden_result and golden_result["correct"] else 1)
+    elif args.benchmark_identity:
+        run_identity_benchmark(args.benchmark_identity[0], args.benchmark_identity[1], args.workers)
+    else:
+        main()